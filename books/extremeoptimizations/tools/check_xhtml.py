@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+# Checks that generated pages are well-formed XHTML, using the
+# checker built into textile.py.
+#
+# Usage: check_xhtml.py [dir or file ...]
+# With no arguments, checks the book's output directory.
+# Exits with 1 if any problems were found.
+
+import sys, os, os.path
+import textile
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+BASE_DIR = os.path.realpath(os.path.join(SCRIPT_DIR, ".."))
+OUTDIR = os.path.realpath(os.path.join(BASE_DIR, "..", "..", "www", "extremeoptimizations"))
+
+def read(path):
+    fo = open(path, "rb")
+    d = fo.read()
+    fo.close()
+    return d
+
+def html_files(path):
+    if os.path.isfile(path):
+        return [path]
+    files = []
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        dirnames.sort()
+        for f in sorted(filenames):
+            if f.endswith(".html"):
+                files.append(os.path.join(dirpath, f))
+    return files
+
+def check_file(path):
+    errors = textile.check_xhtml(textile._text(read(path)))
+    for (line, column, message) in errors:
+        print("%s:%d:%d: %s" % (path, line, column, message))
+    return len(errors)
+
+def main():
+    paths = sys.argv[1:]
+    if not paths:
+        paths = [OUTDIR]
+    nfiles = 0
+    nerrors = 0
+    for path in paths:
+        for f in html_files(path):
+            nfiles += 1
+            nerrors += check_file(f)
+    print("%d files, %d problems" % (nfiles, nerrors))
+    if nerrors > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,7 @@
 # of ParsedStr class in a format suitable for including with
 # optimization_story.textile
 
-import sys, os.path, subprocess, string, re
+import sys, os.path, subprocess, re
 
 SCRIPTDIR = os.path.realpath(sys.argv[0])
 SCRIPTDIR = os.path.dirname(SCRIPTDIR)
@@ -27,7 +27,7 @@ elif not is_linux():
 OUTFILEPATH = os.path.join(TXTSRCDIR, "parsedstr-size-stats-%s.html" % SYSTEM)
 
 def log(txt):
-    print txt,
+    sys.stdout.write(txt)
 
 # like cmdrun() but throws an exception on failure
 def run_cmd_throw(*args):
@@ -35,13 +35,15 @@ def run_cmd_throw(*args):
     log("Running '%s'\n" % cmd)
     cmdproc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     res = cmdproc.communicate()
+    # bytes on Python 3
+    res = [r if isinstance(r, str) else r.decode("latin-1") for r in res]
     errcode = cmdproc.returncode
     if 0 != errcode:
-        print "Failed with error code %d" % errcode
-        print "Stdout:"
-        print res[0]
-        print "Stderr:"
-        print res[1]
+        print("Failed with error code %d" % errcode)
+        print("Stdout:")
+        print(res[0])
+        print("Stderr:")
+        print(res[1])
         raise Exception("'%s' failed with error code %d" % (cmd, errcode))
     return (res[0], res[1])
 
@@ -67,6 +69,8 @@ class FileInfo(object):
         print("sizeof:   %d" % self.sizeof)
 
 def write(path, data):
+    if not isinstance(data, bytes):
+        data = data.encode("latin-1")
     fo = open(path, "wb")
     fo.write(data)
     fo.close()
@@ -92,17 +96,17 @@ def html_from_filesinfo(filesinfo):
     lines.append("</table>")
     lines.append("</center>")
     lines.append("")
-    return string.join(lines, "\n")
+    return "\n".join(lines)
 
 def gcc_version():
     (stdout, stderr) = run_cmd_throw("gcc", "--version")
-    lines = string.split(stdout, "\n")
+    lines = stdout.split("\n")
     ver = lines[0].strip()
     return ver
 
 def get_parsed_str_sizeof(exe):
     (stdout, stderr) = run_cmd_throw(exe)
-    reg = "sizeof\(ParsedStr\)=(\d+)"
+    reg = r"sizeof\(ParsedStr\)=(\d+)"
     regcomp = re.compile(reg, re.MULTILINE)
     m = regcomp.search(stdout)
     sizeoftxt = m.group(1)
@@ -123,11 +127,12 @@ def main():
         fi = FileInfo(filename, readablename, filesize)
         fi.sizeof = get_parsed_str_sizeof(filepath)
         filesinfo.append(fi)
-    filesinfo.sort(lambda x,y: cmp(x.size, y.size))
+    filesinfo.sort(key=lambda fi: fi.size)
     smallest_size = filesinfo[0].size
     for fi in filesinfo:
         fi.size_vs_smallest = fi.size - smallest_size
-    map(FileInfo.dump, filesinfo)
+    for fi in filesinfo:
+        fi.dump()
     html = html_from_filesinfo(filesinfo)
     #print html
     write(OUTFILEPATH, html)
@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 import os.path
 import sys
-import string
 import shutil
+import hashlib
+import json
+import traceback
 import textile
 
+# On Python 3 the files are read as str with one character for
+# each byte (latin-1), so they go through exactly as they do as
+# Python 2 byte strings and are written back unchanged.
+PY3 = sys.version_info[0] >= 3
+
 SCRIPT_DIR = os.path.dirname(__file__)
 BASE_DIR = os.path.realpath(os.path.join(SCRIPT_DIR, ".."))
 TXTSRCDIR = os.path.join(BASE_DIR, "txtsrc")
@@ -16,9 +23,19 @@ def read(path):
     fo = open(path, "rb")
     d = fo.read()
     fo.close()
+    if PY3:
+        d = d.decode("latin-1")
     return d
 
+def readfilelines(path):
+    for l in open(path, "rb"):
+        if PY3:
+            l = l.decode("latin-1")
+        yield l
+
 def write(path, data):
+    if PY3:
+        data = data.encode("latin-1")
     fo = open(path, "wb")
     fo.write(data)
     fo.close()
@@ -96,13 +113,13 @@ def is_includetxt(line): return line.startswith("@includetxt ")
 def readlines(filename, start, end):
     lines = []
     line_no = 1
-    for l in open(filename, "rb"):
+    for l in readfilelines(filename):
         if line_no > end:
-            return string.join(lines, "")
+            return "".join(lines)
         if line_no >= start:
             lines.append(l)
         line_no += 1
-    return string.join(lines, "")
+    return "".join(lines)
 
 g_token = "asdflkasdfasdf:\n"
 # A lame way to generate unique string that we can then string.replace()
@@ -127,6 +144,8 @@ def do_includesrc(line):
     filepath = os.path.join(SRCDIR, filename)
     verify_file_exists(filepath)
     txt = readlines(filepath, startline, endline)
+    if g_deps is not None:
+        g_deps.append(["lines", filepath, startline, endline])
     return (filepath, txt)
 
 def do_includetxt(line, lines):
@@ -138,10 +157,155 @@ def do_includetxt(line, lines):
     filename = parts[1].strip()
     filepath = os.path.join(TXTSRCDIR, filename)
     txt = read(filepath)
+    if g_deps is not None:
+        g_deps.append(["file", filepath])
     lines.append(txt)
 
 g_do_tokens = True
 
+# Set by --memory: a textile.MemoryProfile that every page is
+# rendered with, printed at the end of the build.
+g_profile = None
+
+# Set by --incremental: only rebuild the outputs whose inputs have
+# changed since the last build. What each output was built from is
+# kept, with content hashes, in STATEFILE, next to txtsrc and out of
+# the web root (the outputs are absolute paths, so builds into other
+# directories don't get mixed up):
+#   {"files": {path: [mtime, size, sha1]},
+#    "outputs": {output: [dep, ...]}}
+# where a dep is ["file", path, sha1] or, for an @includesrc,
+# ["lines", path, start, end, sha1 of the file, sha1 of the lines].
+# A file whose mtime and size haven't changed isn't read again.
+g_incremental = False
+g_state = None
+# the includes of the page being parsed, see do_includesrc()
+g_deps = None
+
+STATEFILE = os.path.join(BASE_DIR, ".rebuild_state")
+
+# The scripts the output comes from (not their .pyc). Every output
+# depends on them.
+def tool_files():
+    return [os.path.splitext(m.__file__)[0] + ".py" for m in (textile, sys.modules[__name__])]
+
+def load_state():
+    global g_state
+    g_state = {"files": {}, "outputs": {}}
+    if file_exists(STATEFILE):
+        fo = open(STATEFILE, "r")
+        try:
+            g_state = json.load(fo)
+        except ValueError:
+            print("Ignoring malformed '%s'" % STATEFILE)
+        fo.close()
+
+def save_state():
+    tmppath = tmpfilename(STATEFILE)
+    fo = open(tmppath, "w")
+    json.dump(g_state, fo, indent=0, sort_keys=True)
+    fo.close()
+    os.rename(tmppath, STATEFILE)
+
+def sha1(data):
+    if PY3:
+        data = data.encode("latin-1")
+    return hashlib.sha1(data).hexdigest()
+
+def file_hash(path):
+    st = os.stat(path)
+    entry = g_state["files"].get(path)
+    if entry is None or entry[0] != st.st_mtime or entry[1] != st.st_size:
+        entry = [st.st_mtime, st.st_size, sha1(read(path))]
+        g_state["files"][path] = entry
+    return entry[2]
+
+def dep_with_hashes(dep):
+    if dep[0] == "lines":
+        (kind, path, start, end) = dep
+        return dep + [file_hash(path), sha1(readlines(path, start, end))]
+    return dep + [file_hash(dep[1])]
+
+def dep_changed(dep):
+    if not file_exists(dep[1]):
+        return True
+    if dep[0] == "lines":
+        (kind, path, start, end, filehash, lineshash) = dep
+        h = file_hash(path)
+        if h == filehash:
+            return False
+        # the file changed, but maybe not the included lines
+        if sha1(readlines(path, start, end)) != lineshash:
+            return True
+        dep[4] = h
+        return False
+    return file_hash(dep[1]) != dep[2]
+
+def up_to_date(outputs):
+    deps = g_state["outputs"].get(outputs[0])
+    if deps is None:
+        return False
+    for path in outputs:
+        if not file_exists(path):
+            return False
+    for dep in deps:
+        if dep_changed(dep):
+            return False
+    return True
+
+def record_deps(output, deps):
+    g_state["outputs"][output] = [dep_with_hashes(dep) for dep in deps]
+
+# Set by -j N: build the files on a pool of N processes.
+g_jobs = 1
+
+def worker_settings():
+    return (TXTSRCDIR, SRCDIR, OUTDIR, OUTSRCDIR, g_do_tokens, g_incremental)
+
+def init_worker(settings):
+    global TXTSRCDIR, SRCDIR, OUTDIR, OUTSRCDIR, g_do_tokens, g_incremental
+    (TXTSRCDIR, SRCDIR, OUTDIR, OUTSRCDIR, g_do_tokens, g_incremental) = settings
+    # once for each worker instead of once for each file
+    header()
+    footer()
+    headersrc()
+    footersrc()
+    textile.textile("tell me about textile.")
+
+# Runs dofile() or dosrcfile() in a worker. Returns (<result>, <error>,
+# <state>), where <error> is the traceback if it failed and <state>
+# what it recorded for --incremental. The parent has already checked
+# that the file is out of date, so it starts from an empty state.
+def build_job(job):
+    global g_state
+    (func, srcpath) = job
+    g_state = {"files": {}, "outputs": {}}
+    try:
+        return (func(srcpath), None, g_state)
+    except Exception:
+        return (None, traceback.format_exc(), None)
+
+# Returns (<results>, <paths of the files that failed>). A file that
+# fails doesn't stop the others.
+def build_parallel(jobs):
+    import multiprocessing
+    pool = multiprocessing.Pool(g_jobs, init_worker, (worker_settings(),))
+    results = []
+    errors = []
+    try:
+        for ((func, srcpath), (res, error, state)) in zip(jobs, pool.imap(build_job, jobs)):
+            if error is not None:
+                print("Failed to build '%s':\n%s" % (srcpath, error))
+                errors.append(srcpath)
+            if g_incremental and state is not None:
+                g_state["files"].update(state["files"])
+                g_state["outputs"].update(state["outputs"])
+            results.append(res)
+    finally:
+        pool.close()
+        pool.join()
+    return (results, errors)
+
 # Generate sth. like this:
 # "ParsedStrTest.cpp":src/ParsedStrTest.cpp.html ("raw":src/ParsedStrTest.cpp.txt):
 def src_textile_link(basename):
@@ -159,7 +323,7 @@ def parse_textile(srcpath):
     lines = []
     state = ST_START
     tokens = {}
-    for l in open(srcpath, "rb"):
+    for l in readfilelines(srcpath):
         if ST_START == state:
             if is_comment(l): continue
             if is_sep(l):
@@ -182,7 +346,7 @@ def parse_textile(srcpath):
                 do_includetxt(l, lines)
             else:
                 lines.append(l)
-    txt = string.join(lines, "")
+    txt = "".join(lines)
     return (txt, tokens, keys)
 
 def htmlify(text):
@@ -204,6 +368,14 @@ def code_for_filename(filename):
             return '<code class="' + ext_to_classname[ext] + '">'
     return "<code>"
 
+# textile() takes the text as bytes, like Python 2 gives it
+def render(txt):
+    if PY3:
+        txt = txt.encode("latin-1")
+    if g_profile is not None:
+        return textile.textile_memory(txt, g_profile)
+    return textile.textile(txt)
+
 def dofile(srcpath):
     if not issrcfile(srcpath):
         print("Skipping '%s'" % srcpath)
@@ -212,8 +384,14 @@ def dofile(srcpath):
     if dstpath is None:
         print("Ignoring file '%s'" % srcpath)
         return
+    if g_incremental and up_to_date([dstpath]):
+        return False
     tmppath = tmpfilename(srcpath)
+    global g_deps
+    g_deps = []
     (txt, tokens, keys) = parse_textile(srcpath)
+    deps = g_deps
+    g_deps = None
     title = ""
     if "Title" in keys:
         title = keys["Title"]
@@ -221,7 +399,7 @@ def dofile(srcpath):
     hdr = hdr.replace("$title", title)
     ftr = footer()
     #write(tmppath, txt)
-    html = textile.textile(txt)
+    html = render(txt)
     if g_do_tokens:
         #print tokens.keys()
         for token in tokens.keys():
@@ -233,12 +411,29 @@ def dofile(srcpath):
             token = token.strip()
             html = html.replace(token, codehtml)
     write(dstpath, hdr + html + ftr)
+    if g_incremental:
+        files = [srcpath, os.path.join(TXTSRCDIR, "_header.html"), os.path.join(TXTSRCDIR, "_footer.html")] + tool_files()
+        record_deps(dstpath, [["file", f] for f in files] + deps)
+    return True
 
 def issourcecodefile(path):
     for ext in [".cpp", ".cc", ".c", ".h", "makefile"]:
         if path.endswith(ext): return True
     return False
 
+def srcoutputs(srcpath):
+    base = os.path.join(OUTSRCDIR, os.path.basename(srcpath))
+    return [base + ".html", base + ".txt"]
+
+# The files that func(srcpath) writes, None if it skips srcpath
+def job_outputs(func, srcpath):
+    if func is dofile:
+        if issrcfile(srcpath) and outfilename(srcpath) is not None:
+            return [outfilename(srcpath)]
+    elif issourcecodefile(srcpath):
+        return srcoutputs(srcpath)
+    return None
+
 def dosrcfile(srcpath):
     if not issourcecodefile(srcpath):
         print("Skipping '%s'" % srcpath)
@@ -246,22 +441,83 @@ def dosrcfile(srcpath):
     base = os.path.basename(srcpath)
     txtpath = os.path.join(OUTSRCDIR, base) + ".txt"
     htmlpath = os.path.join(OUTSRCDIR, base) + ".html"
+    if g_incremental and up_to_date(srcoutputs(srcpath)):
+        return False
     copy_file(srcpath, txtpath)
     hdr = headersrc()
     hdr = hdr.replace("$title", base)
     html = hdr + "<pre>" + code_for_filename(srcpath) + "\n" + htmlify(read(srcpath)) + "\n</code></pre>\n"
     html = html + footersrc()
     write(htmlpath, html)
+    if g_incremental:
+        files = [srcpath, os.path.join(TXTSRCDIR, "_header_src.html"), os.path.join(TXTSRCDIR, "_footer_src.html")] + tool_files()
+        record_deps(htmlpath, [["file", f] for f in files])
+    return True
 
 def main():
     verify_dir_exists(TXTSRCDIR)
     verify_dir_exists(SRCDIR)
     verify_dir_exists(OUTDIR)
     ensure_dir(OUTSRCDIR)
+    if g_incremental:
+        load_state()
+    jobs = []
     files = [os.path.join(TXTSRCDIR, f) for f in os.listdir(TXTSRCDIR)]
-    map(dofile, [f for f in files if os.path.isfile(f)])
+    jobs += [(dofile, f) for f in files if os.path.isfile(f)]
     files = [os.path.join(SRCDIR, f) for f in os.listdir(SRCDIR)]
-    map(dosrcfile, [f for f in files if os.path.isfile(f)])
+    jobs += [(dosrcfile, f) for f in files if os.path.isfile(f)]
+    # dofile() and dosrcfile() return True if they built the file,
+    # False if it was up to date and None if they skipped it
+    results = []
+    errors = []
+    try:
+        if g_jobs > 1:
+            todo = []
+            for (func, f) in jobs:
+                outputs = job_outputs(func, f)
+                if outputs is None:
+                    # only prints that it skips the file
+                    results.append(func(f))
+                elif g_incremental and up_to_date(outputs):
+                    results.append(False)
+                else:
+                    todo.append((func, f))
+            if todo:
+                (built, errors) = build_parallel(todo)
+                results += built
+        else:
+            for (func, f) in jobs:
+                results.append(func(f))
+    finally:
+        if g_incremental:
+            save_state()
+    if g_incremental:
+        print("Rebuilt %d of %d files" % (results.count(True), len(results) - results.count(None)))
+    if errors:
+        raise Exception("%d files failed to build: %s" % (len(errors), ", ".join(errors)))
+    return results.count(True)
+
+def usage():
+    print("usage: %s [--incremental] [--memory] [-j N]" % os.path.basename(sys.argv[0]))
+    sys.exit(1)
 
 if __name__ == "__main__":
-    main()
+    args = sys.argv[1:]
+    if "--incremental" in args:
+        g_incremental = True
+    if "-j" in args:
+        i = args.index("-j")
+        if i + 1 >= len(args) or not args[i + 1].isdigit():
+            usage()
+        g_jobs = int(args[i + 1])
+        if g_jobs > 1 and "--memory" in args:
+            print("--memory needs a serial build, without -j")
+            sys.exit(1)
+    if "--memory" in args:
+        g_profile = textile.MemoryProfile()
+        g_profile.start()
+        main()
+        g_profile.stop()
+        sys.stdout.write(g_profile.report())
+    else:
+        main()
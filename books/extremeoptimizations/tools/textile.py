@@ -122,8 +122,23 @@ ENCODING = 'latin-1'
 # converted to XML entities if you choose ASCII.
 OUTPUT = 'ascii'
 
+# Textile writes quotes, dashes and other glyphs as numeric
+# entities (&#8217;). Set this to 1, usually along with
+# output='utf-8', to get the characters themselves wherever
+# the output encoding has them. Only &, <, >, " and ' stay
+# entities, since HTML needs those escaped.
+LITERAL = 0
+
+# Set this to 1 to give every header an id and collect a
+# table of contents while rendering. textile() then returns
+# it as the 'toc' attribute of the HTML, and a paragraph
+# with just {toc} in it is replaced by the list.
+TOC = 0
+
 # PyTextile can optionally validate the generated
-# XHTML code. We can use either mxTidy or uTidyLib.
+# XHTML code. With 1 the built-in checker reports any
+# problems to stderr; with 'tidy' the code is cleaned
+# up with either mxTidy or uTidyLib.
 # You can change the default behaviour here.
 VALIDATE = 0
 
@@ -157,11 +172,196 @@ amazon_associate_id = None
 #AMAZON = 'www.amazon.co.uk'
 AMAZON = 'www.amazon.com'
 
+# Colorized Python code is cached in memory. If you also
+# want to keep it between runs, set a directory here and
+# the colorizer will only run for code that changed.
+COLOR_CACHE_DIR = None
+#COLOR_CACHE_DIR = '/var/cache/pytextile'
+
+# How many colorized blocks are kept in memory. When the
+# cache is full it's emptied and filled again, so callers
+# that run for a long time don't keep every block forever.
+COLOR_CACHE_SIZE = 1000
+
+# How inline formatting is done. 'rewrite' runs every
+# phase over the whole text, one after the other. 'spans'
+# finds the quick tags on the original text and builds the
+# HTML in one pass, falling back to 'rewrite' for text where
+# that could give a different result.
+INLINE_ENGINE = 'rewrite'
+
+# textile_many() prescans each batch of documents for
+# inline markup. Set this to 1 to do it with NumPy, in
+# one vectorized pass over the whole batch. Without
+# NumPy installed it falls back to a pure Python scan,
+# which is the default since it only looks for a few
+# characters and is usually just as fast.
+PRESCAN_NUMPY = 0
+
 import re
 import sys
 import os
-import sgmllib
-import unicodedata
+
+# Python 3. The text is worked on as a str with one character for
+# each byte of the input, decoded as latin-1, so it goes through
+# exactly what Python 2 does with a byte string (see _internal()).
+# For the same reason the regular expressions only know ASCII and
+# only ASCII whitespace is stripped (see _whitespace).
+_PY3 = sys.version_info[0] >= 3
+
+if _PY3:
+    unichr = chr
+    _ASCII = re.ASCII
+
+    def _bytes(text):
+        return text.encode('latin-1')
+
+    def _text(data):
+        return data.decode('latin-1')
+
+    def _internal(text, encoding):
+        """The text as process() works on it: bytes are taken as
+        they are, a str is encoded with 'encoding' first."""
+        if isinstance(text, str):
+            text = text.encode(encoding, 'xmlcharrefreplace')
+        return text.decode('latin-1')
+
+    def _decode(text, encoding):
+        return text.encode('latin-1').decode(encoding)
+
+    def _encode(text, output, errors):
+        return text.encode(output, errors).decode(output)
+else:
+    _ASCII = 0
+
+    def _bytes(text):
+        return text
+
+    def _text(data):
+        return data
+
+    def _internal(text, encoding):
+        return text
+
+    def _decode(text, encoding):
+        return unicode(text, encoding)
+
+    def _encode(text, output, errors):
+        return text.encode(output, errors)
+
+# What str.strip() takes away from a Python 2 byte string. A
+# Python 3 str has more whitespace, like '\xa0' (a latin-1
+# no-break space).
+_whitespace = ' \t\n\r\x0b\x0c'
+
+# Python 2 lists the keys of a dict in the order of their slots in
+# its hash table, and that's the order build_open_tag() writes the
+# attributes of a tag in. Python 3 keeps the order they were added
+# in, so the attributes are kept in an _Attributes, which works out
+# where 64-bit Python 2 would have put each key.
+if _PY3:
+    _MASK64 = 0xFFFFFFFFFFFFFFFF
+    _DUMMY = object()
+
+    def _py2_hash(key):
+        """hash() of a byte string on 64-bit Python 2."""
+        if not key:
+            return 0
+        x = ord(key[0]) << 7
+        for c in key:
+            x = ((1000003 * x) & _MASK64) ^ ord(c)
+        x ^= len(key)
+        if x == _MASK64:
+            x -= 1
+        return x
+
+    class _Attributes(dict):
+        """A dict with items() in the order of Python 2's dict.
+
+        Mirrors the hash table of Python 2's dictobject.c: its
+        size, the slots of the keys and of the deleted ones, and
+        when it grows, on assignment, deletion and update().
+        """
+        def __init__(self, items=()):
+            dict.__init__(self)
+            self.table = [None] * 8
+            self.fill = 0
+            for key, value in items:
+                self[key] = value
+
+        def _slot(self, key, h):
+            # The slot a new key goes to: the first deleted one on
+            # its probe sequence, or else the first empty one.
+            table = self.table
+            mask = len(table) - 1
+            i = h & mask
+            perturb = h
+            free = None
+            while table[i & mask] is not None:
+                if table[i & mask] is _DUMMY and free is None:
+                    free = i & mask
+                i = (5 * i + perturb + 1) & _MASK64
+                perturb >>= 5
+            if free is not None:
+                return free
+            self.fill += 1
+            return i & mask
+
+        def _resize(self, minused):
+            size = 8
+            while size <= minused:
+                size <<= 1
+            old = [entry for entry in self.table if entry is not None and entry is not _DUMMY]
+            self.table = [None] * size
+            self.fill = 0
+            for key, h in old:
+                self.table[self._slot(key, h)] = (key, h)
+
+        def _insert(self, key):
+            h = _py2_hash(key)
+            self.table[self._slot(key, h)] = (key, h)
+
+        def __setitem__(self, key, value):
+            if key not in self:
+                self._insert(key)
+                dict.__setitem__(self, key, value)
+                if self.fill * 3 >= len(self.table) * 2:
+                    self._resize(4 * len(self))
+            else:
+                dict.__setitem__(self, key, value)
+
+        def __delitem__(self, key):
+            dict.__delitem__(self, key)
+            for i, entry in enumerate(self.table):
+                if entry is not None and entry is not _DUMMY and entry[0] == key:
+                    self.table[i] = _DUMMY
+
+        def update(self, other):
+            if not isinstance(other, _Attributes):
+                other = _Attributes(other.items())
+            if not other:
+                return
+            if (self.fill + len(other)) * 3 >= len(self.table) * 2:
+                self._resize((len(self) + len(other)) * 2)
+            # No growing until the next assignment.
+            for key, value in other.items():
+                if key not in self:
+                    self._insert(key)
+                dict.__setitem__(self, key, value)
+
+        def items(self):
+            return [(entry[0], self[entry[0]]) for entry in self.table if entry is not None and entry is not _DUMMY]
+
+    def _groupdict(m):
+        """m.groupdict(''), built the way Python 2 builds it: in
+        the order of the pattern's groupindex, itself a dict."""
+        names = _Attributes([(name, None) for name in m.re.groupindex])
+        return _Attributes([(name, m.group(name) or '') for name, gid in names.items()])
+else:
+    _Attributes = dict
+
+    def _groupdict(m):
+        return m.groupdict('')
 
 
 def _in_tag(text, tag):
@@ -178,80 +378,251 @@ def _in_tag(text, tag):
     if text.count('</%s' % tag):
         text = text.split('</%s' % tag, 1)[0]
 
-    text = text.strip().replace('\r\n', '\n')
+    text = text.strip(_whitespace).replace('\r\n', '\n')
 
     return text
 
 
+# Compiled regular expressions, keyed by (pattern, flags).
+# The re module keeps its own cache, but it's small and gets
+# flushed completely when it fills up, so the grammar would be
+# recompiled over and over on long documents.
+_compiled = {}
+
+def _compile(pattern, flags=0):
+    """Compile a regular expression once.
+
+    This works like re.compile, except the result is kept for
+    the lifetime of the module. Nothing is compiled until the
+    first time a pattern is actually used.
+    """
+    try:
+        return _compiled[(pattern, flags)]
+    except KeyError:
+        p = _compiled[(pattern, flags)] = re.compile(pattern, flags | _ASCII)
+        return p
+
+
+def _compile_res(template, flags=0, extra=()):
+    """Compile a pattern built from the expressions in res.
+
+    Like _compile, but the template is only formatted with res
+    (plus any extra (name, expression) pairs) the first time
+    it's used.
+    """
+    key = (template, flags, extra)
+    try:
+        return _compiled[key]
+    except KeyError:
+        params = dict(res)
+        params.update(dict(extra))
+        p = _compiled[key] = re.compile(template % params, flags | _ASCII)
+        return p
+
+
 # If you want PyTextile to automatically colorize
 # your Python code, you need the htmlizer module
 # from Twisted. (You can just grab this file from
 # the distribution, it has no other dependencies.)
-try:
-    #from twisted.python import htmlizer
-    import htmlizer
-    from StringIO import StringIO
+# It's only imported the first time we see Python
+# code in a "bc" block.
+htmlizer = None
+_htmlizer_checked = 0
 
-    def _color(code):
-        """Colorizer Python code.
+def _load_htmlizer():
+    """Import the colorizer on first use.
 
-        This function wraps a text string in a StringIO,
-        and passes it to the htmlizer function from
-        Twisted.
-        """
-        # Fix line continuations.
-        code = preg_replace(r' \\\n', ' \\\\\n', code)
-        
-        code_in  = StringIO(code)
-        code_out = StringIO()
+    Returns the htmlizer module, or None if it's not
+    installed.
+    """
+    global htmlizer, _htmlizer_checked
+    if not _htmlizer_checked:
+        _htmlizer_checked = 1
+        try:
+            #from twisted.python import htmlizer as _htmlizer
+            import htmlizer as _htmlizer
+            htmlizer = _htmlizer
+        except ImportError:
+            htmlizer = None
+
+    return htmlizer
 
-        htmlizer.filter(code_in, code_out)
 
-        # Remove <pre></pre> from input.
-        code = _in_tag(code_out.getvalue(), 'pre')
+def _htmlize(code):
+    """Colorizer Python code.
+
+    This function wraps a text string in a StringIO,
+    and passes it to the htmlizer function from
+    Twisted.
+    """
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        from io import StringIO
+
+    # Fix line continuations.
+    code = preg_replace(r' \\\n', ' \\\\\n', code)
+    
+    code_in  = StringIO(code)
+    code_out = StringIO()
 
-        # Fix newlines.
-        code = code.replace('<span class="py-src-newline">\n</span>', '<span class="py-src-newline"></span>\n')
+    _load_htmlizer().filter(code_in, code_out)
 
-        return code
+    # Remove <pre></pre> from input.
+    code = _in_tag(code_out.getvalue(), 'pre')
 
-except ImportError:
-    htmlizer = None
+    # Fix newlines.
+    code = code.replace('<span class="py-src-newline">\n</span>', '<span class="py-src-newline"></span>\n')
+
+    return code
+
+
+# Colorized code, keyed by the SHA-1 of the source.
+_color_cache = {}
+
+def _color_key(code):
+    import hashlib
+    return hashlib.sha1(_bytes(code)).hexdigest()
+
+
+def _color_remember(key, html):
+    if len(_color_cache) >= COLOR_CACHE_SIZE:
+        _color_cache.clear()
+    _color_cache[key] = html
+
+
+def _color_path(key):
+    return os.path.join(COLOR_CACHE_DIR, key + '.html')
+
+
+def _color_load(key):
+    """Look up colorized code in the caches."""
+    if key in _color_cache:
+        return _color_cache[key]
+
+    if COLOR_CACHE_DIR:
+        try:
+            f = open(_color_path(key), 'rb')
+            try:
+                html = _text(f.read())
+            finally:
+                f.close()
+        except IOError:
+            return None
+        _color_remember(key, html)
+        return html
+
+    return None
+
+
+def _color_store(key, html):
+    """Save colorized code in the caches."""
+    _color_remember(key, html)
+
+    if COLOR_CACHE_DIR:
+        try:
+            if not os.path.isdir(COLOR_CACHE_DIR):
+                os.makedirs(COLOR_CACHE_DIR)
+            # Write to a temporary file first, so a concurrent
+            # build never reads a half-written entry.
+            path = _color_path(key)
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            f = open(tmp, 'wb')
+            try:
+                f.write(_bytes(html))
+            finally:
+                f.close()
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            _debug('Could not write %s to the color cache.' % key)
+
+
+def _color(code):
+    """Colorize Python code, using the cache.
+
+    The htmlizer only runs for code that isn't in the
+    in-memory cache or in COLOR_CACHE_DIR.
+    """
+    key = _color_key(code)
+    html = _color_load(key)
+    if html is None:
+        html = _htmlize(code)
+        _color_store(key, html)
+
+    return html
+
+
+def color_many(codes):
+    """Colorize a batch of Python code blocks.
+
+    Returns the colorized blocks in the same order. Every
+    distinct block is looked up in the caches once, and only
+    the ones that are missing are passed to the htmlizer.
+    """
+    keys = [_color_key(code) for code in codes]
+    done = {}
+    for key, code in zip(keys, codes):
+        if key in done:
+            continue
+
+        html = _color_load(key)
+        if html is None:
+            html = _htmlize(code)
+            _color_store(key, html)
+        done[key] = html
+
+    return [done[key] for key in keys]
 
 
 # PyTextile can optionally validate the generated
-# XHTML code using either mxTidy or uTidyLib.
-try:
-    # This is mxTidy.
+# XHTML code using either mxTidy or uTidyLib. The
+# validators are only looked up when validation is
+# first requested.
+_tidy = None
+_tidy_checked = 0
+
+def _tidy1(text):
+    """mxTidy's XHTML validator.
+
+    This function is a wrapper to mxTidy's validator.
+    """
     from mx.Tidy import Tidy
-    
-    def _tidy1(text):
-        """mxTidy's XHTML validator.
+    nerrors, nwarnings, text, errortext = Tidy.tidy(text, output_xhtml=1, numeric_entities=1, wrap=0)
+    return _in_tag(text, 'body')
 
-        This function is a wrapper to mxTidy's validator.
-        """
-        nerrors, nwarnings, text, errortext = Tidy.tidy(text, output_xhtml=1, numeric_entities=1, wrap=0)
-        return _in_tag(text, 'body')
 
-    _tidy = _tidy1
+def _tidy2(text):
+    """uTidyLib's XHTML validator.
 
-except ImportError:
-    try:
-        # This is uTidyLib.
-        import tidy
+    This function is a wrapper to uTidyLib's validator.
+    """
+    import tidy
+    text = tidy.parseString(text,  output_xhtml=1, add_xml_decl=0, indent=0, tidy_mark=0)
+    return _in_tag(str(text), 'body')
 
-        def _tidy2(text):
-            """uTidyLib's XHTML validator.
 
-            This function is a wrapper to uTidyLib's validator.
-            """
-            text = tidy.parseString(text,  output_xhtml=1, add_xml_decl=0, indent=0, tidy_mark=0)
-            return _in_tag(str(text), 'body')
+def _load_tidy():
+    """Find a validator on first use.
 
-        _tidy = _tidy2
+    Returns _tidy1 if mxTidy is installed, _tidy2 if
+    uTidyLib is installed, or None.
+    """
+    global _tidy, _tidy_checked
+    if not _tidy_checked:
+        _tidy_checked = 1
+        try:
+            # This is mxTidy.
+            from mx.Tidy import Tidy
+            _tidy = _tidy1
+        except ImportError:
+            try:
+                # This is uTidyLib.
+                import tidy
+                _tidy = _tidy2
+            except ImportError:
+                _tidy = None
 
-    except ImportError:
-        _tidy = None
+    return _tidy
     
 
 # This is good for debugging.
@@ -261,7 +632,7 @@ def _debug(s, level=1):
     This function outputs debug information if DEBUGLEVEL is
     higher than a given treshold.
     """
-    if DEBUGLEVEL >= level: print >> sys.stderr, s
+    if DEBUGLEVEL >= level: sys.stderr.write('%s\n' % (s,))
 
 
 #############################
@@ -450,6 +821,289 @@ res = {
 }
 
 
+# The characters a block signature with a dot can start with.
+_extend_breakers = 'pbhfdt<>=()[{#*'
+
+def _separators(text):
+    """Find the blank lines between blocks.
+
+    Yields (start, end, last) for every run of whitespace with two
+    or more newlines in it: start is its first newline, end is where
+    the run stops and last is its last newline. These are the places
+    where re.split(r'((\n\\s*){2,})', text) would split, but found
+    without backtracking.
+    """
+    p = _compile(r'''\n[^\S\n]*\n\s*''')
+    for m in p.finditer(text):
+        start, end = m.span()
+        yield start, end, text.rfind('\n', start, end)
+
+
+# Characters without which an inline phase can't change the text.
+# format() looks for them before running a phase and skips the
+# phase when none of them are there.
+_qtags_triggers = '$^*_?-+~@%'
+_glyphs_triggers = '"\'.-x([{:@\x60\xb4'
+
+# Quick tags: (delimiter, HTML tag, pattern parameters), in the
+# order qtags() applies them.
+_qtags = [('**', 'b',      (('qf', r'(?<!\*)\*\*(?!\*)'), ('cls', r'\*'))),
+          ('__', 'i',      (('qf', '(?<!_)__(?!_)'), ('cls', '_'))),
+          ('??', 'cite',   (('qf', r'\?\?(?!\?)'), ('cls', r'\?'))),
+          ('-',  'del',    (('qf', r'(?<!\-)\-(?!\-)'), ('cls', '-'))),
+          ('+',  'ins',    (('qf', r'(?<!\+)\+(?!\+)'), ('cls', r'\+'))),
+          ('*',  'strong', (('qf', r'(?<!\*)\*(?!\*)'), ('cls', r'\*'))),
+          ('_',  'em',     (('qf', '(?<!_)_(?!_)'), ('cls', '_'))),
+          ('++', 'big',    (('qf', r'(?<!\+)\+\+(?!\+)'), ('cls', r'\+\+'))),
+          ('--', 'small',  (('qf', r'(?<!\-)\-\-(?!\-)'), ('cls', r'\-\-'))),
+          ('~',  'sub',    (('qf', r'(?<!\~)\~(?!(\\/~))'), ('cls', r'\~'))),
+          ('@',  'code',   (('qf', '(?<!@)@(?!@)'), ('cls', '@'))),
+          ('%',  'span',   (('qf', '(?<!%)%(?!%)'), ('cls', '%'))),
+          ]
+
+def _qtag_re(redict):
+    """Get the regular expression for one of the _qtags."""
+    return _compile_res(r'''(?:                          #
+                           ^                        # Start of string
+                           |                        #
+                           (?<=[\s>'"])             # Whitespace, end of tag, quotes
+                           |                        #
+                           (?P<pre>[{[])            # Surrounded by [ or {
+                           |                        #
+                           (?<=%(punct)s)           # Punctuation
+                       )                            #
+                       %(qf)s                       # opening tag
+                       %(qattr)s                    # attributes
+                       (?P<text>[^%(cls)s\s].*?)    # text
+                       (?<=\S)                      # non-whitespace
+                       %(qf)s                       # 
+                       (?:                          #
+                           $                        # End of string
+                           |                        #
+                           (?P<post>[\]}])          # Surrounded by ] or }
+                           |                        # 
+                           (?=%(punct)s{1,2}|\s)    # punctuation
+                        )                           #
+                     ''', re.VERBOSE, redict)
+
+
+# The characters quick tags are delimited with.
+_qtag_chars = '*_?-+~@%'
+
+def _has_any(text, chars):
+    """Check if any of the characters is in the text."""
+    for c in chars:
+        if c in text:
+            return True
+    return False
+
+
+# Inline markup characters that textile never adds to the text by
+# itself (only itex output could have them, and itex needs a '$').
+# If a document doesn't have one of them, none of its blocks has.
+_document_triggers = '$^*~@!'
+
+# NumPy is only imported by _prescan(), with PRESCAN_NUMPY.
+numpy = None
+_numpy_checked = 0
+
+def _load_numpy():
+    """Import NumPy on first use.
+
+    Returns the numpy module, or None if it's not installed.
+    """
+    global numpy, _numpy_checked
+    if not _numpy_checked:
+        _numpy_checked = 1
+        try:
+            import numpy as _numpy
+            numpy = _numpy
+        except ImportError:
+            numpy = None
+
+    return numpy
+
+
+def _prescan(texts):
+    """Find the _document_triggers in a batch of documents.
+
+    Returns a list with the characters each text contains. With
+    PRESCAN_NUMPY, the texts are joined in one byte array, every
+    byte is mapped to a trigger bit in a single vectorized pass
+    and the bits are or'ed per document; otherwise each text is
+    searched with 'in'. Both give the same result.
+    """
+    np = PRESCAN_NUMPY and _load_numpy()
+    if not np or not texts or [t for t in texts if not isinstance(t, str)]:
+        return [''.join([c for c in _document_triggers if c in text]) for text in texts]
+
+    # Offsets of the documents in the batch. Empty documents get
+    # no slot, since reduceat() doesn't handle empty ranges.
+    lengths = np.array([len(t) for t in texts])
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    nonempty = np.flatnonzero(lengths)
+
+    buf = np.frombuffer(_bytes(''.join(texts)), dtype=np.uint8)
+    table = np.zeros(256, dtype=np.uint8)
+    for i, c in enumerate(_document_triggers):
+        table[ord(c)] = 1 << i
+
+    # Bit i of bits[doc] is set if the document has trigger i.
+    bits = np.zeros(len(texts), dtype=np.uint8)
+    if len(nonempty):
+        bits[nonempty] = np.bitwise_or.reduceat(table[buf], starts[nonempty])
+
+    present = []
+    for b in bits.tolist():
+        present.append(''.join([c for i, c in enumerate(_document_triggers) if b & (1 << i)]))
+    return present
+
+
+# Images, for images(): !src(alt)!:link
+_image_re = r'''\!               # Opening !
+             %(iattr)s        # Image attributes
+             (?P<src>%(url)s) # Image src
+             \s?              # Optional whitesapce
+             (                #
+                 \(           #
+                 (?P<alt>.*?) # Optional (alt) attribute
+                 \)           #
+             )?               #
+             \s?              # Optional whitespace
+             %(resize)s       # Resize parameters
+             \!               # Closing !
+             (                # Optional link
+                 :            #    starts with ':'
+                 (?P<link>    #    
+                 %(url)s      #    link HREF
+                 )            #
+             )?               #
+          '''
+
+# Links, for links(): ["text":href] and "text(title)":url
+_link_res = [r'''\[                           # [
+                 (?P<quote>"|')               # Opening quotes
+                 %(lattr)s                    # Link attributes
+                 (?P<text>[^"]+?)             # Link text
+                 \s?                          # Optional whitespace
+                 (?:\((?P<title>[^\)]+?)\))?  # Optional (title)
+                 (?P=quote)                   # Closing quotes
+                 :                            # :
+                 (?P<href>[^\]]+)             # HREF
+                 \]                           # ]
+              ''',
+             r'''(?P<quote>"|')               # Opening quotes
+                 %(lattr)s                    # Link attributes
+                 (?P<text>[^"]+?)             # Link text
+                 \s?                          # Optional whitespace
+                 (?:\((?P<title>[^\)]+?)\))?  # Optional (title)
+                 (?P=quote)                   # Closing quotes
+                 :                            # :
+                 (?P<href>%(url)s)            # HREF
+              ''']
+
+# What glyphs() turns into links: URLs, with a protocol, and emails.
+_glyph_url = r'''(?=[a-zA-Z0-9./#])                          # Must start correctly
+                 ((?:                                        # Match the leading part (proto://hostname, or just hostname)
+                     (?:ftp|https?|telnet|nntp)              #     protocol
+                     ://                                     #     ://
+                     (?:                                     #     Optional 'username:password@'
+                         \w+                                 #         username
+                         (?::\w+)?                           #         optional :password
+                         @                                   #         @
+                     )?                                      # 
+                     [-\w]+(?:\.\w[-\w]*)+                   #     hostname (sub.example.com)
+                 )                                           #
+                 (?::\d+)?                                   # Optional port number
+                 (?:                                         # Rest of the URL, optional
+                     /?                                      #     Start with '/'
+                     [^.!,?;:"'<>()\[\]{}\s\x7F-\xFF]*       #     Can't start with these
+                     (?:                                     #
+                         [.!,?;:]+                           #     One or more of these
+                         [^.!,?;:"'<>()\[\]{}\s\x7F-\xFF]+   #     Can't finish with these
+                         #'"                                 #     # or ' or "
+                     )*                                      #
+                 )?)                                         #
+              '''
+
+_glyph_email = r'''(?:mailto:)?            # Optional mailto:
+                   ([-\+\w]+               # username
+                   \@                      # at
+                   [-\w]+(?:\.\w[-\w]*)+)  # hostname
+                '''
+
+# The protocols _glyph_url knows, as they come right before '://'.
+_link_protocols = ('telnet', 'https', 'http', 'nntp', 'ftp')
+
+def _linkify_urls(text):
+    """Turn the URLs in the text into links, for glyphs().
+
+    Same as substituting _glyph_url over the text, but a URL can
+    only start with a protocol right before a '://', so instead of
+    trying the pattern at every offset, this finds the '://'s,
+    checks which protocol ends there and only matches from its
+    start. Like re.sub(), the search goes on from the end of each
+    match.
+    """
+    p = _compile(_glyph_url, re.VERBOSE)
+    pieces = []
+    last = 0
+    k = text.find('://')
+    while k != -1:
+        for proto in _link_protocols:
+            start = k - len(proto)
+            if start >= 0 and text.startswith(proto, start):
+                if start >= last:
+                    m = p.match(text, start)
+                    if m:
+                        pieces.append(text[last:start])
+                        pieces.append('<a href="%s">%s</a>' % (m.group(1), m.group(1)))
+                        last = m.end()
+                break
+        k = text.find('://', max(k + 1, last))
+
+    if not pieces:
+        return text
+    pieces.append(text[last:])
+    return ''.join(pieces)
+
+
+def _linkify_emails(text):
+    """Turn the emails in the text into links, for glyphs().
+
+    Same as substituting _glyph_email over the text. Each email
+    has exactly one '@', so for every '@' this walks back over
+    the user name (and an optional 'mailto:') to where re.sub()
+    would have started, and only matches from there.
+    """
+    p = _compile(_glyph_email, re.VERBOSE)
+    is_user = _compile(r'''[-\+\w]''').match
+    pieces = []
+    last = 0
+    stop = 0
+    at = text.find('@')
+    while at != -1:
+        # The user name can't go back past the previous '@' either.
+        start = at
+        while start > stop and is_user(text, start - 1):
+            start -= 1
+        if start < at:
+            if start - 7 >= last and text.startswith('mailto:', start - 7):
+                start -= 7
+            m = p.match(text, start)
+            if m:
+                pieces.append(text[last:start])
+                pieces.append('<a href="mailto:%s">%s</a>' % (m.group(1), m.group(1)))
+                last = m.end()
+        stop = max(at + 1, last)
+        at = text.find('@', stop)
+
+    if not pieces:
+        return text
+    pieces.append(text[last:])
+    return ''.join(pieces)
+
+
 def preg_replace(pattern, replacement, text):
     """Alternative re.sub that handles empty groups.
 
@@ -470,7 +1124,7 @@ def preg_replace(pattern, replacement, text):
 
         return rc
         
-    p = re.compile(pattern)
+    p = _compile(pattern)
     _debug(pattern)
 
     return p.sub(replacement_func, text)
@@ -482,14 +1136,14 @@ def html_replace(pattern, replacement, text):
     Does a preg_replace only outside HTML tags.
     """
     # If there is no html, do a simple search and replace.
-    if not re.search(r'''<.*>''', text):
+    if not _compile(r'''<.*>''').search(text):
         return preg_replace(pattern, replacement, text)
 
     else:
         lines = []
         # Else split the text into an array at <>.
-        for line in re.split('(<.*?>)', text):
-            if not re.match('<.*?>', line):
+        for line in _compile('(<.*?>)').split(text):
+            if not _compile('<.*?>').match(line):
                 line = preg_replace(pattern, replacement, line)
 
             lines.append(line)
@@ -499,137 +1153,689 @@ def html_replace(pattern, replacement, text):
 
 # PyTextile can optionally sanitize the generated XHTML,
 # which is good for weblog comments. This code is from
-# Mark Pilgrim's feedparser.
-class _BaseHTMLProcessor(sgmllib.SGMLParser):
-    elements_no_end_tag = ['area', 'base', 'basefont', 'br', 'col', 'frame', 'hr',
-      'img', 'input', 'isindex', 'link', 'meta', 'param']
+# Mark Pilgrim's feedparser. The classes are only built
+# (and sgmllib, or html.parser on Python 3, imported) the
+# first time we sanitize.
+_HTMLSanitizer = None
+
+def _load_sanitizer():
+    """Build the sanitizer classes on first use.
+
+    Returns the _HTMLSanitizer class.
+    """
+    global _HTMLSanitizer
+    if _HTMLSanitizer is not None:
+        return _HTMLSanitizer
+
+    try:
+        import sgmllib
+        SGMLParser = sgmllib.SGMLParser
+        charref = sgmllib.charref
+    except ImportError:
+        # Python 3 has no sgmllib. html.parser calls handlers with
+        # other names, skips quoted < and > inside a tag, and
+        # unescapes every reference in attribute values, so tags are
+        # parsed here the way sgmllib does it: a tag ends at the next
+        # < or >, a value-less attribute gets its name and only
+        # references to ASCII characters and the XML entities are
+        # replaced.
+        import html.parser
+
+        endbracket = _compile(r'''[<>]''')
+        tagfind = _compile(r'''[a-zA-Z][-_.a-zA-Z0-9]*''')
+        attrfind = _compile(r'''\s*([a-zA-Z_][-:.a-zA-Z_0-9]*)(\s*=\s*(\'[^\']*\'|"[^"]*"|[][\-a-zA-Z0-9./,:;+*%?!&$\(\)_#=~\'"@]*))?''')
+        entity_or_charref = _compile(r'''&(?:([a-zA-Z][-.a-zA-Z0-9]*)|#([0-9]+))(;?)''')
+        entitydefs = {'amp': '&', 'lt': '<', 'gt': '>', 'apos': "'", 'quot': '"'}
+
+        def convert_ref(m):
+            if m.group(2):
+                if int(m.group(2)) <= 127:
+                    return chr(int(m.group(2)))
+                return '&#%s%s' % m.groups()[1:]
+            elif m.group(3):
+                return entitydefs.get(m.group(1), '&%s;' % m.group(1))
+            return '&%s' % m.group(1)
+
+        class SGMLParser(html.parser.HTMLParser):
+            def __init__(self):
+                html.parser.HTMLParser.__init__(self, convert_charrefs=False)
+
+            def parse_starttag(self, i):
+                rawdata = self.rawdata
+                match = endbracket.search(rawdata, i + 1)
+                if not match:
+                    return -1
+                j = match.start()
+                k = tagfind.match(rawdata, i + 1).end()
+                tag = rawdata[i+1:k].lower()
+                self.lasttag = tag
+                attrs = []
+                # like sgmllib, a quoted value can run past the end
+                # of the tag
+                while k < j:
+                    m = attrfind.match(rawdata, k)
+                    if not m:
+                        break
+                    name, rest, value = m.group(1, 2, 3)
+                    if not rest:
+                        value = name
+                    else:
+                        if value[:1] == "'" == value[-1:] or value[:1] == '"' == value[-1:]:
+                            value = value[1:-1]
+                        value = entity_or_charref.sub(convert_ref, value)
+                    attrs.append((name.lower(), value))
+                    k = m.end()
+                if rawdata[j] == '>':
+                    j += 1
+                self.unknown_starttag(tag, attrs)
+                return j
+
+            def parse_endtag(self, i):
+                rawdata = self.rawdata
+                match = endbracket.search(rawdata, i + 1)
+                if not match:
+                    return -1
+                j = match.start()
+                tag = rawdata[i+2:j].strip(_whitespace).lower()
+                if rawdata[j] == '>':
+                    j += 1
+                self.unknown_endtag(tag)
+                return j
+
+        charref = re.compile('&#([0-9]+)[^0-9]')
+
+    class _BaseHTMLProcessor(SGMLParser):
+        elements_no_end_tag = ['area', 'base', 'basefont', 'br', 'col', 'frame', 'hr',
+          'img', 'input', 'isindex', 'link', 'meta', 'param']
+        
+        def __init__(self):
+            SGMLParser.__init__(self)
+        
+        def reset(self):
+            self.pieces = []
+            SGMLParser.reset(self)
     
-    def __init__(self):
-        sgmllib.SGMLParser.__init__(self)
+        def normalize_attrs(self, attrs):
+            # utility method to be called by descendants
+            attrs = [(k.lower(), charref.sub(lambda m: unichr(int(m.groups()[0])), v).strip()) for k, v in attrs]
+            attrs = [(k, k in ('rel', 'type') and v.lower() or v) for k, v in attrs]
+            return attrs
+        
+        def unknown_starttag(self, tag, attrs):
+            # called for each start tag
+            # attrs is a list of (attr, value) tuples
+            # e.g. for <pre class="screen">, tag="pre", attrs=[("class", "screen")]
+            strattrs = "".join([' %s="%s"' % (key, value) for key, value in attrs])
+            if tag in self.elements_no_end_tag:
+                self.pieces.append("<%(tag)s%(strattrs)s />" % locals())
+            else:
+                self.pieces.append("<%(tag)s%(strattrs)s>" % locals())
+            
+        def unknown_endtag(self, tag):
+            # called for each end tag, e.g. for </pre>, tag will be "pre"
+            # Reconstruct the original end tag.
+            if tag not in self.elements_no_end_tag:
+                self.pieces.append("</%(tag)s>" % locals())
     
-    def reset(self):
-        self.pieces = []
-        sgmllib.SGMLParser.reset(self)
-
-    def normalize_attrs(self, attrs):
-        # utility method to be called by descendants
-        attrs = [(k.lower(), sgmllib.charref.sub(lambda m: unichr(int(m.groups()[0])), v).strip()) for k, v in attrs]
-        attrs = [(k, k in ('rel', 'type') and v.lower() or v) for k, v in attrs]
-        return attrs
+        def handle_charref(self, ref):
+            # called for each character reference, e.g. for "&#160;", ref will be "160"
+            # Reconstruct the original character reference.
+            self.pieces.append("&#%(ref)s;" % locals())
     
-    def unknown_starttag(self, tag, attrs):
-        # called for each start tag
-        # attrs is a list of (attr, value) tuples
-        # e.g. for <pre class="screen">, tag="pre", attrs=[("class", "screen")]
-        strattrs = "".join([' %s="%s"' % (key, value) for key, value in attrs])
-        if tag in self.elements_no_end_tag:
-            self.pieces.append("<%(tag)s%(strattrs)s />" % locals())
-        else:
-            self.pieces.append("<%(tag)s%(strattrs)s>" % locals())
+        def handle_entityref(self, ref):
+            # called for each entity reference, e.g. for "&copy;", ref will be "copy"
+            # Reconstruct the original entity reference.
+            self.pieces.append("&%(ref)s;" % locals())
+    
+        def handle_data(self, text):
+            # called for each block of plain text, i.e. outside of any tag and
+            # not containing any character or entity references
+            # Store the original text verbatim.
+            self.pieces.append(text)
+    
+        def handle_comment(self, text):
+            # called for each HTML comment, e.g. <!-- insert Javascript code here -->
+            # Reconstruct the original comment.
+            self.pieces.append("<!--%(text)s-->" % locals())
+    
+        def handle_pi(self, text):
+            # called for each processing instruction, e.g. <?instruction>
+            # Reconstruct original processing instruction.
+            self.pieces.append("<?%(text)s>" % locals())
+    
+        def handle_decl(self, text):
+            # called for the DOCTYPE, if present, e.g.
+            # <!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN"
+            #     "http://www.w3.org/TR/html4/loose.dtd">
+            # Reconstruct original DOCTYPE
+            self.pieces.append("<!%(text)s>" % locals())
+    
+        def output(self):
+            """Return processed HTML as a single string"""
+            return "".join(self.pieces)
+    
+    
+    class _HTMLSanitizer(_BaseHTMLProcessor):
+        acceptable_elements = ['a', 'abbr', 'acronym', 'address', 'area', 'b', 'big',
+          'blockquote', 'br', 'button', 'caption', 'center', 'cite', 'code', 'col',
+          'colgroup', 'dd', 'del', 'dfn', 'dir', 'div', 'dl', 'dt', 'em', 'fieldset',
+          'font', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'input',
+          'ins', 'kbd', 'label', 'legend', 'li', 'map', 'menu', 'ol', 'optgroup',
+          'option', 'p', 'pre', 'q', 's', 'samp', 'select', 'small', 'span', 'strike',
+          'strong', 'sub', 'sup', 'table', 'tbody', 'td', 'textarea', 'tfoot', 'th',
+          'thead', 'tr', 'tt', 'u', 'ul', 'var']
+    
+        acceptable_attributes = ['abbr', 'accept', 'accept-charset', 'accesskey',
+          'action', 'align', 'alt', 'axis', 'border', 'cellpadding', 'cellspacing',
+          'char', 'charoff', 'charset', 'checked', 'cite', 'class', 'clear', 'cols',
+          'colspan', 'color', 'compact', 'coords', 'datetime', 'dir', 'disabled',
+          'enctype', 'for', 'frame', 'headers', 'height', 'href', 'hreflang', 'hspace',
+          'id', 'ismap', 'label', 'lang', 'longdesc', 'maxlength', 'media', 'method',
+          'multiple', 'name', 'nohref', 'noshade', 'nowrap', 'prompt', 'readonly',
+          'rel', 'rev', 'rows', 'rowspan', 'rules', 'scope', 'selected', 'shape', 'size',
+          'span', 'src', 'start', 'summary', 'tabindex', 'target', 'title', 'type',
+          'usemap', 'valign', 'value', 'vspace', 'width']
+        
+        unacceptable_elements_with_end_tag = ['script', 'applet'] 
         
-    def unknown_endtag(self, tag):
-        # called for each end tag, e.g. for </pre>, tag will be "pre"
-        # Reconstruct the original end tag.
-        if tag not in self.elements_no_end_tag:
-            self.pieces.append("</%(tag)s>" % locals())
-
-    def handle_charref(self, ref):
-        # called for each character reference, e.g. for "&#160;", ref will be "160"
-        # Reconstruct the original character reference.
-        self.pieces.append("&#%(ref)s;" % locals())
-
-    def handle_entityref(self, ref):
-        # called for each entity reference, e.g. for "&copy;", ref will be "copy"
-        # Reconstruct the original entity reference.
-        self.pieces.append("&%(ref)s;" % locals())
-
-    def handle_data(self, text):
-        # called for each block of plain text, i.e. outside of any tag and
-        # not containing any character or entity references
-        # Store the original text verbatim.
-        self.pieces.append(text)
-
-    def handle_comment(self, text):
-        # called for each HTML comment, e.g. <!-- insert Javascript code here -->
-        # Reconstruct the original comment.
-        self.pieces.append("<!--%(text)s-->" % locals())
-
-    def handle_pi(self, text):
-        # called for each processing instruction, e.g. <?instruction>
-        # Reconstruct original processing instruction.
-        self.pieces.append("<?%(text)s>" % locals())
-
-    def handle_decl(self, text):
-        # called for the DOCTYPE, if present, e.g.
-        # <!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN"
-        #     "http://www.w3.org/TR/html4/loose.dtd">
-        # Reconstruct original DOCTYPE
-        self.pieces.append("<!%(text)s>" % locals())
-
-    def output(self):
-        """Return processed HTML as a single string"""
-        return "".join(self.pieces)
-
-
-class _HTMLSanitizer(_BaseHTMLProcessor):
-    acceptable_elements = ['a', 'abbr', 'acronym', 'address', 'area', 'b', 'big',
-      'blockquote', 'br', 'button', 'caption', 'center', 'cite', 'code', 'col',
-      'colgroup', 'dd', 'del', 'dfn', 'dir', 'div', 'dl', 'dt', 'em', 'fieldset',
-      'font', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'input',
-      'ins', 'kbd', 'label', 'legend', 'li', 'map', 'menu', 'ol', 'optgroup',
-      'option', 'p', 'pre', 'q', 's', 'samp', 'select', 'small', 'span', 'strike',
-      'strong', 'sub', 'sup', 'table', 'tbody', 'td', 'textarea', 'tfoot', 'th',
-      'thead', 'tr', 'tt', 'u', 'ul', 'var']
-
-    acceptable_attributes = ['abbr', 'accept', 'accept-charset', 'accesskey',
-      'action', 'align', 'alt', 'axis', 'border', 'cellpadding', 'cellspacing',
-      'char', 'charoff', 'charset', 'checked', 'cite', 'class', 'clear', 'cols',
-      'colspan', 'color', 'compact', 'coords', 'datetime', 'dir', 'disabled',
-      'enctype', 'for', 'frame', 'headers', 'height', 'href', 'hreflang', 'hspace',
-      'id', 'ismap', 'label', 'lang', 'longdesc', 'maxlength', 'media', 'method',
-      'multiple', 'name', 'nohref', 'noshade', 'nowrap', 'prompt', 'readonly',
-      'rel', 'rev', 'rows', 'rowspan', 'rules', 'scope', 'selected', 'shape', 'size',
-      'span', 'src', 'start', 'summary', 'tabindex', 'target', 'title', 'type',
-      'usemap', 'valign', 'value', 'vspace', 'width']
+        # This if for MathML.
+        mathml_elements = ['math', 'mi', 'mn', 'mo', 'mrow', 'msup']
+        mathml_attributes = ['mode', 'xmlns']
+    
+        acceptable_elements = acceptable_elements + mathml_elements
+        acceptable_attributes = acceptable_attributes + mathml_attributes
+                      
+        def reset(self):
+            _BaseHTMLProcessor.reset(self)
+            self.unacceptablestack = 0
+            
+        def unknown_starttag(self, tag, attrs):
+            if not tag in self.acceptable_elements:
+                if tag in self.unacceptable_elements_with_end_tag:
+                    self.unacceptablestack += 1
+                return
+            attrs = self.normalize_attrs(attrs)
+            attrs = [(key, value) for key, value in attrs if key in self.acceptable_attributes]
+            _BaseHTMLProcessor.unknown_starttag(self, tag, attrs)
     
-    unacceptable_elements_with_end_tag = ['script', 'applet'] 
+        def unknown_endtag(self, tag):
+            if not tag in self.acceptable_elements:
+                if tag in self.unacceptable_elements_with_end_tag:
+                    self.unacceptablestack -= 1
+                return
+            _BaseHTMLProcessor.unknown_endtag(self, tag)
     
-    # This if for MathML.
-    mathml_elements = ['math', 'mi', 'mn', 'mo', 'mrow', 'msup']
-    mathml_attributes = ['mode', 'xmlns']
+        def handle_pi(self, text):
+            pass
+    
+        def handle_decl(self, text):
+            pass
+    
+        def handle_data(self, text):
+            if not self.unacceptablestack:
+                _BaseHTMLProcessor.handle_data(self, text)
+
+    return _HTMLSanitizer
+
+
+# PyTextile also has a built-in XHTML checker. It doesn't
+# need any external library and it doesn't rewrite the
+# document: it makes a single pass over the tags, keeping
+# a stack of the open elements, and reports what's wrong.
+_void_elements = ['area', 'base', 'basefont', 'br', 'col', 'frame', 'hr',
+                  'img', 'input', 'isindex', 'link', 'meta', 'param']
+
+_block_elements = ['address', 'blockquote', 'center', 'dir', 'div', 'dl',
+                   'fieldset', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+                   'hr', 'menu', 'noscript', 'ol', 'p', 'pre', 'table', 'ul']
+
+_inline_elements = ['a', 'abbr', 'acronym', 'b', 'big', 'cite', 'code', 'del',
+                    'dfn', 'em', 'font', 'i', 'ins', 'kbd', 'label', 'q', 's',
+                    'samp', 'small', 'span', 'strike', 'strong', 'sub', 'sup',
+                    'tt', 'u', 'var']
+
+# Elements that can only hold inline content.
+_inline_only = _inline_elements + ['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+                                   'pre', 'dt', 'caption', 'address']
+
+# Elements that must be inside one of the given parents.
+_required_parents = {'li': ['ul', 'ol', 'menu', 'dir'],
+                     'dt': ['dl'],
+                     'dd': ['dl'],
+                     'tr': ['table', 'thead', 'tbody', 'tfoot'],
+                     'td': ['tr'],
+                     'th': ['tr'],
+                     'thead': ['table'],
+                     'tbody': ['table'],
+                     'tfoot': ['table'],
+                     'caption': ['table'],
+                     'col': ['table', 'colgroup'],
+                     'colgroup': ['table'],
+                    }
+
+_markup = r'''<!--.*?-->                      # Comment
+            | <![^>]*>                        # Declaration
+            | <\?.*?\?>                       # Processing instruction
+            | </(?P<end>[^\s>]*)\s*>          # End tag
+            | <(?P<start>[a-zA-Z][\w:-]*)     # Start tag
+              (?P<attrs>(?:[^>"']|"[^"]*"|'[^']*')*)
+              >                               #
+            | (?P<lt><)                       # Stray <
+            | (?P<amp>&(?!\#[0-9]+;|\#[xX][0-9a-fA-F]+;|\w+;))  # Stray &
+          '''
+
+_attribute = r'''\s*
+                 (?P<name>[^\s=/"']+)        # Name
+                 (?:\s*=\s*                  #
+                     (?P<value>"[^"]*"       # "value"
+                     |'[^']*'                # 'value'
+                     |[^\s"']+)              # value
+                 )?                          #
+              '''
+
+
+def check_xhtml(text):
+    """Check that a document is well-formed XHTML.
+
+    This makes a single pass over the tags in the text and returns
+    a list of (line, column, message) tuples, one for each problem
+    found. Lines and columns start at 1. It checks that tags are
+    balanced and properly nested, that single tags are closed
+    with '/>', that elements are allowed where they are, and that
+    attribute values are quoted.
+    """
+    problems = []
+    stack = []
+
+    def error(pos, message):
+        problems.append((pos, message))
+
+    attribute = _compile(_attribute, re.VERBOSE)
+    for m in _compile(_markup, re.VERBOSE | re.DOTALL).finditer(text):
+        tag = m.group('start')
+        if tag is not None:
+            pos = m.start()
+            attrs = m.group('attrs')
+            single = attrs.rstrip(_whitespace).endswith('/')
+            if single:
+                attrs = attrs.rstrip(_whitespace)[:-1]
+
+            if tag != tag.lower():
+                error(pos, '<%s> should be lowercase' % tag)
+            tag = tag.lower()
+
+            # Check the attributes.
+            for a in attribute.finditer(attrs):
+                if a.group('value') is None:
+                    error(pos, 'attribute "%s" of <%s> has no value' % (a.group('name'), tag))
+                elif a.group('value')[0] not in '"\'':
+                    error(pos, 'value of attribute "%s" of <%s> is not quoted' % (a.group('name'), tag))
+
+            # Check the nesting.
+            if stack:
+                parent = stack[-1][0]
+                if tag in _block_elements and parent in _inline_only:
+                    error(pos, '<%s> is not allowed inside <%s>' % (tag, parent))
+                elif tag == 'a' and 'a' in [t for t, p in stack]:
+                    error(pos, '<a> is not allowed inside another <a>')
+
+            if tag in _required_parents:
+                if not stack or stack[-1][0] not in _required_parents[tag]:
+                    error(pos, '<%s> must be inside <%s>' % (tag, '>, <'.join(_required_parents[tag])))
+
+            if tag in _void_elements:
+                if not single:
+                    error(pos, '<%s> must be closed with "/>"' % tag)
+            elif not single:
+                stack.append((tag, pos))
+            continue
+
+        tag = m.group('end')
+        if tag is not None:
+            pos = m.start()
+            tag = tag.lower()
+            if tag in _void_elements:
+                error(pos, '</%s> closes a tag that must be empty' % tag)
+            elif stack and stack[-1][0] == tag:
+                stack.pop()
+            elif tag in [t for t, p in stack]:
+                # Close everything that was left open in between.
+                while stack[-1][0] != tag:
+                    t, p = stack.pop()
+                    error(p, '<%s> is not closed before </%s>' % (t, tag))
+                stack.pop()
+            else:
+                error(pos, '</%s> has no matching <%s>' % (tag, tag))
+            continue
+
+        if m.group('lt') is not None:
+            error(m.start(), '"<" should be escaped as "&lt;"')
+        elif m.group('amp') is not None:
+            error(m.start(), '"&" should be escaped as "&amp;"')
+
+    for tag, pos in stack:
+        error(pos, '<%s> is never closed' % tag)
+
+    # Work out the line numbers, walking forward once.
+    problems.sort()
+    errors = []
+    last, line, linestart = 0, 1, 0
+    for pos, message in problems:
+        n = text.count('\n', last, pos)
+        if n:
+            line += n
+            linestart = text.rfind('\n', last, pos) + 1
+        last = pos
+        errors.append((line, pos - linestart + 1, message))
+
+    return errors
+
+
+# Smart searches and block signatures. These only depend on
+# the settings at the top of the module, so they're built the
+# first time a Textiler is created and then shared.
+_searches = None
+_signatures = None
+
+def _build_searches():
+    searches = {}
+    searches['imdb']   = 'http://www.imdb.com/Find?for=%s'
+    searches['google'] = 'http://www.google.com/search?q=%s'
+    searches['python'] = 'http://www.python.org/doc/current/lib/module-%s.html'
+    if amazon_associate_id:
+        searches['isbn']   = ''.join(['http://', AMAZON, '/exec/obidos/ASIN/%s/', amazon_associate_id])
+        searches['amazon'] = ''.join(['http://', AMAZON, '/exec/obidos/external-search?mode=blended&keyword=%s&tag=', amazon_associate_id])
+    else:
+        searches['isbn']   = ''.join(['http://', AMAZON, '/exec/obidos/ASIN/%s'])
+        searches['amazon'] = ''.join(['http://', AMAZON, '/exec/obidos/external-search?mode=blended&keyword=%s'])
 
-    acceptable_elements = acceptable_elements + mathml_elements
-    acceptable_attributes = acceptable_attributes + mathml_attributes
-                  
-    def reset(self):
-        _BaseHTMLProcessor.reset(self)
-        self.unacceptablestack = 0
+    return searches
+
+
+def _build_signatures():
+    """Build the block signatures.
+
+    Returns a list of (regular expression, method name) tuples,
+    in the order they should be tried.
+    """
+    return [
+        # Paragraph.
+        (r'''^p                       # Paragraph signature
+             %(battr)s                # Paragraph attributes
+             (?P<dot>\.)              # .
+             (?P<extend>\.)?          # Extended paragraph denoted by a second dot
+             \s                       # whitespace
+             (?P<text>.*)             # text
+          ''' % res, 'paragraph'),
+
+        # Pre-formatted text.
+        (r'''^pre                     # Pre signature
+             %(battr)s                # Pre attributes
+             (?P<dot>\.)              # .
+             (?P<extend>\.)?          # Extended pre denoted by a second dot
+             \s                       # whitespace
+             (?P<text>.*)             # text
+          ''' % res, 'pre'),
+
+        # Block code.
+        (r'''^bc                      # Blockcode signature
+             %(battr)s                # Blockcode attributes
+             (?P<dot>\.)              # .
+             (?P<extend>\.)?          # Extended blockcode denoted by a second dot
+             \s                       # whitespace
+             (?P<text>.*)             # text
+          ''' % res, 'bc'),
+
+        # Blockquote.
+        (r'''^bq                      # Blockquote signature
+             %(battr)s                # Blockquote attributes
+             (?P<dot>\.)              # .
+             (?P<extend>\.)?          # Extended blockquote denoted by a second dot
+             (:(?P<cite>              # Optional cite attribute
+             (                        #
+                 %(url)s              #     URL
+             |   "[\w]+(?:\s[\w]+)*"  #     "Name inside quotes"
+             ))                       #
+             )?                       #
+             \s                       # whitespace
+             (?P<text>.*)             # text
+          ''' % res, 'blockquote'),
+
+        # Header.
+        (r'''^h                       # Header signature
+             (?P<header>\d)           # Header number
+             %(battr)s                # Header attributes
+             (?P<dot>\.)              # .
+             (?P<extend>\.)?          # Extended header denoted by a second dot
+             \s                       # whitespace
+             (?P<text>.*)             # text
+          ''' % res, 'header'),
+
+        # Footnote.
+        (r'''^fn                      # Footnote signature
+             (?P<footnote>[\d]+)      # Footnote number
+             (?P<dot>\.)              # .
+             (?P<extend>\.)?          # Extended footnote denoted by a second dot
+             \s                       # whitespace
+             (?P<text>.*)             # text
+          ''', 'footnote'),
+
+        # Definition list.
+        (r'''^dl                      # Definition list signature
+             %(battr)s                # Definition list attributes
+             (?P<dot>\.)              # .
+             (?P<extend>\.)?          # Extended definition list denoted by a second dot
+             \s                       # whitespace
+             (?P<text>.*)             # text
+          ''' % res, 'dl'),
         
-    def unknown_starttag(self, tag, attrs):
-        if not tag in self.acceptable_elements:
-            if tag in self.unacceptable_elements_with_end_tag:
-                self.unacceptablestack += 1
-            return
-        attrs = self.normalize_attrs(attrs)
-        attrs = [(key, value) for key, value in attrs if key in self.acceptable_attributes]
-        _BaseHTMLProcessor.unknown_starttag(self, tag, attrs)
-
-    def unknown_endtag(self, tag):
-        if not tag in self.acceptable_elements:
-            if tag in self.unacceptable_elements_with_end_tag:
-                self.unacceptablestack -= 1
-            return
-        _BaseHTMLProcessor.unknown_endtag(self, tag)
+        # Ordered list (attributes to first <li>).
+        (r'''^%(olattr)s              # Ordered list attributes
+             \#                       # Ordered list signature
+             %(liattr)s               # List item attributes
+             (?P<dot>\.)?             # .
+             \s                       # whitespace
+             (?P<text>.*)             # text
+          ''' % res, 'ol'),
+
+        # Unordered list (attributes to first <li>).
+        (r'''^%(olattr)s              # Unrdered list attributes
+             \*                       # Unordered list signature
+             %(liattr)s               # Unordered list attributes
+             (?P<dot>\.)?             # .
+             \s                       # whitespace
+             (?P<text>.*)             # text
+          ''' % res, 'ul'),
+
+        # Escaped text.
+        (r'''^==?(?P<text>.*?)(==)?$  # Escaped text
+          ''', 'escape'),
+
+        (r'''^(?P<text><.*)$          # XHTML tag
+          ''', 'escape'),
+
+        # itex code.
+        (r'''^(?P<text>               # itex code
+             \\\[                     # starts with \[
+             .*?                      # complicated mathematical equations go here
+             \\\])                    # ends with \]
+          ''', 'itex'),
+
+        # Tables.
+        (r'''^table                   # Table signature
+             %(tattr)s                # Table attributes
+             (?P<dot>\.)              # .
+             (?P<extend>\.)?          # Extended blockcode denoted by a second dot
+             \s                       # whitespace
+             (?P<text>.*)             # text
+          ''' % res, 'table'),
+        
+        # Simple tables.
+        (r'''^(?P<text>
+             \|
+             .*)
+          ''', 'table'),
+
+        # About.
+        (r'''^(?P<text>tell\sme\sabout\stextile\.)$''', 'about'),
+    ]
+
 
-    def handle_pi(self, text):
-        pass
+def _literal_charref(m):
+    """Turn a numeric character reference into the character.
 
-    def handle_decl(self, text):
-        pass
+    Keeps the ones HTML needs escaped, control characters and
+    anything that isn't a valid character.
+    """
+    if m.group(1):
+        n = int(m.group(1))
+    else:
+        n = int(m.group(2), 16)
+    if n in (34, 38, 39, 60, 62) or n < 32 or 127 <= n < 160 or 0xd800 <= n < 0xe000:
+        return m.group(0)
+    try:
+        return unichr(n)
+    except ValueError:
+        return m.group(0)
 
-    def handle_data(self, text):
-        if not self.unacceptablestack:
-            _BaseHTMLProcessor.handle_data(self, text)
+
+def _finishers(validate=VALIDATE, sanitize=SANITIZE, output=OUTPUT, encoding=ENCODING, literal=LITERAL):
+    """Build the steps that run after the blocks are rendered.
+
+    Returns a list of functions that take a Textiler and the text
+    and return the new text. All the decisions about the options
+    are made here, once, so there's nothing left to check when
+    the steps run.
+    """
+    finishers = []
+
+    # Convert to desired output.
+    def convert(textiler, text):
+        return _encode(_decode(text, encoding), output, 'xmlcharrefreplace')
+    if literal:
+        p = _compile(r'''&#(?:(\d+)|[xX]([0-9a-fA-F]+));''')
+        def convert(textiler, text):
+            text = _decode(text, encoding)
+            if '&#' in text:
+                text = p.sub(_literal_charref, text)
+            return _encode(text, output, 'xmlcharrefreplace')
+    finishers.append(convert)
+
+    # Sanitize?
+    if sanitize:
+        sanitizer = _load_sanitizer()
+        def clean(textiler, text):
+            p = sanitizer()
+            p.feed(text)
+            return p.output()
+        finishers.append(clean)
+
+    # Validate output.
+    if validate == 'tidy':
+        if _load_tidy():
+            finishers.append(lambda textiler, text: _tidy(text))
+    elif validate:
+        def check(textiler, text):
+            textiler.errors = check_xhtml(text)
+            for line, column, message in textiler.errors:
+                sys.stderr.write('textile: line %d, column %d: %s\n' % (line, column, message))
+            return text
+        finishers.append(check)
+
+    return finishers
+
+
+class Rendered(str):
+    """HTML from process() with TOC set, with the table of
+    contents in 'toc', as (level, id, title) tuples."""
+    toc = ()
+
+if not _PY3:
+    class RenderedUnicode(unicode):
+        """Rendered, for when the HTML comes out as unicode (the
+        sanitizer can return it)."""
+        toc = ()
+
+
+def _slug(title):
+    """Make an id out of a header title, without tags or entities."""
+    slug = _compile(r'''&#?\w+;''').sub('', title).lower()
+    slug = _compile(r'''[^a-z0-9]+''').sub('-', slug).strip('-')
+    if not slug[:1].isalpha():
+        slug = ('section-' + slug).rstrip('-')
+    return slug
+
+
+def _sub_offsets(p, repl, text, offsets):
+    """p.sub(repl, text), and where each character of the result
+    comes from: 'offsets' has one for each character of the text,
+    and one more for its end. A replacement comes from the start
+    of what it replaced."""
+    pieces = []
+    result = []
+    last = 0
+    for m in p.finditer(text):
+        pieces.append(text[last:m.start()])
+        result.extend(offsets[last:m.start()])
+        r = m.expand(repl)
+        pieces.append(r)
+        result.extend([offsets[m.start()]] * len(r))
+        last = m.end()
+    pieces.append(text[last:])
+    result.extend(offsets[last:])
+    return (''.join(pieces), result)
+
+
+class Block(object):
+    """A block found by split_text().
+
+    Blocks refer to the text they come from by offsets instead of
+    holding a copy of it. 'kind' is the name of the Textiler method
+    that renders the block, and its text is source[start:end], or,
+    for extended blocks, the pieces in 'spans' (a flat array of
+    start, end offsets) joined. 'params' has the other captures of
+    the block signature that aren't None, as a tuple of (name,
+    value) pairs, or is None.
+    """
+    __slots__ = ('kind', 'start', 'end', 'spans', 'params')
+
+    def __init__(self, kind, start, end, params=None):
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.spans = None
+        self.params = params
+
+    def text(self, source):
+        """Slice the text of the block out of the source."""
+        spans = self.spans
+        if spans is None:
+            return source[self.start:self.end]
+        return ''.join([source[spans[i]:spans[i+1]] for i in range(0, len(spans), 2)])
+
+    def captures(self, source):
+        """Build the keyword arguments for the rendering method."""
+        captures = {'text': self.text(source)}
+        if self.params:
+            captures.update(self.params)
+        return captures
+
+
+def _render_chunk(job):
+    """Render a chunk of blocks in a worker process.
+
+    'job' comes from Textiler.render_parallel(): the Textiler class,
+    the state the blocks need and (method name, captures) pairs.
+    Returns the HTML of each block.
+    """
+    klass, links, head_offset, inline_engine, qtags_triggers, blocks = job
+    textiler = klass()
+    textiler._links = links
+    textiler.head_offset = head_offset
+    textiler.inline_engine = inline_engine
+    textiler.qtags_triggers = qtags_triggers
+
+    return [getattr(textiler, kind)(**captures) for kind, captures in blocks]
 
 
 class Textiler:
@@ -643,145 +1849,83 @@ class Textiler:
         Here we pre-process the text and collect all the link
         lookups for later.
         """
+        self.reset()
         self.text = text
 
         # Basic regular expressions.
         self.res = res
 
         # Smart searches.
-        self.searches = {}
-        self.searches['imdb']   = 'http://www.imdb.com/Find?for=%s'
-        self.searches['google'] = 'http://www.google.com/search?q=%s'
-        self.searches['python'] = 'http://www.python.org/doc/current/lib/module-%s.html'
-        if amazon_associate_id:
-            self.searches['isbn']   = ''.join(['http://', AMAZON, '/exec/obidos/ASIN/%s/', amazon_associate_id])
-            self.searches['amazon'] = ''.join(['http://', AMAZON, '/exec/obidos/external-search?mode=blended&keyword=%s&tag=', amazon_associate_id])
-        else:
-            self.searches['isbn']   = ''.join(['http://', AMAZON, '/exec/obidos/ASIN/%s'])
-            self.searches['amazon'] = ''.join(['http://', AMAZON, '/exec/obidos/external-search?mode=blended&keyword=%s'])
-
-        # These are the blocks we know.
-        self.signatures = [
-                           # Paragraph.
-                           (r'''^p                       # Paragraph signature
-                                %(battr)s                # Paragraph attributes
-                                (?P<dot>\.)              # .
-                                (?P<extend>\.)?          # Extended paragraph denoted by a second dot
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''' % self.res, self.paragraph),
-   
-                           # Pre-formatted text.
-                           (r'''^pre                     # Pre signature
-                                %(battr)s                # Pre attributes
-                                (?P<dot>\.)              # .
-                                (?P<extend>\.)?          # Extended pre denoted by a second dot
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''' % self.res, self.pre),
-   
-                           # Block code.
-                           (r'''^bc                      # Blockcode signature
-                                %(battr)s                # Blockcode attributes
-                                (?P<dot>\.)              # .
-                                (?P<extend>\.)?          # Extended blockcode denoted by a second dot
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''' % self.res, self.bc),
-   
-                           # Blockquote.
-                           (r'''^bq                      # Blockquote signature
-                                %(battr)s                # Blockquote attributes
-                                (?P<dot>\.)              # .
-                                (?P<extend>\.)?          # Extended blockquote denoted by a second dot
-                                (:(?P<cite>              # Optional cite attribute
-                                (                        #
-                                    %(url)s              #     URL
-                                |   "[\w]+(?:\s[\w]+)*"  #     "Name inside quotes"
-                                ))                       #
-                                )?                       #
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''' % self.res, self.blockquote),
-   
-                           # Header.
-                           (r'''^h                       # Header signature
-                                (?P<header>\d)           # Header number
-                                %(battr)s                # Header attributes
-                                (?P<dot>\.)              # .
-                                (?P<extend>\.)?          # Extended header denoted by a second dot
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''' % self.res, self.header),
-   
-                           # Footnote.
-                           (r'''^fn                      # Footnote signature
-                                (?P<footnote>[\d]+)      # Footnote number
-                                (?P<dot>\.)              # .
-                                (?P<extend>\.)?          # Extended footnote denoted by a second dot
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''', self.footnote),
-   
-                           # Definition list.
-                           (r'''^dl                      # Definition list signature
-                                %(battr)s                # Definition list attributes
-                                (?P<dot>\.)              # .
-                                (?P<extend>\.)?          # Extended definition list denoted by a second dot
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''' % self.res, self.dl),
-                           
-                           # Ordered list (attributes to first <li>).
-                           (r'''^%(olattr)s              # Ordered list attributes
-                                \#                       # Ordered list signature
-                                %(liattr)s               # List item attributes
-                                (?P<dot>\.)?             # .
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''' % self.res, self.ol),
-   
-                           # Unordered list (attributes to first <li>).
-                           (r'''^%(olattr)s              # Unrdered list attributes
-                                \*                       # Unordered list signature
-                                %(liattr)s               # Unordered list attributes
-                                (?P<dot>\.)?             # .
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''' % self.res, self.ul),
-   
-                           # Escaped text.
-                           (r'''^==?(?P<text>.*?)(==)?$  # Escaped text
-                             ''', self.escape),
-   
-                           (r'''^(?P<text><.*)$          # XHTML tag
-                             ''', self.escape),
-   
-                           # itex code.
-                           (r'''^(?P<text>               # itex code
-                                \\\[                     # starts with \[
-                                .*?                      # complicated mathematical equations go here
-                                \\\])                    # ends with \]
-                             ''', self.itex),
-   
-                           # Tables.
-                           (r'''^table                   # Table signature
-                                %(tattr)s                # Table attributes
-                                (?P<dot>\.)              # .
-                                (?P<extend>\.)?          # Extended blockcode denoted by a second dot
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''' % self.res, self.table),
-                           
-                           # Simple tables.
-                           (r'''^(?P<text>
-                                \|
-                                .*)
-                             ''', self.table),
-   
-                           # About.
-                           (r'''^(?P<text>tell\sme\sabout\stextile\.)$''', self.about),
-                          ]
+        global _searches, _signatures
+        if _searches is None:
+            _searches = _build_searches()
+            _signatures = _build_signatures()
+        self.searches = _searches
+
+        # These are the blocks we know, as (regexp, method name).
+        self.signatures = _signatures
+
+
+    def reset(self):
+        """Forget the last document.
+
+        Clears what run() leaves behind (the text, link lookups,
+        blocks, errors) and puts the options back to their defaults,
+        so the instance can render another text.
+        """
+        self.text = ''
+        self._links = {}
+        self.blocks = []
+        self.errors = []
+
+        # Inline phases skipped by format(), by name.
+        self.skipped = {}
+
+        # Offset for the headers.
+        self.head_offset = HEAD_OFFSET
+
+        # The encoding of the text, for str on Python 3, see _internal().
+        self.encoding = ENCODING
+
+        # See INLINE_ENGINE.
+        self.inline_engine = INLINE_ENGINE
+
+        # Worker processes for the blocks, see render_parallel().
+        self.workers = 0
+
+        # The (count, start, end) of the blocks to render, see excerpt().
+        self.selection = None
+
+        # The (start, end) of the lookup lines grab_links() took out.
+        self.link_cuts = []
+
+        # See TOC. run() fills the table of contents in 'toc' and
+        # keeps the header ids already taken in 'ids'.
+        self.make_toc = TOC
+        self.toc = None
+        self.ids = {}
+
+        # What format() looks for before running qtags.
+        # textile_many() narrows it down for each document.
+        self.qtags_triggers = _qtags_triggers
+
+
+    def render(self, text, **args):
+        """Render another text with this instance.
+
+        Same as textile(text, **args), without building a new
+        Textiler each time:
+
+            textiler = Textiler()
+            for text in texts:
+                html = textiler.render(text, head_offset=1)
+
+        An instance renders one text at a time; threads should
+        use a TextilerPool.
+        """
+        self.reset()
+        self.text = text
+        return self.process(**args)
 
 
     def preprocess(self):
@@ -790,14 +1934,15 @@ class Textiler:
         Remove whitespace, fix carriage returns.
         """
         # Remove whitespace.
-        self.text = self.text.strip()
+        text = self.text.strip(_whitespace)
 
         # Zap carriage returns.
-        self.text = self.text.replace("\r\n", "\n")
-        self.text = self.text.replace("\r", "\n")
+        if '\r' in text:
+            text = text.replace("\r\n", "\n")
+            text = text.replace("\r", "\n")
 
         # Minor sanitizing.
-        self.text = self.sanitize(self.text)
+        self.text = self.sanitize(text)
 
 
     def grab_links(self):
@@ -808,61 +1953,279 @@ class Textiler:
         """
         # Grab links like this: '[id]example.com'
         links = {}
-        p = re.compile(r'''(?:^|\n)\[([\w]+?)\](%(url)s)(?:$|\n)''' % self.res, re.VERBOSE)
-        for key, link in p.findall(self.text):
-            links[key] = link
+        p = _compile_res(r'''(?:^|\n)\[([\w]+?)\](%(url)s)(?:$|\n)''', re.VERBOSE)
+
+        # A lookup can only start the text or follow a newline, so
+        # only try the pattern there, and clear the lookups from the
+        # text as we go. Like re.sub(), the search goes on from the
+        # end of each match.
+        text = self.text
+        pieces = []
+        self.link_cuts = []
+        last = 0
+        pos = 0
+        while pos != -1:
+            m = p.match(text, pos)
+            if m:
+                links[m.group(1)] = m.group(2)
+                self.link_cuts.append((pos, m.end()))
+                pieces.append(text[last:pos])
+                last = m.end()
+                pos = text.find('\n[', last)
+            else:
+                pos = text.find('\n[', pos + 1)
 
-        # And clear them from the text.
-        self.text = p.sub('', self.text)
+        if pieces:
+            pieces.append(text[last:])
+            self.text = ''.join(pieces)
 
         return links
 
 
-    def process(self, head_offset=HEAD_OFFSET, validate=VALIDATE, sanitize=SANITIZE, output=OUTPUT, encoding=ENCODING):
+    def process(self, head_offset=HEAD_OFFSET, validate=VALIDATE, sanitize=SANITIZE, output=OUTPUT, encoding=ENCODING, inline_engine=INLINE_ENGINE, workers=0, literal=LITERAL, toc=TOC):
         """Process the text.
 
         Here we actually process the text, splitting the text in
         blocks and applying the corresponding function to each
-        one of them.
+        one of them. With workers > 1, the blocks are rendered
+        on that many processes (see render_parallel()).
         """
+        # Offset for the headers.
+        self.head_offset = head_offset
+        self.encoding = encoding
+        self.inline_engine = inline_engine
+        self.workers = workers
+        self.make_toc = toc
+
+        return self.run(self.finishers(validate, sanitize, output, encoding, literal))
+
+
+    def finishers(self, validate, sanitize, output, encoding, literal):
+        """The steps to run after the blocks, see _finishers()."""
+        return _finishers(validate, sanitize, output, encoding, literal)
+
+
+    def run(self, finishers):
+        """Render the text and pass it through the finishers.
+
+        This is the part of process() that doesn't depend on the
+        options. The finishers come from _finishers(), so callers
+        that render a lot of text with the same options only have
+        to work them out once (see make_renderer()).
+        """
+        self.errors = []
+        self.skipped = {}
+        self.ids = {}
+        self.toc = None
+        if self.make_toc:
+            self.toc = []
+
+        self.text = _internal(self.text, self.encoding)
+        source = self.text
+
         # Basic global changes.
         self.preprocess()
 
         # Grab lookup links and clean them from the text.
         self._links = self.grab_links()
 
-        # Offset for the headers.
-        self.head_offset = head_offset
-
         # Process each block.
         self.blocks = self.split_text()
-
-        text = []
-        for [function, captures] in self.blocks:
-            text.append(function(**captures))
+        if self.selection is not None:
+            (count, start, end) = self.selection
+            if start is not None or end is not None:
+                (start, end) = self.text_range(source, start, end)
+            self.blocks = self.select_blocks(count, start, end)
+        if self.toc is not None:
+            self.reserve_ids()
+
+        # Colorize all the Python code at once.
+        self.color_blocks()
+
+        # The headers have to be seen in order for the table of
+        # contents, so it's always made here.
+        if self.workers > 1 and len(self.blocks) > 1 and self.toc is None:
+            text = self.render_parallel(self.workers)
+        else:
+            text = []
+            source = self.text
+            markers = []
+            for block in self.blocks:
+                if self.toc is not None and block.kind == 'paragraph' and block.text(source).strip(_whitespace) == '{toc}':
+                    markers.append(len(text))
+                text.append(getattr(self, block.kind)(**block.captures(source)))
+
+            # Put the table of contents where it was asked for, or
+            # drop the markers if there are no headers.
+            if markers:
+                toc = self.toc_html()
+                for i in reversed(markers):
+                    if toc:
+                        text[i] = toc
+                    else:
+                        del text[i]
 
         text = '\n\n'.join(text)
 
         # Add titles to footnotes.
         text = self.footnotes(text)
 
-        # Convert to desired output.
-        text = unicode(text, encoding)
-        text = text.encode(output, 'xmlcharrefreplace')
+        # Convert, sanitize, validate.
+        for finish in finishers:
+            text = finish(self, text)
 
-        # Sanitize?
-        if sanitize:
-            p = _HTMLSanitizer()
-            p.feed(text)
-            text = p.output()
-
-        # Validate output.
-        if _tidy and validate:
-            text = _tidy(text)
+        if self.toc is not None:
+            if not _PY3 and isinstance(text, unicode):
+                text = RenderedUnicode(text)
+            else:
+                text = Rendered(text)
+            text.toc = self.toc
+            if _PY3:
+                text.toc = [(level, id, _decode(title, self.encoding)) for level, id, title in self.toc]
 
         return text
 
 
+    def excerpt(self, count=None, start=None, end=None, **args):
+        """Render only some of the blocks.
+
+        Takes the same options as process(), but only renders the
+        first 'count' blocks, or those overlapping the text from
+        offset 'start' to 'end', or the first 'count' of those.
+        The offsets are in the text as it was given (in bytes, for
+        a str encoded with 'encoding'); text_range() turns them
+        into offsets in self.text, where the blocks are.
+
+        The whole text is still scanned for link lookups and block
+        boundaries, so links to lookups defined in other blocks
+        work, but only the blocks picked are rendered.
+        """
+        self.selection = (count, start, end)
+        try:
+            return self.process(**args)
+        finally:
+            self.selection = None
+
+
+    def text_range(self, source, start, end):
+        """Turn a range of offsets in 'source', the text before
+        preprocess() and grab_links(), into one in self.text.
+
+        Replays what preprocess() and sanitize() do to the text,
+        keeping track of where each character comes from, and takes
+        out the lookup lines grab_links() took out. A subclass that
+        changes those steps gets the range unchanged.
+        """
+        if start is None:
+            start = 0
+        if end is None:
+            end = len(source)
+        text = source.lstrip(_whitespace)
+        lead = len(source) - len(text)
+        text = text.rstrip(_whitespace)
+        # offsets[i] is where text[i] is in the source, plus one for the end
+        offsets = list(range(lead, lead + len(text) + 1))
+        text, offsets = _sub_offsets(_compile(r'''\r\n?'''), '\n', text, offsets)
+        text, offsets = _sub_offsets(_compile(r'''<(img|br|hr)(.*?)(?:\s*/?\s*)?>'''), r'''<\1\2 />''', text, offsets)
+        text, offsets = _sub_offsets(_compile(r'''&(?!#?[xX]?(?:[0-9a-fA-F]+|\w{1,8});)'''), r'''&amp;''', text, offsets)
+        if self.link_cuts:
+            pieces = []
+            kept = []
+            last = 0
+            for (cut_start, cut_end) in self.link_cuts:
+                pieces.append(text[last:cut_start])
+                kept.extend(offsets[last:cut_start])
+                last = cut_end
+            pieces.append(text[last:])
+            kept.extend(offsets[last:])
+            text = ''.join(pieces)
+            offsets = kept
+        if text != self.text:
+            return (start, end)
+        import bisect
+        return (bisect.bisect_left(offsets, start), bisect.bisect_left(offsets, end))
+
+
+    def select_blocks(self, count=None, start=None, end=None):
+        """Pick the blocks excerpt() asked for, 'start' and 'end'
+        being offsets in self.text."""
+        blocks = self.blocks
+        if start is not None or end is not None:
+            if start is None:
+                start = 0
+            if end is None:
+                end = len(self.text)
+            # an extended block goes on to the end of its last span
+            blocks = [block for block in blocks
+                      if block.start < end and (block.spans[-1] if block.spans else block.end) > start]
+        if count is not None:
+            blocks = blocks[:count]
+        return blocks
+
+
+    def render_parallel(self, workers):
+        """Render the blocks on a pool of worker processes.
+
+        Once split_text() is done the blocks only share the link
+        lookups, so they're cut into chunks of about the same size,
+        rendered by 'workers' processes and put back in order.
+        Returns the HTML of each block, as the serial loop in run()
+        would. Starting the pool takes a while, so this only pays
+        off for big documents (a megabyte or more).
+        """
+        import multiprocessing
+
+        source = self.text
+        state = (self.__class__, self._links, self.head_offset, self.inline_engine, self.qtags_triggers)
+        chunk_size = len(source) // (workers * 4) + 1
+
+        jobs = []
+        chunk = []
+        size = 0
+        for block in self.blocks:
+            captures = block.captures(source)
+            chunk.append((block.kind, captures))
+            size += len(captures['text'])
+            if size >= chunk_size:
+                jobs.append(state + (chunk,))
+                chunk = []
+                size = 0
+        if chunk:
+            jobs.append(state + (chunk,))
+
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_render_chunk, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        html = []
+        for result in results:
+            html.extend(result)
+        return html
+
+
+    def color_blocks(self):
+        """Colorize the Python code blocks.
+
+        This passes the text of every bc[python] block to color_many(),
+        so the colorizer only runs on code that isn't cached yet.
+        """
+        if not _load_htmlizer():
+            return
+
+        codes = []
+        for block in self.blocks:
+            if block.kind == 'bc':
+                attributes = self.parse_params(dict(block.params or ()).get('parameters', None))
+                if attributes.get('lang', None) == 'python':
+                    codes.append(block.text(self.text))
+
+        if codes:
+            color_many(codes)
+
+
     def sanitize(self, text):
         """Fix single tags.
 
@@ -880,11 +2243,14 @@ class Textiler:
         it also can optionally validade the generated code with these wrappers
         to ensure 100% valid XHTML(eXtensible HyperText Markup Language).
         """
-        # Fix single tags like <img /> and <br />.
-        text = preg_replace(r'''<(img|br|hr)(.*?)(?:\s*/?\s*)?>''', r'''<\1\2 />''', text)
+        # Fix single tags like <img /> and <br />. Both groups
+        # always match, so a plain re.sub() does.
+        if '<' in text:
+            text = _compile(r'''<(img|br|hr)(.*?)(?:\s*/?\s*)?>''').sub(r'''<\1\2 />''', text)
 
         # Remove ampersands.
-        text = preg_replace(r'''&(?!#?[xX]?(?:[0-9a-fA-F]+|\w{1,8});)''', r'''&amp;''', text)
+        if '&' in text:
+            text = _compile(r'''&(?!#?[xX]?(?:[0-9a-fA-F]+|\w{1,8});)''').sub(r'''&amp;''', text)
 
         return text
 
@@ -952,12 +2318,36 @@ class Textiler:
 
         extending  = 0
 
-        # We capture the \n's because they are important inside "pre..".
-        blocks = re.split(r'''((\n\s*){2,})''', self.text)
+        # While a block is being extended we only keep track of
+        # the pieces that belong to it, as start, end offsets
+        # into the text. Appending to the block text every time
+        # made long extended blocks quadratic.
+        from array import array
+        spans = array('l')
+
+        def add_span(start, end):
+            if spans and spans[-1] == start:
+                spans[-1] = end
+            else:
+                spans.extend((start, end))
+
+        def join_spans():
+            if len(spans) > 2:
+                output[-1].spans = spans[:]
+            del spans[:]
+
+        # We keep the \n's because they are important inside "pre..".
+        text = self.text
+        separators = list(_separators(text))
+        separators.append((len(text), len(text), len(text)))
+
         output = []
-        for block in blocks:
+        pos = 0
+        for start, end, last in separators:
+            block = text[pos:start]
+
             # Check for the clear signature.
-            m = re.match(clear_sig, block)
+            m = _compile(clear_sig).match(block)
             if m:
                 clear = m.group('alignment')
                 if clear:
@@ -965,34 +2355,43 @@ class Textiler:
                 else:
                     clear = 'clear:both;'
 
+            elif extending and block[:1] not in _extend_breakers:
+                # Only a signature with a dot can end an extended
+                # block, so there's no need to try them all.
+                add_span(pos, start)
+
             else:
                 # Check each of the code signatures.
-                for regexp, function in self.signatures:
-                    p = re.compile(regexp, (re.VERBOSE | re.DOTALL))
+                for regexp, kind in self.signatures:
+                    p = _compile(regexp, (re.VERBOSE | re.DOTALL))
                     m = p.match(block)
                     if m:
                         # Put everything in a dictionary.
                         captures = m.groupdict()
+                        del captures['text']
 
                         # If we are extending a block, we require a dot to
                         # break it, so we can start lines with '#' inside
                         # an extended <pre> without matching an ordered list.
                         if extending and not captures.get('dot', None):
-                            output[-1][1]['text'] += block
+                            add_span(pos, start)
                             break 
-                        elif captures.has_key('dot'):
+                        elif 'dot' in captures:
                             del captures['dot']
                             
                         # If a signature matches, we are not extending a block.
                         extending = 0
+                        join_spans()
 
                         # Check if we should extend this block.
-                        if captures.has_key('extend'):
+                        if 'extend' in captures:
                             extending = captures['extend']
                             del captures['extend']
-                            
+                            if extending:
+                                add_span(pos + m.start('text'), pos + m.end('text'))
+
                         # Apply head_offset.
-                        if captures.has_key('header'):
+                        if 'header' in captures:
                             captures['header'] = int(captures['header']) + self.head_offset
 
                         # Apply clear.
@@ -1000,18 +2399,32 @@ class Textiler:
                             captures['clear'] = clear
                             clear = None
 
-                        # Save the block to be processed later.
-                        output.append([function, captures])
+                        # Save the block to be processed later, without
+                        # the captures that are left to their defaults.
+                        for key in [k for k, v in captures.items() if v is None]:
+                            del captures[key]
+                        output.append(Block(kind, pos + m.start('text'), pos + m.end('text'), tuple(captures.items()) or None))
 
                         break
 
                 else:
                     if extending:
                         # Append the text to the last block.
-                        output[-1][1]['text'] += block
-                    elif block.strip():
-                        output.append([self.paragraph, {'text': block}])
+                        add_span(pos, start)
+                    elif block.strip(_whitespace):
+                        output.append(Block('paragraph', pos, start))
+
+            # The separator goes to the extended block too, along
+            # with its last line (which is what re.split() used
+            # to give us for the inner group).
+            if extending and start < len(text):
+                add_span(start, end)
+                add_span(last, end)
+
+            pos = end
     
+        join_spans()
+
         return output
 
 
@@ -1042,26 +2455,26 @@ class Textiler:
         """
         if not parameters:
             if clear:
-                return {'style': clear}
+                return _Attributes([('style', clear)])
             else:
-                return {}
+                return _Attributes()
 
-        output = {}
+        output = _Attributes()
         
         # Match class from (class) or (class#id).
-        m = re.search(r'''\((?P<class>[\w]+(\s[\w]+)*)(\#[\w][\w\d\.:_-]*)?\)''', parameters)
+        m = _compile(r'''\((?P<class>[\w]+(\s[\w]+)*)(\#[\w][\w\d\.:_-]*)?\)''').search(parameters)
         if m: output['class'] = m.group('class')
 
         # Match id from (#id) or (class#id).
-        m = re.search(r'''\([\w]*(\s[\w]+)*\#(?P<id>[\w][\w\d\.:_-]*)\)''', parameters)
+        m = _compile(r'''\([\w]*(\s[\w]+)*\#(?P<id>[\w][\w\d\.:_-]*)\)''').search(parameters)
         if m: output['id'] = m.group('id')
 
         # Match [language].
-        m = re.search(r'''\[(?P<lang>[\w-]+)\]''', parameters)
+        m = _compile(r'''\[(?P<lang>[\w-]+)\]''').search(parameters)
         if m: output['lang'] = m.group('lang')
 
         # Match {style}.
-        m = re.search(r'''{(?P<style>[^\}]+)}''', parameters)
+        m = _compile(r'''{(?P<style>[^\}]+)}''').search(parameters)
         if m:
             output['style'] = m.group('style').replace('\n', '')
 
@@ -1128,12 +2541,12 @@ class Textiler:
                     output['valign'] = _style
 
             # Colspan and rowspan.
-            m = re.search(r'''\\(\d+)''', parameters)
+            m = _compile(r'''\\(\d+)''').search(parameters)
             if m:
                 #output['colspan'] = m.groups()
                 output['colspan'] = int(m.groups()[0])
 
-            m = re.search(r'''/(\d+)''', parameters)
+            m = _compile(r'''/(\d+)''').search(parameters)
             if m:
                 output['rowspan'] = int(m.groups()[0])
 
@@ -1161,8 +2574,8 @@ class Textiler:
         output['style'] = output.get('style', '') + ''.join(style)
 
         # Remove excess whitespace.
-        if output.has_key('class'):
-            output['class'] = output['class'].strip()
+        if 'class' in output:
+            output['class'] = output['class'].strip(_whitespace)
 
         return output 
         
@@ -1176,7 +2589,10 @@ class Textiler:
         """
         # Open tag.
         open_tag = ['<%s' % tag]
-        for k,v in attributes.items():
+        items = attributes.items()
+        if _PY3 and not isinstance(attributes, _Attributes):
+            items = _Attributes(items).items()
+        for k,v in items:
             # The ALT attribute can be empty.
             if k == 'alt' or v: open_tag.append(' %s="%s"' % (k, v))
 
@@ -1217,7 +2633,7 @@ class Textiler:
         Text in a paragraph block is processed with all the inline rules.
         """
         # Split the lines.
-        lines = re.split('\n{2,}', text)
+        lines = _compile('\n{2,}').split(text)
         
         # Get the attributes.
         attributes = attributes or self.parse_params(parameters, clear)
@@ -1226,14 +2642,14 @@ class Textiler:
         for line in lines:
             if line:
                 # Clean the line.
-                line = line.strip()
+                line = line.strip(_whitespace)
                  
                 # Build the tag.
                 open_tag = self.build_open_tag('p', attributes)
                 close_tag = '</p>'
 
                 # Pop the id because it must be unique.
-                if attributes.has_key('id'): del attributes['id']
+                if 'id' in attributes: del attributes['id']
 
                 # Break lines. 
                 line = preg_replace(r'(<br />|\n)+', '<br />\n', line)
@@ -1280,7 +2696,7 @@ class Textiler:
         """
 
         # Remove trailing whitespace.
-        text = text.rstrip()
+        text = text.rstrip(_whitespace)
 
         # Get the attributes.
         attributes = self.parse_params(parameters, clear)
@@ -1337,7 +2753,7 @@ class Textiler:
         attributes = self.parse_params(parameters, clear)
 
         # XHTML <code> can't have the attribute lang.
-        if attributes.has_key('lang'):
+        if 'lang' in attributes:
             lang = attributes['lang']
             del attributes['lang']
         else:
@@ -1348,7 +2764,7 @@ class Textiler:
         close_tag = '\n</code>\n</pre>'
 
         # Colorize Python code?
-        if htmlizer and lang == 'python':
+        if lang == 'python' and _load_htmlizer():
             text = _color(text)
         else:
             # Replace < and >.
@@ -1515,15 +2931,74 @@ class Textiler:
         n = min(n,6)
         n = max(n,1)
 
+        text = self.inline(text)
+
+        # Give the header an id and add it to the contents.
+        if self.toc is not None:
+            title = _compile('<.*?>').sub('', text)
+            if not attributes.get('id'):
+                attributes['id'] = self.unique_id(_slug(title))
+            self.ids[attributes['id']] = 1
+            self.toc.append((n, attributes['id'], title))
+
         # Build the tag.
         open_tag = self.build_open_tag('h%d' % n, attributes)
         close_tag = '</h%d>' % n
 
-        text = self.inline(text)
-
         return open_tag + text + close_tag
 
 
+    def reserve_ids(self):
+        """Take the ids the blocks give themselves, like h2(#intro),
+        before header() makes any up, so a generated id never takes
+        one that comes later in the document.
+        """
+        for block in self.blocks:
+            parameters = dict(block.params or ()).get('parameters', None)
+            if parameters and '#' in parameters:
+                id = self.parse_params(parameters).get('id')
+                if id:
+                    self.ids[id] = 1
+
+
+    def unique_id(self, id):
+        """Make a header id unique in the document.
+
+        A taken id gets '-2', '-3' and so on, in document order,
+        so the same text always gets the same ids. Ids like 'fn1'
+        are left to the footnotes.
+        """
+        if id not in self.ids and not _compile(r'''fn\d+$''').match(id):
+            return id
+        n = 2
+        while '%s-%d' % (id, n) in self.ids:
+            n += 1
+        return '%s-%d' % (id, n)
+
+
+    def toc_html(self):
+        """Build the table of contents as nested lists."""
+        html = []
+        levels = []
+        for level, id, title in self.toc:
+            if not levels:
+                html.append('<ul class="toc">\n<li>')
+                levels.append(level)
+            elif level > levels[-1]:
+                html.append('\n<ul>\n<li>')
+                levels.append(level)
+            else:
+                while len(levels) > 1 and level <= levels[-2]:
+                    html.append('</li>\n</ul>')
+                    levels.pop()
+                html.append('</li>\n<li>')
+                levels[-1] = level
+            html.append('<a href="#%s">%s</a>' % (id, title))
+        for level in levels:
+            html.append('</li>\n</ul>')
+        return ''.join(html)
+
+
     def footnote(self, text, parameters=None, footnote=1, clear=None):
         """Process a footnote.
 
@@ -1585,11 +3060,11 @@ class Textiler:
             item = items.pop(0)
 
             # Clean the line.
-            item = item.lstrip()
+            item = item.lstrip(_whitespace)
             item = item.replace('\n', '<br />\n')
 
             # Get list item attributes.
-            p = re.compile(r'''^%(liattr)s\s''' % self.res, re.VERBOSE)
+            p = _compile_res(r'''^%(liattr)s\s''', re.VERBOSE)
             m = p.match(item)
             if m:
                 c = m.groupdict('')
@@ -1605,7 +3080,7 @@ class Textiler:
 
             # Reset the attributes, which should be applied
             # only to the first <li>.
-            liattributes = {}
+            liattributes = _Attributes()
 
             # Build the closing tag.
             close_tag_li = '</li>'
@@ -1621,7 +3096,7 @@ class Textiler:
                 n_item = items.pop(0)
 
                 # Grab the <ol> parameters.
-                p = re.compile(r'''^%(olattr)s''' % self.res, re.VERBOSE)
+                p = _compile_res(r'''^%(olattr)s''', re.VERBOSE)
                 m = p.match(n_item)
                 if m:
                     c = m.groupdict('')
@@ -1908,7 +3383,7 @@ class Textiler:
 
         output = []
         default_align = {}
-        rows = re.split(r'''\n+''', text)
+        rows = _compile(r'''\n+''').split(text)
         for row in rows:
             # Get the columns.
             columns = row.split('|')
@@ -1928,7 +3403,7 @@ class Textiler:
                 
             col = 0
             for cell in columns[:-1]:
-                p = re.compile(r'''(?:%(tattr)s\.\s)?(?P<text>.*)''' % self.res, re.VERBOSE)
+                p = _compile_res(r'''(?:%(tattr)s\.\s)?(?P<text>.*)''', re.VERBOSE)
                 m = p.match(cell)
                 if m:
                     c = m.groupdict('')
@@ -1957,7 +3432,7 @@ class Textiler:
                     close_td = '</%s>\n' % td_tag
 
                     #output.append(open_td + c['text'].strip() + close_td)
-                    output.append(open_td + self.inline(c['text'].strip()) + close_td)
+                    output.append(open_td + self.inline(c['text'].strip(_whitespace)) + close_td)
 
                 col += width
 
@@ -2009,9 +3484,9 @@ class Textiler:
         for you, if you have the itex2MML binary (you can download it
         from the "Movable Type plugin":http://golem.ph.utexas.edu/~distler/blog/files/itexToMML.tar.gz).
 
-        Block equations should be enclosed inbetween @\[@ and @\]@:
+        Block equations should be enclosed inbetween @\\[@ and @\\]@:
 
-        pre. \[ e^{i\pi} + 1 = 0 \]
+        pre. \\[ e^{i\\pi} + 1 = 0 \\]
 
         Will be translated to:
 
@@ -2023,7 +3498,7 @@ class Textiler:
 
         Equations can also be displayed inline:
 
-        pre. Euler's formula, $e^{i\pi}+1=0$, ...
+        pre. Euler's formula, $e^{i\\pi}+1=0$, ...
 
         (Note that if you want to display MathML(Mathematical Markup Language)
         your content must be served as @application/xhtml+xml@, which is not
@@ -2081,7 +3556,7 @@ class Textiler:
             doc = doc.split('\n')
             lines = []
             for line in doc:
-                line = line.strip()
+                line = line.strip(_whitespace)
                 lines.append(line)
                 
             doc = '\n'.join(lines)
@@ -2131,9 +3606,9 @@ class Textiler:
         acronyms = r'''(?P<acronym>[\w]+)\((?P<definition>[^\(\)]+?)\)'''
 
         # Check all acronyms.
-        for acronym, definition in re.findall(acronyms, text):
-            caps_acronym = ''.join(re.findall('[A-Z\d]+', acronym))
-            caps_definition = ''.join(re.findall('[A-Z\d]+', definition))
+        for acronym, definition in _compile(acronyms).findall(text):
+            caps_acronym = ''.join(_compile(r'[A-Z\d]+').findall(acronym))
+            caps_definition = ''.join(_compile(r'[A-Z\d]+').findall(definition))
             if caps_acronym and caps_acronym == caps_definition:
                 text = text.replace('%s(%s)' % (acronym, definition), '<acronym title="%s">%s</acronym>' % (definition, acronym))
         
@@ -2149,19 +3624,26 @@ class Textiler:
         adds a title to the link containing the first paragraph of the
         footnote.
         """
-        # Search for footnotes.
-        p = re.compile(r'''<p class="footnote" id="fn(?P<n>\d+)"><sup>(?P=n)</sup>(?P<note>.*)</p>''')
+        if '<p class="footnote"' not in text:
+            return text
+
+        # Search for footnotes. The first one with a number wins.
+        titles = {}
+        p = _compile(r'''<p class="footnote" id="fn(?P<n>\d+)"><sup>(?P=n)</sup>(?P<note>.*)</p>''')
         for m in p.finditer(text):
             n = m.group('n')
-            note = m.group('note').strip()
-
-            # Strip HTML from note.
-            note = re.sub('<.*?>', '', note)
+            if n not in titles:
+                # Strip HTML from note.
+                titles[n] = _compile('<.*?>').sub('', m.group('note').strip(_whitespace))
 
-            # Add the title.
-            text = text.replace('<a href="#fn%s">' % n, '<a href="#fn%s" title="%s">' % (n, note))
+        # Add the titles, all in one pass.
+        def title(m):
+            n = m.group(1)
+            if n in titles:
+                return '<a href="#fn%s" title="%s">' % (n, titles[n])
+            return m.group(0)
 
-        return text
+        return _compile(r'''<a href="#fn(\d+)">''').sub(title, text)
 
 
     def macros(self, m):
@@ -2360,8 +3842,17 @@ class Textiler:
         except KeyError:
             try:
                 # Try a unicode entity.
-                entity = unicodedata.lookup(entity)
-                entity = entity.encode('ascii', 'xmlcharrefreplace')
+                import unicodedata
+                char = unicodedata.lookup(entity)
+                # Python 3 also knows aliases and named sequences,
+                # and Unicode newer than the 5.2 of Python 2, where
+                # lots of words like {label} became emoji. Take the
+                # names Python 2 has, give or take the ones added by
+                # Unicode 4.0 to 5.2.
+                if _PY3 and (len(char) != 1 or unicodedata.name(char) != entity.upper() or
+                             unicodedata.ucd_3_2_0.category(char) == 'Cn'):
+                    raise KeyError(entity)
+                entity = _encode(char, 'ascii', 'xmlcharrefreplace')
             except:
                 # Return the unmodified entity.
                 entity = '{%s}' % entity
@@ -2391,82 +3882,60 @@ class Textiler:
         * Convert ==(TM)==, ==(R)==, and  ==(C)== to &#8482;, &#174;, and &#169;.
         * Convert the letter x to a dimension sign: 2==x==4 to 2x4 and 8 ==x== 10 to 8x10.
         """
-        glyphs = [(r'''"(?<!\w)\b''', r'''&#8220;'''),                              # double quotes
-                  (r'''"''', r'''&#8221;'''),                                       # double quotes
-                  (r"""\b'""", r'''&#8217;'''),                                     # single quotes
-                  (r"""'(?<!\w)\b""", r'''&#8216;'''),                              # single quotes
-                  (r"""'""", r'''&#8217;'''),                                       # single single quote
-                  (r'''(\b|^)( )?\.{3}''', r'''\1&#8230;'''),                       # ellipsis
-                  (r'''\b---\b''', r'''&#8212;&#8212;'''),                          # double em dash
-                  (r'''\s?--\s?''', r'''&#8212;'''),                                # em dash
-                  (r'''(\d+)-(\d+)''', r'''\1&#8211;\2'''),                         # en dash (1954-1999)
-                  (r'''(\d+)-(\W)''', r'''\1&#8212;\2'''),                          # em dash (1954--)
-                  (r'''\s-\s''', r''' &#8211; '''),                                 # en dash
-                  (r'''(\d+) ?x ?(\d+)''', r'''\1&#215;\2'''),                      # dimension sign
-                  (r'''\b ?(\((tm|TM)\))''', r'''&#8482;'''),                       # trademark
-                  (r'''\b ?(\([rR]\))''', r'''&#174;'''),                           # registered
-                  (r'''\b ?(\([cC]\))''', r'''&#169;'''),                           # copyright
-                  (r'''([^\s])\[(\d+)\]''',                                         #
-                       r'''\1<sup class="footnote"><a href="#fn\2">\2</a></sup>'''),# footnote
+        # Each glyph comes with a string it can't match without.
+        glyphs = [('"',   r'''"(?<!\w)\b''', r'''&#8220;'''),                              # double quotes
+                  ('"',   r'''"''', r'''&#8221;'''),                                       # double quotes
+                  ("'",   r"""\b'""", r'''&#8217;'''),                                     # single quotes
+                  ("'",   r"""'(?<!\w)\b""", r'''&#8216;'''),                              # single quotes
+                  ("'",   r"""'""", r'''&#8217;'''),                                       # single single quote
+                  ('...', r'''(\b|^)( )?\.{3}''', r'''\1&#8230;'''),                       # ellipsis
+                  ('---', r'''\b---\b''', r'''&#8212;&#8212;'''),                          # double em dash
+                  ('--',  r'''\s?--\s?''', r'''&#8212;'''),                                # em dash
+                  ('-',   r'''(\d+)-(\d+)''', r'''\1&#8211;\2'''),                         # en dash (1954-1999)
+                  ('-',   r'''(\d+)-(\W)''', r'''\1&#8212;\2'''),                          # em dash (1954--)
+                  ('-',   r'''\s-\s''', r''' &#8211; '''),                                 # en dash
+                  ('x',   r'''(\d+) ?x ?(\d+)''', r'''\1&#215;\2'''),                      # dimension sign
+                  ('(',   r'''\b ?(\((tm|TM)\))''', r'''&#8482;'''),                       # trademark
+                  ('(',   r'''\b ?(\([rR]\))''', r'''&#174;'''),                           # registered
+                  ('(',   r'''\b ?(\([cC]\))''', r'''&#169;'''),                           # copyright
+                  ('[',   r'''([^\s])\[(\d+)\]''',                                         #
+                               r'''\1<sup class="footnote"><a href="#fn\2">\2</a></sup>'''),# footnote
                   ]
 
         # Apply macros.
-        text = re.sub(r'''{([^}]+)}''', self.macros, text)
+        if '{' in text:
+            text = _compile(r'''{([^}]+)}''').sub(self.macros, text)
 
         # LaTeX style quotes.
         text = text.replace('\x60\x60', '&#8220;')
         text = text.replace('\xb4\xb4', '&#8221;')
 
-        # Linkify URL and emails.
-        url = r'''(?=[a-zA-Z0-9./#])                          # Must start correctly
-                  ((?:                                        # Match the leading part (proto://hostname, or just hostname)
-                      (?:ftp|https?|telnet|nntp)              #     protocol
-                      ://                                     #     ://
-                      (?:                                     #     Optional 'username:password@'
-                          \w+                                 #         username
-                          (?::\w+)?                           #         optional :password
-                          @                                   #         @
-                      )?                                      # 
-                      [-\w]+(?:\.\w[-\w]*)+                   #     hostname (sub.example.com)
-                  )                                           #
-                  (?::\d+)?                                   # Optional port number
-                  (?:                                         # Rest of the URL, optional
-                      /?                                      #     Start with '/'
-                      [^.!,?;:"'<>()\[\]{}\s\x7F-\xFF]*       #     Can't start with these
-                      (?:                                     #
-                          [.!,?;:]+                           #     One or more of these
-                          [^.!,?;:"'<>()\[\]{}\s\x7F-\xFF]+   #     Can't finish with these
-                          #'"                                 #     # or ' or "
-                      )*                                      #
-                  )?)                                         #
-               '''
-
-        email = r'''(?:mailto:)?            # Optional mailto:
-                    ([-\+\w]+               # username
-                    \@                      # at
-                    [-\w]+(?:\.\w[-\w]*)+)  # hostname
-                 '''
-
         # If there is no html, do a simple search and replace.
-        if not re.search(r'''<.*>''', text):
-            for glyph_search, glyph_replace in glyphs:
-                text = preg_replace(glyph_search, glyph_replace, text)
+        if not _compile(r'''<.*>''').search(text):
+            for glyph_trigger, glyph_search, glyph_replace in glyphs:
+                if glyph_trigger in text:
+                    text = preg_replace(glyph_search, glyph_replace, text)
 
-            # Linkify.
-            text = re.sub(re.compile(url, re.VERBOSE), r'''<a href="\1">\1</a>''', text)
-            text = re.sub(re.compile(email, re.VERBOSE), r'''<a href="mailto:\1">\1</a>''', text)
+            # Linkify URL and emails.
+            if '://' in text:
+                text = _linkify_urls(text)
+            if '@' in text:
+                text = _linkify_emails(text)
 
         else:
             lines = []
             # Else split the text into an array at <>.
-            for line in re.split('(<.*?>)', text):
-                if not re.match('<.*?>', line):
-                    for glyph_search, glyph_replace in glyphs:
-                        line = preg_replace(glyph_search, glyph_replace, line)
-
-                    # Linkify.
-                    line = re.sub(re.compile(url, re.VERBOSE), r'''<a href="\1">\1</a>''', line)
-                    line = re.sub(re.compile(email, re.VERBOSE), r'''<a href="mailto:\1">\1</a>''', line)
+            for line in _compile('(<.*?>)').split(text):
+                if not _compile('<.*?>').match(line):
+                    for glyph_trigger, glyph_search, glyph_replace in glyphs:
+                        if glyph_trigger in line:
+                            line = preg_replace(glyph_search, glyph_replace, line)
+
+                    # Linkify URL and emails.
+                    if '://' in line:
+                        line = _linkify_urls(line)
+                    if '@' in line:
+                        line = _linkify_emails(line)
 
                 lines.append(line)
 
@@ -2511,54 +3980,28 @@ class Textiler:
         (class) or (#id) or (class#id):For CSS(Cascading Style Sheets) class and id attributes. 
         """
         # itex2mml.
-        text = re.sub('\$(.*?)\$', lambda m: self.itex(m.group()), text)
+        if '$' in text:
+            text = _compile(r'\$(.*?)\$').sub(lambda m: self.itex(m.group()), text)
+        else:
+            self.skip('itex')
 
         # Add span tags to upper-case words which don't have a description.
         #text = preg_replace(r'''(^|\s)([A-Z]{3,})\b(?!\()''', r'''\1<span class="caps">\2</span>''', text)
-        
-        # Quick tags.
-        qtags = [('**', 'b',      {'qf': '(?<!\*)\*\*(?!\*)', 'cls': '\*'}),
-                 ('__', 'i',      {'qf': '(?<!_)__(?!_)', 'cls': '_'}),
-                 ('??', 'cite',   {'qf': '\?\?(?!\?)', 'cls': '\?'}),
-                 ('-',  'del',    {'qf': '(?<!\-)\-(?!\-)', 'cls': '-'}),
-                 ('+',  'ins',    {'qf': '(?<!\+)\+(?!\+)', 'cls': '\+'}),
-                 ('*',  'strong', {'qf': '(?<!\*)\*(?!\*)', 'cls': '\*'}),
-                 ('_',  'em',     {'qf': '(?<!_)_(?!_)', 'cls': '_'}),
-                 ('++', 'big',    {'qf': '(?<!\+)\+\+(?!\+)', 'cls': '\+\+'}),
-                 ('--', 'small',  {'qf': '(?<!\-)\-\-(?!\-)', 'cls': '\-\-'}),
-                 ('~',  'sub',    {'qf': '(?<!\~)\~(?!(\\\/~))', 'cls': '\~'}),
-                 ('@',  'code',   {'qf': '(?<!@)@(?!@)', 'cls': '@'}),
-                 ('%',  'span',   {'qf': '(?<!%)%(?!%)', 'cls': '%'}),
-                ]
 
         # Superscript.
-        text = re.sub(r'''(?<!\^)\^(?!\^)(.+?)(?<!\^)\^(?!\^)''', r'''<sup>\1</sup>''', text)
+        if '^' in text:
+            text = _compile(r'''(?<!\^)\^(?!\^)(.+?)(?<!\^)\^(?!\^)''').sub(r'''<sup>\1</sup>''', text)
+        else:
+            self.skip('sup')
 
         # This is from the perl version of Textile.
-        for qtag, htmltag, redict in qtags:
-            self.res.update(redict)
-            p = re.compile(r'''(?:                          #
-                                   ^                        # Start of string
-                                   |                        #
-                                   (?<=[\s>'"])             # Whitespace, end of tag, quotes
-                                   |                        #
-                                   (?P<pre>[{[])            # Surrounded by [ or {
-                                   |                        #
-                                   (?<=%(punct)s)           # Punctuation
-                               )                            #
-                               %(qf)s                       # opening tag
-                               %(qattr)s                    # attributes
-                               (?P<text>[^%(cls)s\s].*?)    # text
-                               (?<=\S)                      # non-whitespace
-                               %(qf)s                       # 
-                               (?:                          #
-                                   $                        # End of string
-                                   |                        #
-                                   (?P<post>[\]}])          # Surrounded by ] or }
-                                   |                        # 
-                                   (?=%(punct)s{1,2}|\s)    # punctuation
-                                )                           #
-                             ''' % self.res, re.VERBOSE)
+        for qtag, htmltag, redict in _qtags:
+            # Both delimiters have to be there.
+            if qtag[0] not in self.qtags_triggers or qtag not in text:
+                self.skip(htmltag)
+                continue
+
+            p = _qtag_re(redict)
 
             def _replace(m):
                 c = m.groupdict('')
@@ -2635,28 +4078,10 @@ class Textiler:
         for bottom alignment and "middle" for middle alignment.
         """
         # Compile the beast.
-        p = re.compile(r'''\!               # Opening !
-                           %(iattr)s        # Image attributes
-                           (?P<src>%(url)s) # Image src
-                           \s?              # Optional whitesapce
-                           (                #
-                               \(           #
-                               (?P<alt>.*?) # Optional (alt) attribute
-                               \)           #
-                           )?               #
-                           \s?              # Optional whitespace
-                           %(resize)s       # Resize parameters
-                           \!               # Closing !
-                           (                # Optional link
-                               :            #    starts with ':'
-                               (?P<link>    #    
-                               %(url)s      #    link HREF
-                               )            #
-                           )?               #
-                        ''' % self.res, re.VERBOSE)
+        p = _compile_res(_image_re, re.VERBOSE)
 
         for m in p.finditer(text):
-            c = m.groupdict('')
+            c = _groupdict(m)
 
             # Build the parameters for the <img /> tag.
             attributes = self.parse_params(c['parameters'], align_type='image')
@@ -2752,29 +4177,9 @@ class Textiler:
         <a href="http://www.google.com/search?q=PyBlosxom">PyBlosxom</a>
         <a href="http://www.google.com/search?q=python+blosxom+textile">Using Textile and Blosxom with Python</a>
         """
-        linkres = [r'''\[                           # [
-                       (?P<quote>"|')               # Opening quotes
-                       %(lattr)s                    # Link attributes
-                       (?P<text>[^"]+?)             # Link text
-                       \s?                          # Optional whitespace
-                       (?:\((?P<title>[^\)]+?)\))?  # Optional (title)
-                       (?P=quote)                   # Closing quotes
-                       :                            # :
-                       (?P<href>[^\]]+)             # HREF
-                       \]                           # ]
-                    ''' % self.res,
-                   r'''(?P<quote>"|')               # Opening quotes
-                       %(lattr)s                    # Link attributes
-                       (?P<text>[^"]+?)             # Link text
-                       \s?                          # Optional whitespace
-                       (?:\((?P<title>[^\)]+?)\))?  # Optional (title)
-                       (?P=quote)                   # Closing quotes
-                       :                            # :
-                       (?P<href>%(url)s)            # HREF
-                    ''' % self.res]
-
-        for linkre in linkres:
-            p = re.compile(linkre, re.VERBOSE)
+
+        for linkre in _link_res:
+            p = _compile_res(linkre, re.VERBOSE)
             for m in p.finditer(text):
                 c = m.groupdict('')
 
@@ -2795,7 +4200,7 @@ class Textiler:
                 query = query.replace(' ', '+')
 
                 # Look for smart search.
-                if self.searches.has_key(proto):
+                if proto in self.searches:
                     link = self.searches[proto] % query
                 
                 # Fix URL.
@@ -2817,15 +4222,132 @@ class Textiler:
         This function basically defines the order on which the 
         formatting is applied.
         """
-        text = self.qtags(text)
-        text = self.images(text)
-        text = self.links(text)
-        text = self.acronym(text)
-        text = self.glyphs(text)
+        if self.inline_engine == 'spans':
+            html = self.format_spans(text)
+            if html is not None:
+                return html
+
+        if _has_any(text, self.qtags_triggers):
+            text = self.qtags(text)
+        else:
+            self.skip('qtags')
+
+        if '!' in text:
+            text = self.images(text)
+        else:
+            self.skip('images')
+
+        if ':' in text and ('"' in text or "'" in text):
+            text = self.links(text)
+        else:
+            self.skip('links')
+
+        # Acronyms need a '(' or some upper case letters.
+        if '(' in text or text.lower() != text:
+            text = self.acronym(text)
+        else:
+            self.skip('acronym')
+
+        if _has_any(text, _glyphs_triggers):
+            text = self.glyphs(text)
+        else:
+            self.skip('glyphs')
+
+        return text
+
+
+    def narrow(self, present):
+        """Narrow down the inline phases for one document.
+
+        'present' has the _document_triggers found in the whole
+        document. The quick tags that need one of the others
+        can't match in any of its blocks, so format() doesn't
+        have to look for them.
+        """
+        if '$' in present:
+            # itex output could have anything in it.
+            self.qtags_triggers = _qtags_triggers
+            return
+
+        absent = [c for c in _document_triggers if c not in present]
+        self.qtags_triggers = ''.join([c for c in _qtags_triggers if c not in absent])
+
+
+    def format_spans(self, text):
+        """Text formatting in a single output pass.
+
+        The quick tags are found on the original text, as spans,
+        and only the plain text between them goes through acronym()
+        and glyphs(), piece by piece, before the HTML is joined once.
+        This is the same as running the phases one after the other
+        as long as the quick tags can't affect each other, so for
+        nested or adjacent quick tags, quick tags with attributes,
+        and text that needs itex, superscript, images, links, macros
+        or acronym definitions it returns None, and format() falls
+        back to the phases.
+        """
+        if _has_any(text, '$^!{}') or '":' in text or "':" in text:
+            return None
+        if '(' in text and _compile(r'''\w\(''').search(text):
+            return None
+
+        # (start, end, tag, text start, text end) for each quick
+        # tag, and with no tag for the HTML already in the text.
+        cuts = []
+        if '<' in text or '>' in text:
+            for m in _compile(r'''<[^<>\n]*>''').finditer(text):
+                cuts.append((m.start(), m.end(), None, 0, 0))
+            if len(cuts) != text.count('<') or len(cuts) != text.count('>'):
+                return None
+
+        for qtag, htmltag, redict in _qtags:
+            if qtag not in text:
+                continue
+            for m in _qtag_re(redict).finditer(text):
+                if m.group('pre') or m.group('post') or m.group('parameters'):
+                    return None
+                cuts.append((m.start(), m.end(), htmltag, m.start('text'), m.end('text')))
+
+        cuts.sort()
+        html = []
+        pos = 0
+        for start, end, htmltag, text_start, text_end in cuts:
+            if start < pos:
+                return None
+
+            html.append(self.format_text(text[pos:start]))
+            if htmltag is None:
+                html.append(text[start:end])
+            else:
+                if text[start-1:start] in _qtag_chars and start > 0:
+                    return None
+                if text[end:end+1] in _qtag_chars and end < len(text):
+                    return None
+                html.append(self.build_open_tag(htmltag, {}))
+                html.append(self.format_text(text[text_start:text_end]))
+                html.append('</%s>' % htmltag)
+            pos = end
+
+        html.append(self.format_text(text[pos:]))
+
+        return ''.join(html)
+
+
+    def format_text(self, text):
+        """Apply acronym() and glyphs() to text without quick tags."""
+        if text.lower() != text:
+            text = self.acronym(text)
+        if _has_any(text, _glyphs_triggers):
+            text = self.glyphs(text)
 
         return text
 
 
+    def skip(self, phase):
+        """Count an inline phase that format() didn't need to run."""
+        self.skipped[phase] = self.skipped.get(phase, 0) + 1
+
+
     def inline(self, text):
         """Inline formatting.
 
@@ -2837,14 +4359,14 @@ class Textiler:
 
         Inline formatting is applied within a block of text.
         """
-        if not re.search(r'''==(.*?)==''', text):
+        if '==' not in text or not _compile(r'''==(.*?)==''').search(text):
             text = self.format(text)
 
         else:
             lines = []
             # Else split the text into an array at <>.
-            for line in re.split('(==.*?==)', text):
-                if not re.match('==.*?==', line):
+            for line in _compile('(==.*?==)').split(text):
+                if not _compile('==.*?==').match(line):
                     line = self.format(line)
                 else:
                     line = line[2:-2]
@@ -2856,6 +4378,302 @@ class Textiler:
         return text
             
 
+def _plain_unescape(text, encoding):
+    """Replace character references with the characters, as a
+    browser shows them: the &, < and > escaped on the way in and
+    the references in the source alike. A reference to a character
+    'encoding' can't hold, or to no known entity, is left alone."""
+    if '&' not in text:
+        return text
+    try:
+        from htmlentitydefs import name2codepoint
+    except ImportError:
+        from html.entities import name2codepoint
+
+    def char(m):
+        ref = m.group(1)
+        if ref[:2] in ('#x', '#X'):
+            n = int(ref[2:], 16)
+        elif ref[:1] == '#':
+            n = int(ref[1:])
+        elif ref == 'apos':
+            n = 39
+        elif ref in name2codepoint:
+            n = name2codepoint[ref]
+        else:
+            return m.group(0)
+        try:
+            return _text(unichr(n).encode(encoding))
+        except (ValueError, OverflowError, UnicodeError):
+            return m.group(0)
+
+    return _compile(r'''&(#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z][a-zA-Z0-9]*);''').sub(char, text)
+
+
+class PlainTextiler(Textiler):
+    """Textile to plain text, for search indexes and the like.
+
+    Goes through the same blocks as Textiler, but each block
+    method gives back its text instead of HTML: quick tags, links
+    and images are reduced to their text (images to their alt
+    text), HTML tags outside @code@ are dropped, character
+    references are replaced with the characters and no glyphs are
+    turned into entities. Blocks are still separated by blank
+    lines; list items and table rows go one per line.
+
+    The output is UTF-8 unless asked otherwise, and a character
+    the output encoding can't hold raises UnicodeEncodeError
+    rather than being lost from the index.
+    """
+    def process(self, output='utf-8', **args):
+        return Textiler.process(self, output=output, **args)
+
+
+    def finishers(self, validate, sanitize, output, encoding, literal):
+        """Only convert to the output encoding; there is no HTML
+        to sanitize or validate."""
+        def convert(textiler, text):
+            return _encode(_decode(text, encoding), output, 'strict')
+        return [convert]
+
+
+    def format(self, text):
+        """Drop the inline markup, keeping the text."""
+        if '<' in text:
+            text = self.drop_tags(text)
+
+        if _has_any(text, self.qtags_triggers):
+            text = self.qtags(text)
+
+        if '!' in text:
+            text = self.images(text)
+
+        if ':' in text and ('"' in text or "'" in text):
+            text = self.links(text)
+
+        return _plain_unescape(text, self.encoding)
+
+
+    def drop_tags(self, text):
+        """Drop the HTML tags, except in @code@ spans, where they
+        are text the HTML renderer escapes. Only what looks like a
+        tag to the sanitizer goes: a < that doesn't start one, as in
+        'a < b', is text."""
+        tags = _compile(r'''</?[a-zA-Z!][^<>]*>''')
+        if '@' not in text:
+            return tags.sub('', text)
+        code = _qtag_re([redict for qtag, htmltag, redict in _qtags if qtag == '@'][0])
+        output = []
+        pos = 0
+        for m in code.finditer(text):
+            output.append(tags.sub('', text[pos:m.start()]))
+            output.append(m.group(0))
+            pos = m.end()
+        output.append(tags.sub('', text[pos:]))
+        return ''.join(output)
+
+
+    def qtags(self, text):
+        """Keep the text of the quick tags."""
+        if '^' in text:
+            text = _compile(r'''(?<!\^)\^(?!\^)(.+?)(?<!\^)\^(?!\^)''').sub(r'''\1''', text)
+
+        for qtag, htmltag, redict in _qtags:
+            if qtag[0] in self.qtags_triggers and qtag in text:
+                text = _qtag_re(redict).sub(lambda m: m.group('text'), text)
+
+        return text
+
+
+    def images(self, text):
+        """Replace the images with their alt text."""
+        return _compile_res(_image_re, re.VERBOSE).sub(lambda m: m.group('alt') or '', text)
+
+
+    def links(self, text):
+        """Keep the text of the links."""
+        for linkre in _link_res:
+            text = _compile_res(linkre, re.VERBOSE).sub(lambda m: m.group('text'), text)
+        return text
+
+
+    def paragraph(self, text, parameters=None, attributes=None, clear=None):
+        lines = [line.strip(_whitespace) for line in _compile('\n{2,}').split(text)]
+        return '\n\n'.join([self.inline(line) for line in lines if line])
+
+
+    def pre(self, text, parameters=None, clear=None):
+        return _plain_unescape(text.rstrip(_whitespace), self.encoding)
+
+
+    def bc(self, text, parameters=None, clear=None):
+        return _plain_unescape(text, self.encoding)
+
+
+    def dl(self, text, parameters=None, clear=None):
+        output = []
+        for line in text.split('\n'):
+            dt, dd = (line.split(':', 1) + [''])[:2]
+            if dt:
+                output.append(self.inline(dt))
+                if dd:
+                    output.append(self.inline(dd))
+        return '\n'.join(output)
+
+
+    def blockquote(self, text, parameters=None, cite=None, clear=None):
+        # Leave out the citation line.
+        if not cite:
+            lines = text.split('\n')
+            if lines[-1].startswith('-- '):
+                text = '\n'.join(lines[:-1])
+        return self.paragraph(text)
+
+
+    def header(self, text, parameters=None, header=1, clear=None):
+        return self.inline(text)
+
+
+    def footnote(self, text, parameters=None, footnote=1, clear=None):
+        return '%s %s' % (footnote, self.paragraph(text))
+
+
+    def ol(self, text, liparameters=None, olparameters=None, clear=None):
+        p = _compile_res(r'''^[#*]+%(liattr)s\s?''', re.VERBOSE)
+        return '\n'.join([self.inline(p.sub('', line)) for line in text.split('\n')])
+
+
+    ul = ol
+
+
+    def table(self, text, parameters=None, clear=None):
+        p = _compile_res(r'''(?:%(tattr)s\.\s)?(?P<text>.*)''', re.VERBOSE)
+        rows = []
+        for row in _compile(r'''\n+''').split(text):
+            cells = [p.match(cell).group('text').strip(_whitespace) for cell in row.split('|')[1:-1]]
+            rows.append(' | '.join([self.inline(cell) for cell in cells]))
+        return '\n'.join(rows)
+
+
+class MemoryProfile:
+    """Where the memory goes while rendering, traced with tracemalloc.
+
+    Collects, for each Textiler phase and each block type, how many
+    times it ran, the bytes it left allocated when it returned
+    (mostly its result) and the most it had allocated at any point
+    (its peak, above what was allocated when it started). Phases
+    that run inside others count towards both: a paragraph block
+    includes the inline phases of its text. Works across any number
+    of documents:
+
+        profile = MemoryProfile()
+        profile.start()
+        for text in texts:
+            textile_memory(text, profile)
+        profile.stop()
+        sys.stdout.write(profile.report())
+
+    Needs Python 3.9 or later, for tracemalloc.reset_peak().
+    """
+    def __init__(self):
+        # name -> [calls, bytes left allocated, largest peak]
+        self.phases = {}
+        # [allocated at the start, peak so far] for each running phase
+        self.stack = []
+        self.started = False
+
+    def start(self):
+        try:
+            import tracemalloc
+        except ImportError:
+            raise Exception("memory profiling needs tracemalloc (Python 3.9 or later)")
+        if not hasattr(tracemalloc, 'reset_peak'):
+            raise Exception("memory profiling needs tracemalloc.reset_peak() (Python 3.9 or later)")
+        self.tracemalloc = tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started = True
+
+    def stop(self):
+        if self.started:
+            self.tracemalloc.stop()
+            self.started = False
+
+    def call(self, name, func, *args, **kwargs):
+        """Call func(*args, **kwargs) and record its memory as 'name'."""
+        tracemalloc = self.tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        # Resetting the peak loses the one of the phase we are in,
+        # so keep it on the stack.
+        if self.stack:
+            self.stack[-1][1] = max(self.stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        self.stack.append([current, current])
+        try:
+            return func(*args, **kwargs)
+        finally:
+            after, peak = tracemalloc.get_traced_memory()
+            start, inner_peak = self.stack.pop()
+            peak = max(peak, inner_peak)
+            if self.stack:
+                self.stack[-1][1] = max(self.stack[-1][1], peak)
+            record = self.phases.setdefault(name, [0, 0, 0])
+            record[0] += 1
+            record[1] += after - start
+            record[2] = max(record[2], peak - start)
+
+    def report(self):
+        """The phases by largest peak, as text."""
+        lines = ['%-24s %8s %14s %14s' % ('phase', 'calls', 'left (KB)', 'peak (KB)')]
+        items = sorted(self.phases.items(), key=lambda item: (-item[1][2], item[0]))
+        for name, (calls, left, peak) in items:
+            lines.append('%-24s %8d %14.1f %14.1f' % (name, calls, left / 1024.0, peak / 1024.0))
+        return '\n'.join(lines) + '\n'
+
+
+# The names the finishers from _finishers() are reported under.
+_finisher_phases = {'convert': 'encode', 'clean': 'sanitize', 'check': 'validate', '<lambda>': 'tidy'}
+
+
+class ProfilingTextiler(Textiler):
+    """A Textiler that records its memory use in a MemoryProfile.
+
+    Each phase is reported under its method name ('split_text',
+    'qtags', 'footnotes'...), the finishers as 'encode', 'sanitize'
+    and 'validate', and the blocks as 'block ' and their kind. The
+    blocks are always rendered here, never on worker processes,
+    so that they can be traced.
+    """
+    phases = ('preprocess', 'grab_links', 'split_text', 'color_blocks', 'format_spans',
+              'qtags', 'images', 'links', 'acronym', 'glyphs', 'footnotes')
+
+    def __init__(self, text, profile):
+        Textiler.__init__(self, text)
+        self.profile = profile
+        for name in self.phases:
+            setattr(self, name, self.traced(name, getattr(self, name)))
+        kinds = ['paragraph'] + [kind for regexp, kind in self.signatures]
+        for kind in set(kinds):
+            setattr(self, kind, self.traced('block ' + kind, getattr(self, kind)))
+
+
+    def traced(self, name, func):
+        profile = self.profile
+        def traced(*args, **kwargs):
+            return profile.call(name, func, *args, **kwargs)
+        return traced
+
+
+    def finishers(self, validate, sanitize, output, encoding, literal):
+        finishers = Textiler.finishers(self, validate, sanitize, output, encoding, literal)
+        return [self.traced(_finisher_phases.get(f.__name__, f.__name__), f) for f in finishers]
+
+
+    def run(self, finishers):
+        self.workers = 0
+        return Textiler.run(self, finishers)
+
+
 def textile(text, **args):
     """This is Textile.
 
@@ -2869,5 +4687,130 @@ def textile(text, **args):
     return Textiler(text).process(**args)
 
 
+def textile_excerpt(text, count=None, start=None, end=None, **args):
+    """Render part of a document.
+
+    Same as textile(text, **args), but only renders the first
+    'count' blocks and/or the blocks overlapping 'start':'end'
+    (see Textiler.excerpt()), for index pages and previews:
+
+        summary = textile_excerpt(text, 2)
+    """
+    return Textiler(text).excerpt(count, start, end, **args)
+
+
+def textile_plain(text, **args):
+    """Plain text instead of XHTML, see PlainTextiler.
+
+    Takes the same options as textile(); only 'encoding' and
+    'output' matter for the result, and 'output' defaults to
+    'utf-8':
+
+        words = textile_plain(text, output='latin-1')
+    """
+    return PlainTextiler(text).process(**args)
+
+
+def textile_memory(text, profile, **args):
+    """textile(text, **args), recording its memory use in 'profile',
+    a MemoryProfile (see there)."""
+    return ProfilingTextiler(text, profile).process(**args)
+
+
+class TextilerPool:
+    """Textilers shared by threads.
+
+    render() borrows an idle Textiler (or builds one), renders the
+    text with it and gives it back. At most 'size' idle instances
+    are kept around.
+
+        pool = TextilerPool()
+        html = pool.render(text, head_offset=1)    # from any thread
+    """
+    def __init__(self, size=4):
+        import threading
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = []
+
+
+    def render(self, text, **args):
+        """Same as textile(text, **args), on a pooled Textiler."""
+        self.lock.acquire()
+        try:
+            if self.idle:
+                textiler = self.idle.pop()
+            else:
+                textiler = None
+        finally:
+            self.lock.release()
+
+        if textiler is None:
+            textiler = Textiler()
+        try:
+            return textiler.render(text, **args)
+        finally:
+            self.lock.acquire()
+            try:
+                if len(self.idle) < self.size:
+                    self.idle.append(textiler)
+            finally:
+                self.lock.release()
+
+
+def make_renderer(head_offset=HEAD_OFFSET, validate=VALIDATE, sanitize=SANITIZE, output=OUTPUT, encoding=ENCODING, inline_engine=INLINE_ENGINE, literal=LITERAL, toc=TOC):
+    """Build a renderer for one set of options.
+
+    Returns a function that takes the text and returns the same
+    thing textile(text, ...) would with these options. The Textiler,
+    its signatures and searches, and the steps for the options are
+    set up once here, so calling the renderer many times only costs
+    the rendering itself:
+
+        render = make_renderer(head_offset=1, output='utf-8')
+        for text in texts:
+            html = render(text)
+
+    A renderer keeps its state between calls, so don't share one
+    between threads.
+    """
+    textiler = Textiler()
+    textiler.inline_engine = inline_engine
+    textiler.make_toc = toc
+    textiler.encoding = encoding
+    finishers = _finishers(validate, sanitize, output, encoding, literal)
+
+    def render(text):
+        textiler.text = text
+        textiler.head_offset = head_offset
+        return textiler.run(finishers)
+
+    return render
+
+
+def textile_many(texts, head_offset=HEAD_OFFSET, validate=VALIDATE, sanitize=SANITIZE, output=OUTPUT, encoding=ENCODING, inline_engine=INLINE_ENGINE, literal=LITERAL, toc=TOC):
+    """Render a batch of documents.
+
+    Returns the same list as [textile(text, ...) for text in texts].
+    The whole batch is prescanned first (see _prescan()), so for
+    each document format() only looks for the quick tags that
+    can be in it.
+    """
+    textiler = Textiler()
+    textiler.inline_engine = inline_engine
+    textiler.make_toc = toc
+    textiler.encoding = encoding
+    finishers = _finishers(validate, sanitize, output, encoding, literal)
+
+    html = []
+    for text, present in zip(texts, _prescan([_internal(text, encoding) for text in texts])):
+        textiler.text = text
+        textiler.head_offset = head_offset
+        textiler.narrow(present)
+        html.append(textiler.run(finishers))
+
+    return html
+
+
 if __name__ == '__main__':
-    print textile('tell me about textile.', head_offset=1)
+    print(textile('tell me about textile.', head_offset=1))
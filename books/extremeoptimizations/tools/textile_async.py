@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# asyncio front end for textile.py. textile() is plain CPU work and
+# blocks the event loop for as long as a document takes, so this
+# runs it on an executor (threads or processes) instead, with a
+# limit on how many renders run at once and on how many may wait.
+#
+#     html = await textile_async(text, head_offset=1)
+#     pages = await textile_many_async(texts)
+#
+# or, with limits of your own:
+#
+#     renderer = AsyncRenderer(workers=4, kind="process", max_pending=100)
+#     html = await renderer.render(text)
+#     renderer.metrics()    # {'queued': ..., 'running': ..., ...}
+#     renderer.close()
+#
+# Needs Python 3. See "textile_bench.py async" for a benchmark.
+
+import asyncio
+import concurrent.futures
+import time
+import textile
+
+# Threads are enough when the caller mostly needs the event loop
+# to stay responsive; processes are for rendering in parallel.
+DEFAULT_KIND = "thread"
+DEFAULT_WORKERS = 4
+
+def _render(text, options):
+    return textile.textile(text, **options)
+
+class AsyncRenderer:
+    """Renders on a bounded executor for asyncio code.
+
+    At most 'workers' renders run at once; the others wait for a
+    slot. With 'max_pending' set, render() raises asyncio.QueueFull
+    instead of waiting once that many renders are already waiting,
+    so an overloaded service can push back on its callers.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, kind=DEFAULT_KIND, max_pending=None):
+        if kind == "thread":
+            self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        elif kind == "process":
+            self.executor = concurrent.futures.ProcessPoolExecutor(workers)
+        else:
+            raise ValueError("unknown executor kind '%s'" % kind)
+        self.workers = workers
+        self.kind = kind
+        self.max_pending = max_pending
+        # A semaphore belongs to the loop it was first used on,
+        # so keep one per loop.
+        self.loop = None
+        self.slots = None
+        self.queued = 0
+        self.max_queued = 0
+        self.running = 0
+        self.done = 0
+        self.cancelled = 0
+        self.rejected = 0
+
+    def metrics(self):
+        """Queue depth and counters, as a dict."""
+        return {
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "running": self.running,
+            "done": self.done,
+            "cancelled": self.cancelled,
+            "rejected": self.rejected,
+        }
+
+    def _slots(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.loop = loop
+            self.slots = asyncio.Semaphore(self.workers)
+        return self.slots
+
+    def _release(self):
+        self.running -= 1
+        self.slots.release()
+
+    async def render(self, text, **options):
+        """Same as textile.textile(text, **options), off the loop.
+
+        Cancelling the caller stops a render that hasn't started.
+        One that is already running can't be interrupted: its
+        result is dropped, and its slot is only given back when it
+        finishes, so the limit on running renders holds.
+        """
+        if self.max_pending is not None and self.queued >= self.max_pending:
+            self.rejected += 1
+            raise asyncio.QueueFull("%d renders already waiting" % self.queued)
+        slots = self._slots()
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        try:
+            await slots.acquire()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            self.queued -= 1
+
+        self.running += 1
+        loop = self.loop
+        future = self.executor.submit(_render, text, options)
+        try:
+            html = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            if future.done():
+                self._release()
+            else:
+                future.add_done_callback(lambda f: loop.call_soon_threadsafe(self._release))
+        self.done += 1
+        return html
+
+    async def render_many(self, texts, **options):
+        """Render a batch, in order, with at most 'workers' in flight.
+
+        The batch is fed to render() as slots free up rather than
+        all at once, so it never trips 'max_pending' by itself.
+        """
+        results = [None] * len(texts)
+        items = iter(enumerate(texts))
+
+        async def feed():
+            for (i, text) in items:
+                results[i] = await self.render(text, **options)
+
+        tasks = [asyncio.ensure_future(feed()) for i in range(min(self.workers, len(texts)))]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return results
+
+    def close(self, wait=True):
+        self.executor.shutdown(wait)
+
+g_renderer = None
+def default_renderer():
+    global g_renderer
+    if g_renderer is None:
+        g_renderer = AsyncRenderer()
+    return g_renderer
+
+async def textile_async(text, **options):
+    """textile.textile() on the shared AsyncRenderer."""
+    return await default_renderer().render(text, **options)
+
+async def textile_many_async(texts, **options):
+    """A batch of textile.textile() on the shared AsyncRenderer."""
+    return await default_renderer().render_many(texts, **options)
+
+# For benchmarks: textile() called right on the loop, as a baseline.
+class InlineRenderer:
+    kind = "inline"
+
+    async def render(self, text, **options):
+        return textile.textile(text, **options)
+
+    def metrics(self):
+        return {"max_queued": 0}
+
+    def close(self):
+        pass
+
+async def run_clients(renderer, texts, concurrency):
+    """Render texts with 'concurrency' clients sending one request
+    after the other. Returns (total ms, latency of each request in
+    ms, longest event loop stall in ms, results in order)."""
+    latencies = []
+    results = [None] * len(texts)
+    items = iter(enumerate(texts))
+    stall = [0.0]
+    stop = [False]
+
+    async def ticker():
+        while not stop[0]:
+            start = time.time()
+            await asyncio.sleep(0.005)
+            stall[0] = max(stall[0], time.time() - start - 0.005)
+
+    async def client():
+        for (i, text) in items:
+            start = time.time()
+            results[i] = await renderer.render(text)
+            latencies.append((time.time() - start) * 1000.0)
+
+    tick = asyncio.ensure_future(ticker())
+    start = time.time()
+    await asyncio.gather(*[client() for i in range(concurrency)])
+    total = (time.time() - start) * 1000.0
+    stop[0] = True
+    await tick
+    return (total, latencies, stall[0] * 1000.0, results)
@@ -0,0 +1,893 @@
+#!/usr/bin/env python
+
+# Benchmarks for textile.py.
+#
+# Usage: textile_bench.py <command> [args]
+# Run without arguments to see the list of commands.
+
+import sys, os, os.path, subprocess, time, math
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+BASE_DIR = os.path.realpath(os.path.join(SCRIPT_DIR, ".."))
+TXTSRCDIR = os.path.join(BASE_DIR, "txtsrc")
+
+# How long "import textile" may take, in milliseconds, on top
+# of a bare interpreter start. Measured with warm .pyc files.
+# Most of it is loading the code from the .pyc, which is slower
+# on Python 3, and -X importtime there counts more of it than
+# the wall clock difference Python 2 is measured with.
+IMPORT_BUDGET_MS = 2.0
+if sys.version_info[0] >= 3:
+    IMPORT_BUDGET_MS = 3.0
+
+def log(txt):
+    sys.stdout.write(txt + "\n")
+    sys.stdout.flush()
+
+def read(path):
+    fo = open(path, "rb")
+    d = fo.read()
+    fo.close()
+    return d
+
+def child_env():
+    env = dict(os.environ)
+    # we want to measure warm imports, so let python write .pyc files
+    if "PYTHONDONTWRITEBYTECODE" in env:
+        del env["PYTHONDONTWRITEBYTECODE"]
+    env["PYTHONPATH"] = SCRIPT_DIR
+    return env
+
+def supports_importtime():
+    return sys.version_info >= (3, 7)
+
+def run_python(args):
+    cmd = [sys.executable] + args
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=child_env(), cwd=SCRIPT_DIR)
+    (out, err) = proc.communicate()
+    if 0 != proc.returncode:
+        raise Exception("'%s' failed:\n%s" % (" ".join(cmd), err))
+    return (out, err)
+
+# Parses the output of "python -X importtime" and returns the
+# cumulative time, in milliseconds, of importing the given module.
+def importtime_ms(err, module):
+    for line in err.decode("ascii", "replace").splitlines():
+        parts = [p.strip() for p in line.split("|")]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1000.0
+    raise Exception("no import time for '%s' in:\n%s" % (module, err))
+
+def wallclock_ms(args):
+    timer = time.time
+    start = timer()
+    run_python(args)
+    return (timer() - start) * 1000.0
+
+# Python 2 has re loaded before it runs anything, Python 3 doesn't;
+# load it first so the budget is for the module itself on both.
+PRELOADED = "import re; "
+
+def measure_import(module, runs):
+    # the first run writes the .pyc files
+    run_python(["-c", PRELOADED + "import %s" % module])
+    times = []
+    for i in range(runs):
+        if supports_importtime():
+            (out, err) = run_python(["-X", "importtime", "-c", PRELOADED + "import %s" % module])
+            times.append(importtime_ms(err, module))
+        else:
+            # no -X importtime: subtract the cost of a bare interpreter
+            base = wallclock_ms(["-c", PRELOADED + "pass"])
+            times.append(max(0.0, wallclock_ms(["-c", PRELOADED + "import %s" % module]) - base))
+    times.sort()
+    return times[len(times) // 2]
+
+def bench_importtime(args):
+    runs = 11
+    if args:
+        runs = int(args[0])
+    ms = measure_import("textile", runs)
+    method = "-X importtime"
+    if not supports_importtime():
+        method = "wall clock"
+    log("import textile: %.2f ms (median of %d, %s), budget %.2f ms" % (ms, runs, method, IMPORT_BUDGET_MS))
+    if ms > IMPORT_BUDGET_MS:
+        log("FAILED: import time is over budget")
+        sys.exit(1)
+
+# textile() returns str on Python 3, bytes on Python 2
+def encoded(html, output="ascii"):
+    if not isinstance(html, bytes):
+        html = html.encode(output)
+    return html
+
+def timeit(func, *args):
+    timer = time.time
+    start = timer()
+    res = func(*args)
+    return ((timer() - start) * 1000.0, res)
+
+def python_doc(nblocks, changed):
+    blocks = []
+    for i in range(nblocks):
+        code = "def f%d(x):\n    return [y * %d for y in range(x) if y %% 3]" % (i, i)
+        if i < changed:
+            code = code + "  # changed"
+        blocks.append("bc[python]. " + code)
+    return "\n\n".join(blocks)
+
+def bench_color(args):
+    import textile
+    if not textile._load_htmlizer():
+        log("htmlizer is not installed, nothing to measure")
+        return
+    nblocks = 200
+    if args:
+        nblocks = int(args[0])
+    (cold, res) = timeit(textile.textile, python_doc(nblocks, 0))
+    (warm, res) = timeit(textile.textile, python_doc(nblocks, 0))
+    (partial, res) = timeit(textile.textile, python_doc(nblocks, nblocks // 10))
+    log("%d bc[python] blocks: cold %.1f ms, cached %.1f ms, 10%% changed %.1f ms" % (nblocks, cold, warm, partial))
+
+def book_pages():
+    files = sorted(os.listdir(TXTSRCDIR))
+    return [os.path.join(TXTSRCDIR, f) for f in files if f.endswith(".textile")]
+
+def bench_validate(args):
+    import textile
+    texts = [read(f) for f in book_pages()]
+    (render, htmls) = timeit(lambda: [textile.textile(t) for t in texts])
+    (check, errors) = timeit(lambda: [textile.check_xhtml(h) for h in htmls])
+    nerrors = sum([len(e) for e in errors])
+    log("%d pages: render %.1f ms, check_xhtml %.1f ms (%.1f%%), %d problems" % (len(texts), render, check, check * 100.0 / render, nerrors))
+
+def extended_doc(size):
+    chunk = "int f(int x) {\n    return x * 2; // *not* _markup_\n}\n"
+    n = size // (len(chunk) + 2)
+    return "bc.. " + "\n\n".join([chunk] * n) + "\n\np. The end."
+
+def bench_extended(args):
+    import textile
+    mb = 1.0
+    if args:
+        mb = float(args[0])
+    size = int(mb * 1024 * 1024)
+    while size >= 64 * 1024:
+        text = extended_doc(size)
+        t = textile.Textiler(text)
+        t.preprocess()
+        t._links = t.grab_links()
+        t.head_offset = 0
+        (split, blocks) = timeit(t.split_text)
+        (total, html) = timeit(textile.textile, text)
+        log("bc.. block of %7d bytes: split_text %7.1f ms, textile %7.1f ms" % (len(text), split, total))
+        size = size // 2
+
+def bench_renderer(args):
+    import textile
+    n = 20000
+    if args:
+        n = int(args[0])
+    texts = ["h2. Item %d\n\nSome *text* for item %d." % (i, i) for i in range(n)]
+    (plain, res1) = timeit(lambda: [textile.textile(t, head_offset=1) for t in texts])
+    render = textile.make_renderer(head_offset=1)
+    (prebound, res2) = timeit(lambda: [render(t) for t in texts])
+    if res1 != res2:
+        log("FAILED: make_renderer() output differs from textile()")
+        sys.exit(1)
+    log("%d small documents: textile() %.1f ms, make_renderer() %.1f ms (%.2fx)" % (n, plain, prebound, plain / prebound))
+
+def bench_reuse(args):
+    import textile, threading
+    n = 20000
+    if args:
+        n = int(args[0])
+    texts = ["h2. Item %d\n\nSome *text* for item %d." % (i, i) for i in range(n)]
+    (plain, res1) = timeit(lambda: [textile.textile(t, head_offset=1) for t in texts])
+    textiler = textile.Textiler()
+    (reused, res2) = timeit(lambda: [textiler.render(t, head_offset=1) for t in texts])
+    pool = textile.TextilerPool()
+    def render_threads(nthreads=4):
+        res = [None] * len(texts)
+        def worker(k):
+            for i in range(k, len(texts), nthreads):
+                res[i] = pool.render(texts[i], head_offset=1)
+        threads = [threading.Thread(target=worker, args=(k,)) for k in range(nthreads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return res
+    (pooled, res3) = timeit(render_threads)
+    if res1 != res2 or res1 != res3:
+        log("FAILED: Textiler.render() or TextilerPool output differs from textile()")
+        sys.exit(1)
+    log("%d small documents: textile() %.1f ms, Textiler.render() %.1f ms (%.2fx), TextilerPool with 4 threads %.1f ms (%.2fx)" % (n, plain, reused, plain / reused, pooled, plain / pooled))
+
+def bench_prescan(args):
+    import textile
+    class CountingTextiler(textile.Textiler):
+        calls = 0
+        def format(self, text):
+            CountingTextiler.calls += 1
+            return textile.Textiler.format(self, text)
+    texts = [read(f) for f in book_pages()]
+    skipped = {}
+    def render_all():
+        for text in texts:
+            t = CountingTextiler(text)
+            t.process()
+            for (phase, n) in t.skipped.items():
+                skipped[phase] = skipped.get(phase, 0) + n
+    (ms, res) = timeit(render_all)
+    calls = CountingTextiler.calls
+    log("%d pages, %.1f ms, format() called %d times" % (len(texts), ms, calls))
+    for phase in ["qtags", "images", "links", "acronym", "glyphs"]:
+        n = skipped.get(phase, 0)
+        log("  %-8s skipped %6d (%5.1f%%)" % (phase, n, n * 100.0 / max(calls, 1)))
+    log("quick tags skipped:")
+    for phase in sorted(skipped.keys()):
+        if phase not in ["qtags", "images", "links", "acronym", "glyphs"]:
+            log("  %-8s %6d" % (phase, skipped[phase]))
+
+def notion_pages(limit):
+    d = os.path.realpath(os.path.join(BASE_DIR, "..", "..", "notion_cache"))
+    if not os.path.isdir(d):
+        return []
+    files = sorted([f for f in os.listdir(d) if f.endswith(".txt")])[:limit]
+    return [os.path.join(d, f) for f in files]
+
+def bench_batch(args):
+    import textile
+    limit = 200
+    if args:
+        limit = int(args[0])
+    texts = [read(f) for f in book_pages() + notion_pages(limit)]
+    mb = sum([len(t) for t in texts]) / (1024.0 * 1024.0)
+    log("%d documents, %.1f MB" % (len(texts), mb))
+    have_numpy = textile._load_numpy() is not None
+    # _prescan() takes the text the way process() works on it
+    scanned = [textile._text(t) for t in texts]
+    textile.PRESCAN_NUMPY = 1
+    (vec, present) = timeit(textile._prescan, scanned)
+    textile.PRESCAN_NUMPY = 0
+    (py, present2) = timeit(textile._prescan, scanned)
+    if present != present2:
+        log("FAILED: NumPy and pure Python prescans differ")
+        sys.exit(1)
+    if have_numpy:
+        log("prescan: NumPy %.1f ms, pure Python %.1f ms" % (vec, py))
+    else:
+        log("prescan: pure Python %.1f ms (NumPy is not installed)" % py)
+    (plain, res1) = timeit(lambda: [textile.textile(t) for t in texts])
+    (batch, res2) = timeit(textile.textile_many, texts)
+    if res1 != res2:
+        log("FAILED: textile_many() output differs from textile()")
+        sys.exit(1)
+    log("textile() %.1f ms, textile_many() %.1f ms (%.2fx)" % (plain, batch, plain / batch))
+
+def mixed_doc(size):
+    chunk = "\n\n".join([
+        "h2. A heading",
+        "A paragraph with *strong* text, a \"link\":http://example.com and some more words.",
+        "* one\n* two\n* three",
+        "bc. int f(int x) {\n    return x * 2;\n}",
+        "|a|b|c|\n|1|2|3|",
+        "p(note). Another paragraph, with a class.",
+    ])
+    return "\n\n".join([chunk] * (size // (len(chunk) + 2)))
+
+def block_bytes(block, source):
+    size = sys.getsizeof(block)
+    if block.params:
+        size += sys.getsizeof(block.params)
+        for pair in block.params:
+            size += sys.getsizeof(pair)
+    if block.spans is not None:
+        size += sys.getsizeof(block.spans)
+    return size
+
+# What a block took when split_text() returned [function, captures]
+# pairs, with the captures holding a copy of the text.
+def copied_block_bytes(block, source):
+    captures = block.captures(source)
+    size = sys.getsizeof([None, None]) + sys.getsizeof(captures)
+    for value in captures.values():
+        size += sys.getsizeof(value)
+    return size
+
+RSS_SCRIPT = """
+import sys, resource, textile_bench, textile_equiv
+engine = textile_equiv.load_engine(sys.argv[1])
+text = textile_bench.mixed_doc(int(sys.argv[2]))
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+engine.textile(text)
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+sys.stdout.write("%d %d" % (before, after))
+"""
+
+def peak_rss_kb(engine, size):
+    (out, err) = run_python(["-c", RSS_SCRIPT, engine, str(size)])
+    (before, after) = [int(x) for x in out.split()]
+    return (before, after)
+
+def bench_blocks(args):
+    import textile
+    mb = 4.0
+    if args:
+        mb = float(args[0])
+    engines = ["textile"] + args[1:]
+    size = int(mb * 1024 * 1024)
+    text = mixed_doc(size)
+    t = textile.Textiler(text)
+    t.preprocess()
+    t._links = t.grab_links()
+    t.head_offset = 0
+    blocks = t.split_text()
+    compact = sum([block_bytes(b, t.text) for b in blocks])
+    copied = sum([copied_block_bytes(b, t.text) for b in blocks])
+    n = len(blocks)
+    log("%d bytes, %d blocks" % (len(text), n))
+    log("  offset records: %8d bytes (%.0f per block)" % (compact, compact / float(n)))
+    log("  copied text:    %8d bytes (%.0f per block)" % (copied, copied / float(n)))
+    for engine in engines:
+        (before, after) = peak_rss_kb(engine, size)
+        log("  %s: peak RSS %d KB, %d KB more than before rendering" % (engine, after, after - before))
+
+def bench_spans(args):
+    import textile
+    class CountingTextiler(textile.Textiler):
+        counts = [0, 0]
+        def format_spans(self, text):
+            html = textile.Textiler.format_spans(self, text)
+            CountingTextiler.counts[html is None] += 1
+            return html
+    texts = [read(f) for f in book_pages()] + [read(f) for f in notion_pages(50)]
+    # compile the regular expressions first
+    textile.textile("tell me about textile.", inline_engine="spans")
+    (rewrite, res1) = timeit(lambda: [textile.textile(t) for t in texts])
+    (spans, res2) = timeit(lambda: [CountingTextiler(t).process(inline_engine="spans") for t in texts])
+    if res1 != res2:
+        log("FAILED: the spans engine gives a different output")
+        sys.exit(1)
+    (done, fallback) = CountingTextiler.counts
+    log("%d documents: rewrite %.1f ms, spans %.1f ms (%.2fx)" % (len(texts), rewrite, spans, rewrite / spans))
+    log("  %d texts formatted in one pass, %d fell back to the phases" % (done, fallback))
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+def bench_parallel(args):
+    import textile
+    mb = 4.0
+    if args:
+        mb = float(args[0])
+    counts = [2, 4]
+    if len(args) > 1:
+        counts = [int(n) for n in args[1:]]
+    text = mixed_doc(int(mb * 1024 * 1024))
+    log("%d bytes, %d CPUs" % (len(text), cpu_count()))
+    (serial, res1) = timeit(textile.textile, text)
+    log("  serial:    %8.1f ms" % serial)
+    for n in counts:
+        (ms, res2) = timeit(lambda: textile.textile(text, workers=n))
+        if res1 != res2:
+            log("FAILED: output with %d workers differs from the serial one" % n)
+            sys.exit(1)
+        log("  %d workers: %8.1f ms (%.2fx)" % (n, ms, serial / ms))
+
+def bench_excerpt(args):
+    import textile
+    count = 2
+    if args:
+        count = int(args[0])
+    # the notion_cache pages are a single block each, so only the book
+    texts = [read(f) for f in book_pages()]
+    (full, res1) = timeit(lambda: [textile.textile(t) for t in texts])
+    (part, res2) = timeit(lambda: [textile.textile_excerpt(t, count) for t in texts])
+    # asking for more blocks than there are must give the whole page
+    for (text, html) in zip(texts, res1):
+        if textile.textile_excerpt(text, len(text) + 1) != html:
+            log("FAILED: a full excerpt differs from textile()")
+            sys.exit(1)
+    log("%d pages: textile() %.1f ms, textile_excerpt(%d blocks) %.1f ms (%.2fx)" % (len(texts), full, count, part, full / part))
+    log("  %d bytes of HTML instead of %d" % (sum(map(len, res2)), sum(map(len, res1))))
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def bench_async(args):
+    if sys.version_info < (3, 7):
+        log("needs Python 3.7 or later")
+        return
+    import asyncio, textile, textile_async
+    n = 400
+    concurrency = 16
+    if args:
+        n = int(args[0])
+    if len(args) > 1:
+        concurrency = int(args[1])
+    # mostly small pages with a big one now and then
+    big = mixed_doc(256 * 1024)
+    texts = []
+    for i in range(n):
+        if i % 20 == 0:
+            texts.append(big)
+        else:
+            texts.append("h2. Item %d\n\nSome *text* for item %d." % (i, i))
+    expected = [textile.textile(t) for t in texts]
+
+    log("%d requests, %d at a time, 1 in 20 is %d bytes" % (n, concurrency, len(big)))
+    renderers = [textile_async.InlineRenderer(), textile_async.AsyncRenderer(4, "thread"), textile_async.AsyncRenderer(cpu_count(), "process")]
+    for renderer in renderers:
+        (total, latencies, lag, results) = asyncio.run(textile_async.run_clients(renderer, texts, concurrency))
+        if results != expected:
+            log("FAILED: %s output differs from textile()" % renderer.kind)
+            sys.exit(1)
+        log("  %-8s %8.1f ms, latency p50 %7.1f ms, p99 %7.1f ms, max %7.1f ms, loop stalled up to %7.1f ms, %d waiting at most" % (
+            renderer.kind, total, percentile(latencies, 50), percentile(latencies, 99), max(latencies), lag, renderer.metrics()["max_queued"]))
+        renderer.close()
+
+def url_dense_doc(size):
+    words = ["see", "http://example.com/a/b?c=1", "and", "https://www.example.org:8080/x.html,",
+             "or", "mail", "someone@example.com", "(ftp://ftp.example.net/pub)", "text", "mailto:x+y@example.co.uk."]
+    line = " ".join(words)
+    return "\n".join([line] * (size // (len(line) + 1)))
+
+def bench_linkify(args):
+    import re, textile
+    kb = 256
+    if args:
+        kb = int(args[0])
+    url = textile._compile(textile._glyph_url, re.VERBOSE)
+    email = textile._compile(textile._glyph_email, re.VERBOSE)
+    def regex_linkify(text):
+        text = url.sub(r'''<a href="\1">\1</a>''', text)
+        return email.sub(r'''<a href="mailto:\1">\1</a>''', text)
+    def scan_linkify(text):
+        return textile._linkify_emails(textile._linkify_urls(text))
+    texts = [("URL-dense", url_dense_doc(kb * 1024)),
+             ("book", "\n".join([textile._text(read(f)) for f in book_pages()]))]
+    for (name, text) in texts:
+        (old, res1) = timeit(regex_linkify, text)
+        (new, res2) = timeit(scan_linkify, text)
+        if res1 != res2:
+            log("FAILED: the linkifier differs from the regular expressions on %s text" % name)
+            sys.exit(1)
+        log("%-9s %7d bytes: regex %7.1f ms, scanner %7.1f ms (%.2fx)" % (name, len(text), old, new, old / new))
+
+def bench_utf8(args):
+    import textile
+    try:
+        from HTMLParser import HTMLParser
+        unescape = HTMLParser().unescape
+    except ImportError:
+        from html import unescape
+    modes = [("ascii", {}), ("utf-8", {"output": "utf-8"}), ("utf-8 literal", {"output": "utf-8", "literal": 1})]
+    totals = [0] * len(modes)
+    log("%-28s %10s %10s %10s %7s" % ("page", "ascii", "utf-8", "literal", "saved"))
+    for f in book_pages():
+        text = read(f)
+        sizes = []
+        pages = []
+        for (i, (name, kwargs)) in enumerate(modes):
+            html = encoded(textile.textile(text, **kwargs), kwargs.get("output", "ascii"))
+            pages.append(unescape(html.decode(kwargs.get("output", "ascii"))))
+            sizes.append(len(html))
+            totals[i] += len(html)
+        if pages[0] != pages[2]:
+            log("FAILED: %s reads differently with literal characters" % f)
+            sys.exit(1)
+        log("%-28s %10d %10d %10d %6.1f%%" % (os.path.basename(f), sizes[0], sizes[1], sizes[2], 100.0 - sizes[2] * 100.0 / sizes[0]))
+    log("%-28s %10d %10d %10d %6.1f%%" % ("total", totals[0], totals[1], totals[2], 100.0 - totals[2] * 100.0 / totals[0]))
+
+def bench_toc(args):
+    import textile
+    texts = [read(f) for f in book_pages()]
+    # warm up the regular expression cache first
+    [textile.textile(t, toc=1) for t in texts]
+    (plain, res1) = timeit(lambda: [textile.textile(t) for t in texts])
+    (with_toc, res2) = timeit(lambda: [textile.textile(t, toc=1) for t in texts])
+    for (html1, html2) in zip(res1, res2):
+        if len(textile.check_xhtml(html2)) > len(textile.check_xhtml(html1)):
+            log("FAILED: the ids or the table of contents made the XHTML invalid")
+            sys.exit(1)
+    entries = sum([len(html.toc) for html in res2])
+    # the sanitizer can return unicode on Python 2
+    text = 'h1. x\n\n<a title="&#8217;">y</a>'
+    html = textile.textile(text, sanitize=1, toc=1)
+    if html.replace(' id="x"', '') != textile.textile(text, sanitize=1) or [t[1] for t in html.toc] != ['x']:
+        log("FAILED: toc=1 changed sanitized output")
+        sys.exit(1)
+    log("%d pages, %d headers: %.1f ms, %.1f ms with toc=1 (%+.1f%%)" % (len(texts), entries, plain, with_toc, (with_toc - plain) * 100.0 / plain))
+
+def bench_plain(args):
+    import re, textile
+    try:
+        from HTMLParser import HTMLParser
+        unescape = HTMLParser().unescape
+    except ImportError:
+        from html import unescape
+    limit = 100
+    if args:
+        limit = int(args[0])
+    texts = [read(f) for f in book_pages()] + [read(f) for f in notion_pages(limit)]
+    tags = re.compile(r"<[^<>]*>")
+    def html_then_strip():
+        return [unescape(tags.sub("", encoded(textile.textile(t, output="utf-8"), "utf-8").decode("utf-8"))) for t in texts]
+    (html, res1) = timeit(html_then_strip)
+    (plain, res2) = timeit(lambda: [textile.textile_plain(t, output="utf-8") for t in texts])
+    log("%d pages: textile() and stripping the tags %.1f ms, textile_plain() %.1f ms (%.2fx)" % (len(texts), html, plain, html / plain))
+    log("  %d characters of text vs %d" % (sum(map(len, res2)), sum(map(len, res1))))
+    for (text, expected) in [(b"a < b and c > d", b"a < b and c > d"),
+                             (b"h1. Caf\xc3\xa9 &#233; &#xe9; &copy; &amp;", b"Caf\xc3\xa9 \xc3\xa9 \xc3\xa9 \xc2\xa9 &")]:
+        res = encoded(textile.textile_plain(text, encoding="utf-8"), "utf-8")
+        if res != expected:
+            log("FAILED: textile_plain(%r) gave %r" % (text, res))
+            sys.exit(1)
+
+def bench_memory(args):
+    if sys.version_info < (3, 9):
+        log("needs Python 3.9 or later")
+        return
+    import textile
+    limit = 20
+    if args:
+        limit = int(args[0])
+    texts = [read(f) for f in book_pages()] + [read(f) for f in notion_pages(limit)]
+    texts.append(mixed_doc(1024 * 1024))
+    (plain, expected) = timeit(lambda: [textile.textile(t) for t in texts])
+    profile = textile.MemoryProfile()
+    profile.start()
+    (traced, res) = timeit(lambda: [textile.textile_memory(t, profile) for t in texts])
+    profile.stop()
+    if res != expected:
+        log("FAILED: textile_memory() output differs from textile()")
+        sys.exit(1)
+    log("%d pages (%d bytes): %.1f ms, %.1f ms traced" % (len(texts), sum(map(len, texts)), plain, traced))
+    sys.stdout.write(profile.report())
+
+# Synthetic blocks for the lint command, each slow (or not) for one
+# reason textile_lint.py knows about.
+LINT_CASES = [
+    ("1500 links", "p. " + " ".join(['"link %d":http://example.com/%d' % (i, i) for i in range(1500)])),
+    ("300 images", "p. " + " ".join(["!img%d.png!" % i for i in range(300)])),
+    ("1000 images", "p. " + " ".join(["!img%d.png!" % i for i in range(1000)])),
+    ("2000 list items", "\n".join(["* item %d" % i for i in range(2000)])),
+    ("3000 list items", "\n".join(["* item number %d with some words" % i for i in range(3000)])),
+    ("18KB of {a}[b](c)", "p. " + "{a}[b](c)" * 2000),
+    ("500 table rows", "\n".join(["|a%d|b|c|" % i for i in range(500)])),
+    ("2000 table rows", "\n".join(["|a|b|c|" for i in range(2000)])),
+    ("'Wow! ' x 4000", "p. " + "Wow! " * 4000),
+    ("1000 quick tags", "p. " + " ".join([("*b%d*", "_i%d_")[i % 2] % i for i in range(1000)])),
+    ("3000 quick tags", "p. " + " ".join([("*b%d*", "_i%d_")[i % 2] % i for i in range(3000)])),
+    ("2000 unclosed *", "p. " + " ".join(["*x" for i in range(2000)])),
+    ("100KB of prose", "p. " + "Some ordinary words, and more. " * 3300),
+]
+# how far off the estimate of a case may be, either way
+LINT_FACTOR = 3.0
+
+def bench_lint(args):
+    import textile, textile_lint
+    failed = []
+    for (name, text) in LINT_CASES:
+        [(line, kind, block)] = list(textile_lint.blocks(text))
+        f = textile_lint.features(kind, block)
+        (est, worst) = textile_lint.estimate(f)
+        textile.textile(text)
+        ms = min([timeit(textile.textile, text)[0] for i in range(3)])
+        log("  %-20s estimated %8.1f ms, measured %8.1f ms (%s)" % (name, est, ms, textile_lint.describe(kind, f)))
+        if est > ms * LINT_FACTOR or est * LINT_FACTOR < ms:
+            failed.append(name)
+    if failed:
+        log("FAILED: estimates more than %gx off for %s" % (LINT_FACTOR, ", ".join(failed)))
+        sys.exit(1)
+
+# Inputs for the scaling command: a function from a number of units
+# to a document with that many of one construct.
+SCALING_INPUTS = [
+    ("links", lambda n: "p. " + " ".join(['"link %d":http://example.com/%d' % (i, i) for i in range(n)])),
+    ("images", lambda n: "p. " + " ".join(["!img%d.png!" % i for i in range(n)])),
+    ("acronyms", lambda n: "p. " + " ".join(["ABC%d(A b c)" % i for i in range(n)])),
+    ("footnotes", lambda n: "p. " + " ".join(["word[%d]" % (i + 1) for i in range(n)]) + "".join(["\n\nfn%d. Note %d." % (i + 1, i) for i in range(n)])),
+    ("list length", lambda n: "\n".join(["* item %d" % i for i in range(n)])),
+    ("list depth", lambda n: "\n".join(["#" * (i + 1) + " item" for i in range(n)])),
+    ("table rows", lambda n: "\n".join(["|a%d|b|c|" % i for i in range(n)])),
+    ("qtag density", lambda n: "p. " + " ".join([("*b%d*", "_i%d_", "@c%d@", "-d%d-")[i % 4] % i for i in range(n)])),
+    ("extended", lambda n: "bc.. " + "\n\n".join(["int x%d = %d;" % (i, i) for i in range(n)]) + "\n\np. end"),
+]
+SCALING_SIZES = [10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000]
+# once a size takes longer than this, the bigger ones are skipped
+SCALING_LIMIT_MS = 2000.0
+# how much steeper than n log n a curve, or any step of it between
+# two sizes, may be before it's flagged
+SCALING_SLACK = 0.15
+
+def time_render(text):
+    import textile
+    # the first render compiles the expressions the construct needs
+    textile.textile(text)
+    total = 0.0
+    runs = 0
+    while total < 50.0:
+        (ms, res) = timeit(textile.textile, text)
+        total += ms
+        runs += 1
+    return total / runs
+
+def loglog_slope(points):
+    xs = [math.log(x) for (x, y) in points]
+    ys = [math.log(y) for (x, y) in points]
+    mx = sum(xs) / len(xs)
+    my = sum(ys) / len(ys)
+    return sum([(x - mx) * (y - my) for (x, y) in zip(xs, ys)]) / sum([(x - mx) ** 2 for x in xs])
+
+def nlogn_slope(a, b):
+    return math.log(b * math.log(b) / (a * math.log(a))) / math.log(b / float(a))
+
+def bench_scaling(args):
+    import textile
+    max_units = SCALING_SIZES[-1]
+    if args:
+        max_units = int(args[0])
+    names = [name for (name, make) in SCALING_INPUTS]
+    if len(args) > 1:
+        names = args[1].split(",")
+    textile.textile("tell me about textile.")
+    flagged = []
+    failed = []
+    for (name, make) in SCALING_INPUTS:
+        if name not in names:
+            continue
+        points = []
+        for n in [n for n in SCALING_SIZES if n <= max_units]:
+            text = make(n)
+            try:
+                ms = time_render(text)
+            except Exception:
+                e = sys.exc_info()[1]
+                log("  %-12s %7d units %9d bytes fails: %s" % (name, n, len(text), e.__class__.__name__))
+                failed.append("%s fails at %d units (%s)" % (name, n, e.__class__.__name__))
+                break
+            log("  %-12s %7d units %9d bytes %10.2f ms" % (name, n, len(text), ms))
+            # time below a millisecond is mostly noise
+            if ms >= 1.0:
+                points.append((len(text), ms))
+            if ms > SCALING_LIMIT_MS:
+                break
+        if len(points) < 3:
+            log("%s: not enough sizes over 1 ms to fit" % name)
+            continue
+        # fitted against the size in bytes, since the units of some
+        # constructs (list depth) don't all have the same size
+        slope = loglog_slope(points)
+        limit = nlogn_slope(points[0][0], points[-1][0]) + SCALING_SLACK
+        # a fit over the whole range hides a curve that only bends
+        # up at the big sizes, so each step is checked on its own
+        steps = [(loglog_slope([a, b]), nlogn_slope(a[0], b[0]) + SCALING_SLACK, b) for (a, b) in zip(points, points[1:])]
+        (step, step_limit, at) = max(steps, key=lambda s: s[0] - s[1])
+        verdict = "ok"
+        if slope > limit or step > step_limit:
+            verdict = "FASTER THAN n log n"
+            flagged.append(name)
+        log("%s: time grows as bytes^%.2f (n log n would be up to ^%.2f), steepest step ^%.2f up to %d bytes (up to ^%.2f): %s" % (name, slope, limit, step, at[0], step_limit, verdict))
+    if flagged or failed:
+        log("FAILED: %s" % ", ".join(flagged + failed))
+        sys.exit(1)
+
+# The runtimes command runs this in each interpreter. It prints, as
+# its last line: ms to render the pages, ms to build the book with
+# rebuild.py, and a hash of the output of each.
+def runtime_child(limit):
+    import hashlib, tempfile, shutil
+    import textile, rebuild
+    texts = [read(f) for f in book_pages()] + [read(f) for f in notion_pages(limit)]
+    texts.append(mixed_doc(1024 * 1024))
+    textile.textile("tell me about textile.")
+    render = None
+    for i in range(3):
+        (ms, pages) = timeit(lambda: [textile.textile(t) for t in texts])
+        render = min(render or ms, ms)
+    h = hashlib.sha1()
+    for html in pages:
+        h.update(encoded(html))
+    outdir = tempfile.mkdtemp()
+    try:
+        rebuild.OUTDIR = outdir
+        rebuild.OUTSRCDIR = os.path.join(outdir, "src")
+        (build, res) = timeit(rebuild.main)
+        b = hashlib.sha1()
+        for (dirpath, dirnames, filenames) in os.walk(outdir):
+            dirnames.sort()
+            for f in sorted(filenames):
+                path = os.path.join(dirpath, f)
+                b.update(path[len(outdir):].encode("utf-8"))
+                b.update(read(path))
+    finally:
+        shutil.rmtree(outdir)
+    log("%.1f %.1f %s %s" % (render, build, h.hexdigest(), b.hexdigest()))
+
+def bench_runtimes(args):
+    limit = 20
+    if args and args[0].isdigit():
+        limit = int(args[0])
+        args = args[1:]
+    pythons = args or ["python2", "python3"]
+    code = "import textile_bench; textile_bench.runtime_child(%d)" % limit
+    results = []
+    for python in pythons:
+        proc = subprocess.Popen([python, "-c", code], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=child_env(), cwd=SCRIPT_DIR)
+        (out, err) = proc.communicate()
+        if 0 != proc.returncode:
+            raise Exception("'%s' failed:\n%s" % (python, err.decode("utf-8", "replace")))
+        proc = subprocess.Popen([python, "-c", "import platform; print(platform.python_version())"], stdout=subprocess.PIPE)
+        version = proc.communicate()[0].decode("ascii").strip()
+        (render, build, pages, book) = out.decode("ascii").strip().split("\n")[-1].split()
+        results.append((python, version, float(render), float(build), pages, book))
+    (base_render, base_build) = (results[0][2], results[0][3])
+    log("render: the book, %d notion pages and 1MB of mixed markup; build: rebuild.py into a temporary directory" % limit)
+    for (python, version, render, build, pages, book) in results:
+        log("  %-10s %-8s render %8.1f ms (%.2fx)  build %8.1f ms (%.2fx)" % (python, version, render, base_render / render, build, base_build / build))
+    if len(set([r[4] for r in results])) > 1:
+        log("FAILED: the interpreters render different pages")
+        sys.exit(1)
+    if len(set([r[5] for r in results])) > 1:
+        log("FAILED: the interpreters build a different book")
+        sys.exit(1)
+
+# How long "rebuild.py --incremental" may take when nothing changed.
+INCREMENTAL_BUDGET_MS = 20.0
+
+def quiet(func, *args):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        return func(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def edit_file(path, func):
+    fo = open(path, "rb")
+    lines = fo.read().split(b"\n")
+    fo.close()
+    func(lines)
+    fo = open(path, "wb")
+    fo.write(b"\n".join(lines))
+    fo.close()
+
+def output_files(outdir):
+    res = {}
+    for (dirpath, dirnames, filenames) in os.walk(outdir):
+        for f in filenames:
+            path = os.path.join(dirpath, f)
+            res[path[len(outdir):]] = read(path)
+    return res
+
+def bench_incremental(args):
+    import tempfile, shutil
+    import rebuild
+    tmpdir = tempfile.mkdtemp()
+    try:
+        shutil.copytree(rebuild.TXTSRCDIR, os.path.join(tmpdir, "txtsrc"))
+        shutil.copytree(rebuild.SRCDIR, os.path.join(tmpdir, "src"))
+        rebuild.TXTSRCDIR = os.path.join(tmpdir, "txtsrc")
+        rebuild.SRCDIR = os.path.join(tmpdir, "src")
+        rebuild.STATEFILE = os.path.join(tmpdir, "rebuild_state")
+        def build(outdir, incremental):
+            rebuild.OUTDIR = outdir
+            rebuild.OUTSRCDIR = os.path.join(outdir, "src")
+            rebuild.g_incremental = incremental
+            if not os.path.isdir(outdir):
+                os.mkdir(outdir)
+            return timeit(quiet, rebuild.main)
+        out = os.path.join(tmpdir, "out")
+        # (what, how to change the sources, how many files it should rebuild)
+        npages = len([f for f in os.listdir(rebuild.TXTSRCDIR) if rebuild.issrcfile(f)])
+        include = os.path.join(rebuild.SRCDIR, "temp_alloc.h")
+        steps = [
+            ("full build", None, None),
+            ("no-op", None, 0),
+            ("one page edited", lambda: edit_file(os.path.join(rebuild.TXTSRCDIR, "wip.textile"), lambda lines: lines.append(b"One more line.")), 1),
+            ("an included file, outside the lines", lambda: edit_file(include, lambda lines: lines.append(b"// more")), 1),
+            ("an included file, inside the lines", lambda: edit_file(include, lambda lines: lines.insert(5, b"// more")), 2),
+            ("_header.html edited", lambda: edit_file(os.path.join(rebuild.TXTSRCDIR, "_header.html"), lambda lines: lines.append(b"")), npages),
+            ("no-op", None, 0),
+        ]
+        failed = []
+        for (what, change, expected) in steps:
+            if change is not None:
+                change()
+            (ms, built) = build(out, True)
+            log("  %-40s %8.1f ms, %2d files rebuilt" % (what, ms, built))
+            if expected is not None and built != expected:
+                failed.append("%s rebuilt %d files instead of %d" % (what, built, expected))
+            if what == "no-op" and ms > INCREMENTAL_BUDGET_MS:
+                failed.append("a no-op build took %.1f ms, budget %.1f ms" % (ms, INCREMENTAL_BUDGET_MS))
+        full = os.path.join(tmpdir, "full")
+        build(full, False)
+        if output_files(out) != output_files(full):
+            failed.append("the output differs from a full build")
+        if failed:
+            log("FAILED: %s" % ", ".join(failed))
+            sys.exit(1)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_jobs(args):
+    import tempfile, shutil
+    import rebuild
+    counts = sorted(set([1, 2, 4, cpu_count()]))
+    if args:
+        counts = [int(n) for n in args]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        log("building the book, %d CPUs" % cpu_count())
+        outputs = None
+        serial = None
+        for n in counts:
+            outdir = os.path.join(tmpdir, "out%d" % n)
+            os.mkdir(outdir)
+            rebuild.OUTDIR = outdir
+            rebuild.OUTSRCDIR = os.path.join(outdir, "src")
+            rebuild.g_jobs = n
+            (ms, built) = timeit(quiet, rebuild.main)
+            res = output_files(outdir)
+            if outputs is None:
+                (outputs, serial) = (res, ms)
+            elif res != outputs:
+                log("FAILED: the output with -j %d differs from the one with -j %d" % (n, counts[0]))
+                sys.exit(1)
+            log("  -j %-3d %8.1f ms (%.2fx), %d files" % (n, ms, serial / ms, built))
+    finally:
+        shutil.rmtree(tmpdir)
+
+COMMANDS = [
+    ("importtime", bench_importtime, "[runs] - time 'import textile', fail if over budget"),
+    ("color", bench_color, "[blocks] - colorizing Python code, cold vs cached"),
+    ("validate", bench_validate, "- cost of the built-in XHTML checker vs rendering"),
+    ("extended", bench_extended, "[MB] - a big extended bc.. block, halving the size down to 64KB"),
+    ("renderer", bench_renderer, "[docs] - textile() vs a renderer from make_renderer() on small documents"),
+    ("prescan", bench_prescan, "- how many inline phases format() skips on the book's pages"),
+    ("batch", bench_batch, "[notion files] - textile_many() vs textile() on txtsrc and notion_cache"),
+    ("blocks", bench_blocks, "[MB] [engines] - memory of the block records and peak RSS, e.g. blocks 4 git:HEAD~1"),
+    ("spans", bench_spans, "- the 'spans' inline engine vs 'rewrite' on txtsrc and notion_cache"),
+    ("parallel", bench_parallel, "[MB] [workers ...] - rendering one big document on a process pool"),
+    ("reuse", bench_reuse, "[count] - Textiler.render() and TextilerPool vs textile() on small documents"),
+    ("excerpt", bench_excerpt, "[count] - the first blocks of each book page with textile_excerpt() vs textile()"),
+    ("async", bench_async, "[requests] [concurrency] - textile_async.py under concurrent requests: tail latency and event loop stalls (Python 3)"),
+    ("linkify", bench_linkify, "[KB] - glyphs() URL and email linkifier vs the regular expressions it replaces"),
+    ("utf8", bench_utf8, "- page sizes with output='utf-8' and literal characters vs the default ASCII entities"),
+    ("toc", bench_toc, "- rendering the book with header ids and a table of contents (toc=1)"),
+    ("plain", bench_plain, "[notion pages] - textile_plain() vs textile() and stripping the tags, for search indexing"),
+    ("memory", bench_memory, "[notion pages] - memory left allocated and peak memory of each phase and block type (Python 3.9)"),
+    ("lint", bench_lint, "- textile_lint.py estimates against measured times on synthetic blocks, fail if one is more than 3x off"),
+    ("scaling", bench_scaling, "[max units] [constructs] - time against input size for each construct, fail if it grows faster than n log n"),
+    ("incremental", bench_incremental, "- rebuild.py --incremental after no change and after edits, fail if it rebuilds too much or too little"),
+    ("jobs", bench_jobs, "[workers ...] - rebuild.py -j N: building the book against the number of workers"),
+    ("runtimes", bench_runtimes, "[notion pages] [python ...] - rendering and building the book on each interpreter (default: python2 python3), fail if the output differs"),
+]
+
+def usage():
+    log("usage: %s <command> [args]" % os.path.basename(sys.argv[0]))
+    for (name, func, desc) in COMMANDS:
+        log("  %s %s" % (name, desc))
+    sys.exit(1)
+
+def main():
+    if len(sys.argv) < 2:
+        usage()
+    for (name, func, desc) in COMMANDS:
+        if name == sys.argv[1]:
+            func(sys.argv[2:])
+            return
+    usage()
+
+if __name__ == "__main__":
+    main()
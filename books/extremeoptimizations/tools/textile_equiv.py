@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+# Checks that a candidate textile engine produces byte-identical
+# output to a reference engine, and how much faster (or slower) it is.
+#
+# Usage: textile_equiv.py [options]
+#   -r ENGINE     reference engine (default: git:HEAD)
+#   -c ENGINE     candidate engine (default: textile, i.e. the working copy)
+#   -s SOURCES    comma-separated corpus sources (default: txtsrc,notion,about,random)
+#   -o NAME=VAL   extra textile() option for the candidate only (repeatable)
+#   -O NAME=VAL   textile() option for both engines (repeatable)
+#   -n COUNT      number of random documents (default: 2000)
+#   --seed N      seed for the random documents (default: 1)
+#   --limit N     only use the first N notion_cache files
+#   --show N      show details for the first N differences (default: 5)
+#   -v            print the speed ratio of every document
+#
+# An ENGINE is one of:
+#   textile       textile.py from this directory
+#   file:PATH     any textile.py on disk
+#   git:REV       textile.py as of a git revision, e.g. git:HEAD~3
+#   py:PYTHON[:ENGINE]
+#                 ENGINE (default: textile) run by another interpreter, e.g.
+#                 py:python3 to check that Python 3 renders what Python 2 does
+#
+# A py: engine renders in a child process, which gets each document
+# as bytes. Output that isn't bytes is encoded with the output codec
+# on both sides, so two interpreters can be compared byte for byte.
+#
+# Exits with 1 if any document renders differently.
+
+import sys, os, os.path, subprocess, tempfile, shutil, random, time, ast
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+BASE_DIR = os.path.realpath(os.path.join(SCRIPT_DIR, ".."))
+TXTSRCDIR = os.path.join(BASE_DIR, "txtsrc")
+NOTIONDIR = os.path.realpath(os.path.join(BASE_DIR, "..", "..", "notion_cache"))
+
+SOURCES = ["txtsrc", "notion", "about", "random"]
+
+# how many bytes to show around the first difference
+CONTEXT = 40
+
+def log(txt):
+    sys.stdout.write(txt + "\n")
+    sys.stdout.flush()
+
+def read(path):
+    fo = open(path, "rb")
+    d = fo.read()
+    fo.close()
+    return d
+
+def load_source(name, path):
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source(name, path)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def git_show(rev):
+    out = subprocess.check_output(["git", "rev-parse", "--show-prefix"], cwd=SCRIPT_DIR)
+    prefix = out.decode("utf-8").strip()
+    return subprocess.check_output(["git", "show", "%s:%stextile.py" % (rev, prefix)], cwd=SCRIPT_DIR)
+
+def write_message(fo, data):
+    fo.write(("%d\n" % len(data)).encode("ascii"))
+    fo.write(data)
+    fo.flush()
+
+def read_message(fo):
+    line = fo.readline()
+    if not line:
+        return None
+    return fo.read(int(line))
+
+class ChildEngine(object):
+    """An engine running in another interpreter, see serve()."""
+    def __init__(self, python, spec):
+        self.python = python
+        self.spec = spec
+        # about_docs() needs the module itself
+        self.module = load_engine(spec)
+        self.__doc__ = self.module.__doc__
+        self.Textiler = self.module.Textiler
+        cmd = [python, os.path.realpath(__file__), "--serve", spec]
+        self.child = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def render(self, text, kwargs):
+        write_message(self.child.stdin, repr(kwargs).encode("ascii"))
+        write_message(self.child.stdin, text)
+        elapsed = float(read_message(self.child.stdout))
+        return (read_message(self.child.stdout), elapsed)
+
+    def textile(self, text, **kwargs):
+        return self.render(text, kwargs)[0]
+
+# The child side of a py: engine: renders what comes on stdin until
+# it's closed.
+def serve(spec):
+    module = load_engine(spec)
+    stdin = getattr(sys.stdin, "buffer", sys.stdin)
+    stdout = getattr(sys.stdout, "buffer", sys.stdout)
+    while True:
+        kwargs = read_message(stdin)
+        if kwargs is None:
+            break
+        kwargs = ast.literal_eval(kwargs.decode("ascii"))
+        (res, elapsed) = render(module, read_message(stdin), kwargs)
+        write_message(stdout, ("%r" % elapsed).encode("ascii"))
+        write_message(stdout, res)
+
+g_engine_no = 0
+def load_engine(spec):
+    global g_engine_no
+    g_engine_no += 1
+    name = "textile_engine_%d" % g_engine_no
+    if spec.startswith("py:"):
+        (python, sep, spec) = spec[len("py:"):].partition(":")
+        return ChildEngine(python, spec or "textile")
+    if spec == "textile":
+        return load_source(name, os.path.join(SCRIPT_DIR, "textile.py"))
+    if spec.startswith("file:"):
+        return load_source(name, spec[len("file:"):])
+    if spec.startswith("git:"):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "textile.py")
+            fo = open(path, "wb")
+            fo.write(git_show(spec[len("git:"):]))
+            fo.close()
+            return load_source(name, path)
+        finally:
+            shutil.rmtree(tmpdir)
+    raise Exception("unknown engine '%s'" % spec)
+
+def textile_files(dir, ext, limit=None):
+    if not os.path.isdir(dir):
+        return []
+    files = sorted([f for f in os.listdir(dir) if f.endswith(ext)])
+    if limit is not None:
+        files = files[:limit]
+    return [os.path.join(dir, f) for f in files]
+
+# The same texts about() renders: the part after '---' of the module
+# docstring and of every documented Textiler method.
+def about_docs(module):
+    docs = [("about:tell me", "tell me about textile.")]
+    items = [("module", module.__doc__)]
+    for name in sorted(dir(module.Textiler)):
+        attr = getattr(module.Textiler, name)
+        if not name.startswith("_") and callable(attr):
+            items.append((name, attr.__doc__))
+    for (name, doc) in items:
+        if not doc or "---" not in doc:
+            continue
+        doc = doc.split("---", 1)[1]
+        doc = "\n".join([line.strip() for line in doc.split("\n")])
+        docs.append(("about:" + name, doc))
+    return docs
+
+RANDOM_PIECES = [
+    "bc.. ", "pre.. ", "bq.. ", "bc. ", "p. ", "p(cls#id). ", "p{color:red}. ", "p[fr]. ",
+    "h1. ", "h2>. ", "h3(x). ", "fn1. ", "fn2. ", "# ", "## ", "* ", "** ", "#. ", "clear.",
+    "clear>.", "dl. ", "table. ", "|a|b|", "|_. h|", "|{color:red}. c|", "\n", "\n\n",
+    "\n \n", " \n\t\n\n", "\r\n", "\r", "  ", "text", "Word", "ABC(A b c)", " *b* ", " **bb** ",
+    " _i_ ", " __ii__ ", " ??cite?? ", " -del- ", " +ins+ ", " ^sup^ ", " ~sub~ ", " %span% ",
+    " @code@ ", "==raw==", "$x^2$", "\"link\":http://example.com/a?b=1", "\"t(title)\":/rel",
+    "[x]http://example.org", "\"ref\":x", "!img.png!", "!>img.png(alt)!:http://a.b/",
+    "http://bare.example.com/path", "mail@example.com", "it's", "\"quoted\"", "--", " - ",
+    "...", "(c)", "(tm)", "(r)", "10x20", "a[1]", "{cent}", "{C=}", "<div>", "</div>",
+    "<b>bold</b>", "<br>", "<pre>", "</pre>", "&", "&amp;", "\xe9", "\xb4",
+]
+
+def random_docs(count, seed):
+    rnd = random.Random(seed)
+    docs = []
+    for i in range(count):
+        n = rnd.randint(1, 40)
+        text = "".join([rnd.choice(RANDOM_PIECES) for j in range(n)])
+        docs.append(("random:%d:%d" % (seed, i), text))
+    return docs
+
+def corpus(sources, module, opts):
+    docs = []
+    if "txtsrc" in sources:
+        for f in textile_files(TXTSRCDIR, ".textile"):
+            docs.append(("txtsrc:" + os.path.basename(f), read(f)))
+    if "notion" in sources:
+        for f in textile_files(NOTIONDIR, ".txt", opts["limit"]):
+            docs.append(("notion:" + os.path.basename(f), read(f)))
+    if "about" in sources:
+        docs.extend(about_docs(module))
+    if "random" in sources:
+        docs.extend(random_docs(opts["count"], opts["seed"]))
+    return docs
+
+def render(module, text, kwargs):
+    if isinstance(module, ChildEngine):
+        return module.render(text, kwargs)
+    timer = time.time
+    start = timer()
+    try:
+        res = module.textile(text, **kwargs)
+    except Exception:
+        e = sys.exc_info()[1]
+        res = "EXCEPTION %s" % e.__class__.__name__
+    elapsed = timer() - start
+    # a str on Python 3 and, with sanitize, unicode on Python 2
+    if not isinstance(res, bytes):
+        res = res.encode(kwargs.get("output", module.OUTPUT), "xmlcharrefreplace")
+    return (res, elapsed)
+
+def first_difference(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+def show_difference(name, text, ref, cand):
+    pos = first_difference(ref, cand)
+    start = max(0, pos - CONTEXT)
+    log("DIFF %s: first difference at byte %d (reference %d bytes, candidate %d bytes)" % (name, pos, len(ref), len(cand)))
+    log("  reference: %r" % ref[start:pos + CONTEXT])
+    log("  candidate: %r" % cand[start:pos + CONTEXT])
+    if len(text) < 200:
+        log("  input:     %r" % text)
+
+def parse_value(s):
+    if s.isdigit():
+        return int(s)
+    if s in ("None", "True", "False"):
+        return {"None": None, "True": True, "False": False}[s]
+    return s
+
+def parse_option(s, kwargs):
+    if "=" not in s:
+        usage()
+    (name, value) = s.split("=", 1)
+    kwargs[name] = parse_value(value)
+
+def usage():
+    log("usage: %s [-r ENGINE] [-c ENGINE] [-s SOURCES] [-o NAME=VAL] [-O NAME=VAL] [-n COUNT] [--seed N] [--limit N] [--show N] [-v]" % os.path.basename(sys.argv[0]))
+    log("see the comment at the top of the script for details")
+    sys.exit(1)
+
+def parse_args(args):
+    opts = {"reference": "git:HEAD", "candidate": "textile", "sources": SOURCES, "count": 2000,
+            "seed": 1, "limit": None, "show": 5, "verbose": False, "ref_kwargs": {}, "cand_kwargs": {}}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == "-v":
+            opts["verbose"] = True
+            i += 1
+            continue
+        if i + 1 >= len(args):
+            usage()
+        val = args[i + 1]
+        if arg == "-r":
+            opts["reference"] = val
+        elif arg == "-c":
+            opts["candidate"] = val
+        elif arg == "-s":
+            opts["sources"] = val.split(",")
+            for s in opts["sources"]:
+                if s not in SOURCES:
+                    usage()
+        elif arg == "-o":
+            parse_option(val, opts["cand_kwargs"])
+        elif arg == "-O":
+            parse_option(val, opts["ref_kwargs"])
+            parse_option(val, opts["cand_kwargs"])
+        elif arg == "-n":
+            opts["count"] = int(val)
+        elif arg == "--seed":
+            opts["seed"] = int(val)
+        elif arg == "--limit":
+            opts["limit"] = int(val)
+        elif arg == "--show":
+            opts["show"] = int(val)
+        else:
+            usage()
+        i += 2
+    return opts
+
+def main():
+    if sys.argv[1:2] == ["--serve"] and len(sys.argv) == 3:
+        serve(sys.argv[2])
+        return
+    opts = parse_args(sys.argv[1:])
+    ref = load_engine(opts["reference"])
+    cand = load_engine(opts["candidate"])
+    docs = corpus(opts["sources"], ref, opts)
+    # compile the regular expressions before timing anything
+    for module in (ref, cand):
+        module.textile("tell me about textile.")
+    ndiffs = 0
+    ref_total = 0.0
+    cand_total = 0.0
+    ratios = []
+    for (name, text) in docs:
+        (ref_html, ref_time) = render(ref, text, opts["ref_kwargs"])
+        (cand_html, cand_time) = render(cand, text, opts["cand_kwargs"])
+        ref_total += ref_time
+        cand_total += cand_time
+        ratio = ref_time / max(cand_time, 1e-6)
+        ratios.append((ratio, name))
+        if opts["verbose"]:
+            log("%-50s %8.2f ms %8.2f ms %6.2fx" % (name, ref_time * 1000.0, cand_time * 1000.0, ratio))
+        if ref_html != cand_html:
+            ndiffs += 1
+            if ndiffs <= opts["show"]:
+                show_difference(name, text, ref_html, cand_html)
+    ratios.sort()
+    log("reference %s: %.1f ms" % (opts["reference"], ref_total * 1000.0))
+    log("candidate %s: %.1f ms (%.2fx)" % (opts["candidate"], cand_total * 1000.0, ref_total / max(cand_total, 1e-6)))
+    if ratios:
+        log("per document speed ratio: median %.2fx, slowest %.2fx (%s), fastest %.2fx (%s)" % (ratios[len(ratios) // 2][0], ratios[0][0], ratios[0][1], ratios[-1][0], ratios[-1][1]))
+    log("%d documents, %d differ" % (len(docs), ndiffs))
+    if ndiffs > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
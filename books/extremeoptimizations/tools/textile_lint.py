@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+# Finds blocks of textile source that will be slow to render, without
+# rendering them. Each block is split out the way textile.py does it
+# and its cost is estimated from a few things that are known to make
+# rendering slow: its size, links and images (every one rescans the
+# rest of the block), words starting with a quick tag character like
+# * or _ with no closing one soon after (the quick tag expressions
+# look for it up to the end of the line), runs of ([{ without spaces
+# and the items of lists and cells of tables.
+#
+# Usage: textile_lint.py [--budget MS] [-v] [dir or file ...]
+#   --budget MS   flag blocks estimated to take more than MS ms (default: 20)
+#   -v            print the estimate of every block
+# With no arguments, checks the book's txtsrc directory.
+# Exits with 1 if any block is over the budget.
+#
+# The weights were fitted against measured render times on one
+# machine, so take the numbers as an order of magnitude; what
+# matters is which blocks stand out.
+
+import sys, os, os.path, re, bisect
+import textile
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+BASE_DIR = os.path.realpath(os.path.join(SCRIPT_DIR, ".."))
+TXTSRCDIR = os.path.join(BASE_DIR, "txtsrc")
+
+BUDGET = 20.0
+
+# ms per unit of each feature
+W_SIZE = 3e-4       # per byte
+W_SIZE_PRE = 1e-5   # per byte of bc and pre blocks, which are only escaped
+W_LINKS = 1e-6      # per link, per byte of the block
+W_IMAGES = 7.5e-6     # per image, per byte of the block
+W_QTAGS = 6e-3      # per quick tag opener
+W_QTAG_SCAN = 4e-5  # per byte between a quick tag opener and its closer
+W_ATTRS = 2.5e-7    # per ( [ or {, per byte of the run it is in
+W_ITEMS = 6e-3      # per list item
+W_CELLS = 8e-3      # per table cell
+
+_qtag_opener = re.compile(r'''(?:^|[\s!-/:-@\[-`{-~])[*_?\-+~@%^]''')
+# a quick tag character that can close one: after something other
+# than whitespace, before whitespace, punctuation or the end of a line
+_qtag_closer = re.compile(r'''(?<=\S)[*_?\-+~@%^](?=$|[\s!-/:-@\[-`{-~])''', re.M)
+# the marker (and modifiers) at the start of a list item, which
+# is not a quick tag
+_list_marker = re.compile(r'''^[#*]+\S*\s+''')
+# an image the way textile.py finds them, so a ! in the text isn't
+# taken for one
+_image = textile._compile_res(textile._image_re, re.VERBOSE)
+
+def read(path):
+    fo = open(path, "rb")
+    d = fo.read()
+    fo.close()
+    return d
+
+def textile_files(path):
+    if os.path.isfile(path):
+        return [path]
+    files = []
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        dirnames.sort()
+        for f in sorted(filenames):
+            if f.endswith(".textile"):
+                files.append(os.path.join(dirpath, f))
+    return files
+
+def qtag_scan(text):
+    """Returns (quick tag openers, bytes from each to its closer).
+
+    The quick tag expressions look for the closer from the opener on
+    to the end of the line, so an opener that is closed right away is
+    cheap and one that isn't closed at all costs the rest of the line.
+    """
+    closers = {}
+    for m in _qtag_closer.finditer(text):
+        closers.setdefault(m.group(0), []).append(m.start())
+    openers = 0
+    scanned = 0
+    for m in _qtag_opener.finditer(text):
+        start = m.end()
+        end = text.find('\n', start)
+        if end < 0:
+            end = len(text)
+        positions = closers.get(text[start - 1], ())
+        i = bisect.bisect_left(positions, start)
+        if i < len(positions) and positions[i] < end:
+            end = positions[i]
+        openers += 1
+        scanned += end - start
+    return (openers, scanned)
+
+def features(kind, text):
+    """Returns {feature: count} for the text of one block."""
+    n = len(text)
+    if kind in ('bc', 'pre'):
+        return {'size': n, 'size weight': W_SIZE_PRE, 'links': 0, 'images': 0,
+                'qtags': 0, 'qtag bytes': 0, 'attrs': 0, 'list items': 0, 'cells': 0}
+    attrs = 0
+    for run in text.split():
+        k = run.count('(') + run.count('[') + run.count('{')
+        if k:
+            attrs += k * len(run)
+    items = 0
+    cells = 0
+    if kind in ('ol', 'ul'):
+        # the markers at the start of the items aren't quick tags
+        lines = text.split('\n')
+        items = len(lines)
+        text = '\n'.join([_list_marker.sub('', line, 1) for line in lines])
+    elif kind == 'table':
+        for line in text.split('\n'):
+            cells += max(line.count('|') - 1, 0)
+    (qtags, qtag_bytes) = qtag_scan(text)
+    return {
+        'size': n,
+        'size weight': W_SIZE,
+        'links': text.count('":') + text.count("':"),
+        'images': len(_image.findall(text)),
+        'qtags': qtags,
+        'qtag bytes': qtag_bytes,
+        'attrs': attrs,
+        'list items': items,
+        'cells': cells,
+    }
+
+def estimate(f):
+    """Returns (estimated ms, the feature to blame for it)."""
+    n = f['size']
+    size = n * f['size weight']
+    costs = [
+        (f['links'] * n * W_LINKS, 'links'),
+        (f['images'] * n * W_IMAGES, 'images'),
+        (f['qtags'] * W_QTAGS + f['qtag bytes'] * W_QTAG_SCAN, 'qtags'),
+        (f['attrs'] * W_ATTRS, 'attrs'),
+        (f['list items'] * W_ITEMS, 'list items'),
+        (f['cells'] * W_CELLS, 'cells'),
+    ]
+    total = size + sum([c for (c, name) in costs])
+    # every block costs something for its size, so only blame the
+    # size when nothing else stands out
+    (cost, worst) = max(costs)
+    if cost < total / 4:
+        worst = 'size'
+    return (total, worst)
+
+def blocks(text):
+    """Yields (line, kind, text) for each block of the source."""
+    t = textile.Textiler(text)
+    t.preprocess()
+    # preprocess() strips the text, keep track of the lines it removed
+    lead = text[:len(text) - len(text.lstrip())]
+    line = lead.count('\n') + 1
+    pos = 0
+    for block in t.split_text():
+        line += t.text.count('\n', pos, block.start)
+        pos = block.start
+        yield (line, block.kind, block.text(t.text))
+
+def describe(kind, f):
+    n = f['size']
+    if kind in ('ol', 'ul'):
+        return "%d list items" % f['list items']
+    if kind == 'table':
+        return "%d cells" % f['cells']
+    parts = ["%d bytes" % n]
+    for name in ('links', 'images', 'qtags'):
+        if f[name]:
+            parts.append("%d %s" % (f[name], name))
+    return ", ".join(parts)
+
+REASONS = {
+    'size': "large block",
+    'links': "many links",
+    'images': "many images",
+    'qtags': "many quick tag openers",
+    'attrs': "long runs of ([{ that stress the attribute lookahead",
+    'list items': "long list",
+    'cells': "large table",
+}
+
+def lint_file(path, budget, verbose):
+    nflagged = 0
+    for (line, kind, text) in blocks(textile._text(read(path))):
+        f = features(kind, text)
+        (ms, worst) = estimate(f)
+        if ms > budget:
+            nflagged += 1
+            print("%s:%d: %s block estimated at %.0f ms: %s (%s)" % (path, line, kind, ms, REASONS[worst], describe(kind, f)))
+        elif verbose:
+            print("%s:%d: %s block estimated at %.1f ms (%s)" % (path, line, kind, ms, describe(kind, f)))
+    return nflagged
+
+def usage():
+    print("usage: %s [--budget MS] [-v] [dir or file ...]" % os.path.basename(sys.argv[0]))
+    sys.exit(1)
+
+def main():
+    args = sys.argv[1:]
+    budget = BUDGET
+    verbose = False
+    paths = []
+    i = 0
+    while i < len(args):
+        if args[i] == "--budget":
+            if i + 1 >= len(args):
+                usage()
+            budget = float(args[i + 1])
+            i += 2
+            continue
+        if args[i] == "-v":
+            verbose = True
+        elif args[i].startswith("-"):
+            usage()
+        else:
+            paths.append(args[i])
+        i += 1
+    if not paths:
+        paths = [TXTSRCDIR]
+    nfiles = 0
+    nflagged = 0
+    for path in paths:
+        for f in textile_files(path):
+            nfiles += 1
+            nflagged += lint_file(f, budget, verbose)
+    print("%d files, %d blocks over %g ms" % (nfiles, nflagged, budget))
+    if nflagged > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
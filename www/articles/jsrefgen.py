@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-import cgi
 import re
 import jsrefgentmpl
 
@@ -58,7 +57,7 @@ ass(_isNaN_(0/0)); // NaN stands for Not a Number
 ass(0/0 != 0/0); // NaN is not equal to itself!
 ass(!_isFinite_(1/0)); ass(isFinite(1));
 
-!string String 'abc' "abc" "line\u000D\u000A"
+!string String 'abc' "abc" "line\\u000D\\u000A"
 var s=="str"; // double or single quotes
 var s=='str';
 ass("str" _+_ "ing" == "string"); // + concatenates
@@ -95,33 +94,33 @@ ass(/ing/._test_(s));
 ass(s._search_(/ing/) == 3);
 ass('nature'._replace_(/a/,'ur') == 'nurture');
 ass('a:b:c'._split_(':')._join_('..') == 'a..b..c');
-ass('1-37/54'._match_(\d+/g).join() == '1,37,54');
+ass('1-37/54'._match_(\\d+/g).join() == '1,37,54');
 RegExp.lastIndex = 0;
 ass(/o(.)r/._exec_('courage').join() == 'our,u');
 ---
 // search expects a regular expresion (where dot=any):
 ass('imdb.com'.search(".") == 0); // see you must
 ass('imdb.com'.search(/./) == 0); // not forget to
-ass('imdb.com'.search(/\./) == 4); // double-escape
+ass('imdb.com'.search(/\\./) == 4); // double-escape
 ass('imdb.com'.search("\\.") == 4); // your punctuation
 ---
 // Slash Escapes
-s="_\uFFFF_"; // hexadecimal Unicode
+s="_\\uFFFF_"; // hexadecimal Unicode
 s="_\\xFF_"; // hexadecimal ASCII
 x="_\\377_"; s="_\\77_"; s="_\\7_"; // 8-bit octal
-ass('_\\0_' == '\u0000'); // NUL
-ass('_\\b_' == '\u0008'); // backspace
-ass('_\\t_' == '\u0009'); // tab
-ass('_\\f_' == '\u000C); // formfeed
-ass('_\\r_' == '\u000D); // return (CR)
-ass('_\\n_' == '\u000A); // newline (LF)
-ass('_\\v_' == '\u000B'); // vertical tab
+ass('_\\0_' == '\\u0000'); // NUL
+ass('_\\b_' == '\\u0008'); // backspace
+ass('_\\t_' == '\\u0009'); // tab
+ass('_\\f_' == '\\u000C); // formfeed
+ass('_\\r_' == '\\u000D); // return (CR)
+ass('_\\n_' == '\\u000A); // newline (LF)
+ass('_\\v_' == '\\u000B'); // vertical tab
 ass("_\\"_" = '"');
 ass('_\'_' == "'");
-ass("_\\\\_" == '\u005C);
+ass("_\\\\_" == '\\u005C);
 ---
 // multi-line strings
-s = "this is a _\_
+s = "this is a _\\_
 test"; // comments not allowed on the line above
 ass(s == "this is a test");
 s="this is a " _+_ // concatenate
@@ -135,10 +134,10 @@ ass('abc\\0def' != 'abc\\0xyz');
 // user-entered cookies or URLs must encode punctuation
 ass(_escape_("that's all.") == "that%27s%20all.");
 ass(_unescape_("that%27s%20all.") == "that's all.');
-// These are escaped %<>[\]^`{|}#$&,:;=?!/'()~
+// These are escaped %<>[\\]^`{|}#$&,:;=?!/'()~
 // plus space. Alphanumerics and these are not *-._+/@
-// _encodeURI_() translates %<>[\]^`{|}
-// _encoeURIComponent_() %<>[\]^`{|}#$&+,/:;=?
+// _encodeURI_() translates %<>[\\]^`{|}
+// _encoeURIComponent_() %<>[\\]^`{|}#$&+,/:;=?
 // _decodeURI_() and _decodeURIComponent_() do the inverse
 
 !number-to-string Number<->String conversions
@@ -660,6 +659,13 @@ class header_row(object):
 		#"""<span class="big">%s</span> %s""" % (self.left, self.right)
 		return tr(td(s, "header line"))
 
+# what cgi.escape() did, which is gone in Python 3.8
+def escape(s):
+	s = s.replace("&", "&amp;")
+	s = s.replace("<", "&lt;")
+	s = s.replace(">", "&gt;")
+	return s
+
 re_em1 = re.compile("__(.*?)__")
 re_em2 = re.compile("_(.*?)_")
 re_comment = re.compile("(//.*)$")
@@ -671,7 +677,7 @@ class row(object):
 	def tohtml(self):
 		s = self.s.replace("ass(", "assert(");
 		s = s.replace("assa(", "assertApprox(");
-		s = cgi.escape(s)
+		s = escape(s)
 		s = re_comment.sub(span(r"\1", "comment"), s)
 		s = re_em1.sub(span(r"\1", "em"), s)
 		s = re_em2.sub(span(r"\1", "em"), s)